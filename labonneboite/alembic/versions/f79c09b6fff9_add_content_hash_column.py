@@ -0,0 +1,34 @@
+"""
+Add a `content_hash` column to `etablissements_prod`, the offices table of the importer.
+
+Offices imported before content hashes were introduced have a NULL hash, and will be updated once
+(see importer/jobs/extract_etablissements.get_content_hash).
+The table only exists in the database of the importer: elsewhere, nothing is done.
+
+Revision ID: f79c09b6fff9
+Revises: 090e86dfc304
+Create Date: 2026-10-18 10:12:41.503127
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# Revision identifiers, used by Alembic.
+revision = 'f79c09b6fff9'
+down_revision = '090e86dfc304'
+branch_labels = None
+depends_on = None
+
+
+def has_importer_office_table():
+    return 'etablissements_prod' in sa.inspect(op.get_bind()).get_table_names()
+
+
+def upgrade():
+    if has_importer_office_table():
+        op.add_column('etablissements_prod', sa.Column('content_hash', sa.CHAR(32), nullable=True))
+
+
+def downgrade():
+    if has_importer_office_table():
+        op.drop_column('etablissements_prod', 'content_hash')
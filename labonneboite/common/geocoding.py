@@ -1,4 +1,5 @@
 import csv
+import operator
 import os
 import urllib
 import requests
@@ -9,6 +10,7 @@ logger = logging.getLogger('main')
 
 COORDINATES_CACHE = {}
 COMMUNES_CACHE = {}
+DEPARTEMENT_BOUNDING_BOXES_CACHE = {}
 
 
 # --------- BEGIN INTERNAL FUNCTIONS
@@ -81,6 +83,34 @@ def load_coordinates_for_cities():
     return city_coordinates
 
 
+def load_top_cities(count):
+    """
+    Returns the `count` most populated cities (arrondissements excluded),
+    as tuples of load_coordinates_for_cities, from the most populated one.
+    """
+    cities = [city for city in load_coordinates_for_cities() if city[2][-2:] == "00"]
+    return sorted(cities, key=operator.itemgetter(3), reverse=True)[:count]
+
+
+def load_departement_bounding_boxes():
+    """
+    Returns the `(west, south, east, north)` bounding box of the cities of each departement,
+    departements being identified as in offices (first 2 digits of the zipcode).
+    """
+    if not DEPARTEMENT_BOUNDING_BOXES_CACHE:
+        for zipcode, (latitude, longitude) in load_coordinates().iteritems():
+            try:
+                latitude, longitude = float(latitude), float(longitude)
+            except ValueError:
+                continue
+            departement = zipcode[:2]
+            west, south, east, north = DEPARTEMENT_BOUNDING_BOXES_CACHE.get(
+                departement, (longitude, latitude, longitude, latitude))
+            DEPARTEMENT_BOUNDING_BOXES_CACHE[departement] = (
+                min(west, longitude), min(south, latitude), max(east, longitude), max(north, latitude))
+    return DEPARTEMENT_BOUNDING_BOXES_CACHE
+
+
 def get_latitude_and_longitude(city, zipcode):
     location = "%s %s" % (city, zipcode)
     BASE = "http://api-adresse.data.gouv.fr/search/?q="
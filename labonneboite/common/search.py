@@ -1,13 +1,20 @@
 # coding: utf8
 
-from datetime import datetime
+from datetime import date
+import base64
 import collections
-import itertools
+import hashlib
+import inspect
+import json
 import logging
-import random
+import math
+import sys
+import threading
+import time
 import unidecode
 
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError, TransportError
 from slugify import slugify
 
 from labonneboite.common.models import Office
@@ -32,6 +39,289 @@ class JobException(Exception):
     pass
 
 
+class CursorException(Exception):
+    pass
+
+
+class CircuitOpenException(Exception):
+    pass
+
+
+class SearchUnavailableException(Exception):
+    pass
+
+
+# Two offices whose distances to the searched location differ by less than this value (in km)
+# are considered to be at the same distance when resuming a search from a cursor.
+# Many offices share the exact same coordinates (e.g. offices geocoded to their city center),
+# this tolerance only absorbs rounding errors between Elasticsearch sort values and filters.
+KEYSET_DISTANCE_TOLERANCE = 0.000001
+
+# Geohash precision of the map clusters for each zoom level of the map, from zoom level 0.
+# The cells of a given precision are about 1/10 of the width of the map at this zoom level.
+GEOHASH_PRECISION_BY_ZOOM = [1, 1, 1, 2, 2, 3, 3, 3, 4, 4, 5, 5, 5, 6, 6, 7, 7, 8]
+
+# Maximum number of clusters returned for a map, whatever the number of offices.
+MAP_CLUSTERS_MAXIMUM = 1000
+
+# Distance of "France entière" searches.
+NATIONAL_DISTANCE = 3000
+
+# (west, south, east, north) bounding box of metropolitan France, Corsica included.
+# Any two points of this bounding box are less than NATIONAL_DISTANCE km away from each other.
+METROPOLITAN_FRANCE_BOUNDING_BOX = (-5.5, 41.0, 10.0, 51.5)
+
+# Elasticsearch type of the national tops of offices, see create_index.create_national_tops.
+NATIONAL_TOP_TYPE = 'national_top'
+
+EARTH_RADIUS_IN_KM = 6371
+
+# Nested documents holding the scores adjusted to each ROME code
+# when settings.ES_COMPACT_SCORES_FOR_ROME is enabled.
+SCORES_FOR_ROME_PATH = "scores_for_rome"
+
+# Offices are routed to the shards of the index by departement (see get_routing).
+# A search only queries the shards of the departements its circle intersects,
+# unless it intersects more than ROUTING_DEPARTEMENTS_MAXIMUM of them.
+ROUTING_DEPARTEMENTS_MAXIMUM = 10
+# Departements are approximated by the bounding box of their cities' centers,
+# this margin accounts for offices located away from their city center.
+ROUTING_MARGIN_IN_KM = 10
+
+# Offices having the same stars or the same distance are shuffled by a pseudo-random key stored in their document,
+# one of SHUFFLE_KEY_COUNT keys being used each day (see get_shuffle_keys and get_shuffle_key_field).
+SHUFFLE_KEY_COUNT = 7
+
+# Number of sort values of a hit, which make the position of a cursor (see build_json_body_elastic_search).
+KEYSET_LENGTHS = {
+    'distance': 3,
+    'score': 4,
+}
+
+
+class SingleFlight(object):
+    """
+    Ensures that concurrent identical calls (identified by the same key) run only once:
+    while a call is in flight, the other threads asking for the same key wait for it
+    and share its result (or its exception) instead of calling the backend again.
+
+    Results are not cached: a call made after the in-flight one has returned runs again.
+    """
+
+    class Call(object):
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exc_info = None
+            self.waiting_count = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def run(self, key, function, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.Call()
+                self.calls[key] = call
+            else:
+                call.waiting_count += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            if call.waiting_count:
+                logger.info("%s identical requests coalesced with %s", call.waiting_count, key)
+            call.done.set()
+
+
+# Coalesces identical concurrent Elasticsearch requests, see get_elastic_search_key.
+ELASTIC_SEARCH_SINGLE_FLIGHT = SingleFlight()
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a backend which keeps failing or being slow, so that requests fail fast
+    instead of piling up while waiting for timeouts.
+
+    - closed: calls go through. The circuit opens when at least `failure_ratio` of the
+      last `window` calls failed (raised one of `failure_exceptions` or took more than
+      `slow_call_duration` seconds).
+    - open: calls fail immediately with CircuitOpenException, during `open_duration` seconds.
+    - half-open: a single probe call goes through, the others still fail immediately.
+      The circuit closes if the probe succeeds, and opens again otherwise.
+
+    The state is held by each process.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, window, failure_ratio, slow_call_duration, open_duration, failure_exceptions=(Exception,)):
+        self.failure_ratio = failure_ratio
+        self.slow_call_duration = slow_call_duration
+        self.open_duration = open_duration
+        self.failure_exceptions = failure_exceptions
+        self.lock = threading.Lock()
+        self.outcomes = collections.deque(maxlen=window)
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probing = False
+
+    def get_state(self):
+        with self.lock:
+            return self._refresh_state()
+
+    def _refresh_state(self):
+        if self.state == self.OPEN and time.time() - self.opened_at >= self.open_duration:
+            self.state = self.HALF_OPEN
+        return self.state
+
+    def _open(self):
+        logger.warning("circuit breaker opened for %s seconds", self.open_duration)
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
+
+    def call(self, function, *args, **kwargs):
+        with self.lock:
+            state = self._refresh_state()
+            if state == self.OPEN or (state == self.HALF_OPEN and self.probing):
+                raise CircuitOpenException("circuit breaker is %s" % state)
+            is_probe = state == self.HALF_OPEN
+            if is_probe:
+                self.probing = True
+
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except self.failure_exceptions:
+            self._record(False, is_probe)
+            raise
+        except Exception:
+            # the backend did answer, this is not a failure of the backend
+            self._record(True, is_probe)
+            raise
+        self._record(time.time() - start <= self.slow_call_duration, is_probe)
+        return result
+
+    def _record(self, is_success, is_probe):
+        with self.lock:
+            if is_probe:
+                self.probing = False
+                if is_success:
+                    logger.info("circuit breaker closed")
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+                else:
+                    self._open()
+                return
+            self.outcomes.append(is_success)
+            if self.state == self.CLOSED and len(self.outcomes) == self.outcomes.maxlen:
+                failure_count = self.outcomes.count(False)
+                if failure_count >= self.failure_ratio * self.outcomes.maxlen:
+                    self._open()
+
+
+class StaleResultCache(object):
+    """
+    Keeps the last good result of the `maximum` most recently used keys,
+    to be served when the backend is unavailable.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.pop(key, None)
+            if result is not None:
+                self.results[key] = result
+            return result
+
+    def set(self, key, result):
+        with self.lock:
+            self.results.pop(key, None)
+            self.results[key] = result
+            while len(self.results) > self.maximum:
+                self.results.popitem(last=False)
+
+
+ELASTIC_SEARCH_CIRCUIT_BREAKER = CircuitBreaker(
+    window=settings.ES_CIRCUIT_BREAKER_WINDOW,
+    failure_ratio=settings.ES_CIRCUIT_BREAKER_FAILURE_RATIO,
+    slow_call_duration=settings.ES_CIRCUIT_BREAKER_SLOW_CALL_DURATION,
+    open_duration=settings.ES_CIRCUIT_BREAKER_OPEN_DURATION,
+    failure_exceptions=(ConnectionError, TransportError),
+)
+
+ELASTIC_SEARCH_STALE_RESULTS = StaleResultCache(settings.ES_STALE_RESULTS_MAXIMUM)
+
+
+def run_elastic_search(operation, index, json_body, routing=None):
+    """
+    Runs an Elasticsearch `search` or `count` request through the circuit breaker,
+    on the shards of the given `routing` only (see get_routing).
+
+    When Elasticsearch fails or the circuit is open, the last good response to the same request
+    is returned, with an additional `stale` key set to True.
+    Raises SearchUnavailableException when no such response is available.
+    """
+    key = get_elastic_search_key(operation, index, json_body)
+
+    def call():
+        es = Elasticsearch(timeout=settings.ES_TIMEOUT)
+        if operation == "count":
+            return es.count(index=index, doc_type="office", body=json_body, routing=routing)
+        return es.search(index=index, doc_type="office", body=json_body, routing=routing)
+
+    try:
+        res = ELASTIC_SEARCH_CIRCUIT_BREAKER.call(call)
+    except (CircuitOpenException, ConnectionError, TransportError) as e:
+        res = ELASTIC_SEARCH_STALE_RESULTS.get(key)
+        if res is None:
+            logger.warning("Elastic Search %s unavailable: %s", operation, e)
+            raise SearchUnavailableException("Elastic Search %s unavailable: %s" % (operation, e))
+        logger.warning("serving stale Elastic Search %s result: %s", operation, e)
+        return dict(res, stale=True)
+
+    ELASTIC_SEARCH_STALE_RESULTS.set(key, res)
+    return res
+
+
+# Result of search_companies_for_naf_codes.
+# `stale` is True when Elasticsearch was unavailable and the result is the last known one.
+SearchResult = collections.namedtuple(
+    'SearchResult',
+    ['companies', 'companies_count', 'next_search_after', 'facets', 'stale'],
+)
+
+
+def get_elastic_search_key(operation, index, json_body):
+    """
+    Normalized key of an Elasticsearch request: requests built from identical search parameters
+    have the same body, whatever the way the parameters were given (e.g. string or int headcount).
+    """
+    return "%s:%s:%s" % (operation, index, json.dumps(json_body, sort_keys=True))
+
+
 class Fetcher(object):
 
     def __init__(self, **kwargs):
@@ -58,11 +348,33 @@ class Fetcher(object):
         self.rome = None
         self.from_number = int(kwargs.get('from') or 1)
         self.to_number = int(kwargs.get('to') or 10)
+        self.cursor = kwargs.get('cursor')
+        self.next_cursor = None
+        self.facets = None
+        self.stale = False
+
+    def get_search_after(self):
+        """
+        Returns the position from which the current page should be fetched
+        if a valid cursor matching the current page was given, None otherwise.
+        Without this position, the page is fetched with a regular `from` offset.
+        """
+        if not self.cursor:
+            return None
+        try:
+            sort, search_after, from_number = decode_cursor(self.cursor)
+        except CursorException:
+            logger.info("ignoring invalid cursor %s", self.cursor)
+            return None
+        if sort != self.sort or from_number != self.from_number:
+            logger.info("ignoring cursor %s which does not match the current page", self.cursor)
+            return None
+        return search_after
 
     def get_companies_for_rome_and_naf_codes(self, rome_codes, naf_codes, distance=None):
         if distance is None:
             distance = self.distance
-        companies = _get_companies_from_api(
+        result = _get_companies_from_api(
             rome_codes,
             naf_codes,
             self.longitude,
@@ -75,7 +387,15 @@ class Fetcher(object):
             self.flag_alternance,
             self.flag_junior,
             self.flag_senior,
-            self.flag_handicap)
+            self.flag_handicap,
+            search_after=self.get_search_after())
+        companies = result.companies
+        self.company_count = result.companies_count
+        self.facets = result.facets
+        self.stale = result.stale
+        self.next_cursor = None
+        if result.next_search_after and self.to_number < self.company_count:
+            self.next_cursor = encode_cursor(self.sort, result.next_search_after, self.to_number + 1)
         search_companies = {}
         for company in companies:
             search_companies[company["siret"]] = company
@@ -114,7 +434,7 @@ class Fetcher(object):
             headcount_filter=self.headcount,
             rome_code=rome_code)
 
-    def get_companies(self):
+    def set_location_and_rome(self):
         try:
             self.latitude, self.longitude = geocoding.get_latitude_and_longitude_from_file(self.city, self.zipcode)
             logger.info("location found for %s %s : lat=%s long=%s",
@@ -124,8 +444,36 @@ class Fetcher(object):
             raise LocationError
 
         self.rome = mapping_util.SLUGIFIED_ROME_LABELS[self.occupation]
-        self.company_count = self.get_company_count([self.rome], [self.naf], self.distance)
-        logger.debug("set company_count to %s from get_companies", self.company_count)
+
+    def get_clusters(self, bounding_box, zoom):
+        """
+        Returns the offices of the search located in the `(west, south, east, north)` bounding box
+        aggregated as clusters (see get_clusters_for_naf_codes).
+        """
+        self.set_location_and_rome()
+        naf_codes = get_api_ready_rome_and_naf_codes([self.rome], [self.naf])
+        try:
+            headcount_filter = int(self.headcount)
+        except (TypeError, ValueError):
+            headcount_filter = settings.HEADCOUNT_WHATEVER
+        return get_clusters_for_naf_codes(
+            naf_codes,
+            self.latitude,
+            self.longitude,
+            self.distance,
+            bounding_box,
+            zoom,
+            headcount_filter=headcount_filter,
+            flag_alternance=self.flag_alternance,
+            flag_junior=self.flag_junior,
+            flag_senior=self.flag_senior,
+            flag_handicap=self.flag_handicap,
+            rome_code=self.rome,
+            index=settings.ES_INDEX,
+        )
+
+    def get_companies(self):
+        self.set_location_and_rome()
 
         if self.from_number < 1:
             self.from_number = 1
@@ -133,35 +481,47 @@ class Fetcher(object):
         if (self.from_number - 1) % 10:
             self.from_number = 1
             self.to_number = 10
+        if self.to_number - self.from_number > settings.PAGINATION_COMPANIES_PER_PAGE:
+            self.from_number = 1
+            self.to_number = 10
+
+        # The same Elasticsearch query returns both the company_count and the current page.
+        result = self.get_companies_for_rome_and_naf_codes([self.rome], [self.naf], self.distance)
+        logger.debug("set company_count to %s from get_companies", self.company_count)
+
         if self.to_number > self.company_count + 1:
             self.to_number = self.company_count + 1
         if self.to_number < self.from_number:
             # this happens if a page out of bound is requested
             self.from_number = 1
             self.to_number = 10
-        if self.to_number - self.from_number > settings.PAGINATION_COMPANIES_PER_PAGE:
-            self.from_number = 1
-            self.to_number = 10
+            self.cursor = None
+            if self.company_count:
+                result = self.get_companies_for_rome_and_naf_codes([self.rome], [self.naf], self.distance)
 
-        result = []
-        if self.company_count:
-            result = self.get_companies_for_rome_and_naf_codes([self.rome], [self.naf], self.distance)
         if self.company_count < 10:
-            alternative_rome_codes = settings.ROME_MOBILITIES[self.rome]
-            for rome in alternative_rome_codes:
-                if not rome == self.rome:
-                    self.naf_codes = []
-                    company_count = self.get_company_count([rome], [self.naf], self.distance)
-                    self.alternative_rome_codes[rome] = company_count
-            last_count = 0
-            for distance, distance_label in [(30, '30 km'), (50, '50 km'), (3000, u'France entière')]:
-                self.naf_codes = []
-                company_count = self.get_company_count([self.rome], [self.naf], distance)
-                if company_count > last_count:
-                    last_count = company_count
-                    self.alternative_distances[distance] = (distance_label, last_count)
+            try:
+                self.set_alternatives()
+            except SearchUnavailableException:
+                # alternatives are optional, the results can be displayed without them
+                logger.info("alternatives unavailable for %s %s %s", self.city, self.zipcode, self.rome)
         return result
 
+    def set_alternatives(self):
+        alternative_rome_codes = settings.ROME_MOBILITIES[self.rome]
+        for rome in alternative_rome_codes:
+            if not rome == self.rome:
+                self.naf_codes = []
+                company_count = self.get_company_count([rome], [self.naf], self.distance)
+                self.alternative_rome_codes[rome] = company_count
+        last_count = 0
+        for distance, distance_label in [(30, '30 km'), (50, '50 km'), (3000, u'France entière')]:
+            self.naf_codes = []
+            company_count = self.get_company_count([self.rome], [self.naf], distance)
+            if company_count > last_count:
+                last_count = company_count
+                self.alternative_distances[distance] = (distance_label, last_count)
+
     def get_first_rome_suggestion(self, job):
         logger.debug("get suggestions for input %s", job)
         suggestions = build_job_label_suggestions(job)
@@ -199,9 +559,12 @@ def _get_companies_from_api(
         flag_alternance,
         flag_junior,
         flag_senior,
-        flag_handicap):
+        flag_handicap,
+        search_after=None):
     """Internal function to be used to avoid the http overhead as for now
     the application server and the API server are on the same server.
+
+    Returns a SearchResult whose companies are JSON.
     """
     try:
         headcount_filter = int(headcount)
@@ -216,15 +579,44 @@ def _get_companies_from_api(
         raise Exception("multi ROME search not supported")
     rome_code = rome_codes[0]
 
-    companies, _ = get_companies_for_naf_codes(
+    result = search_companies_for_naf_codes(
         naf_codes, latitude, longitude, distance, from_number, to_number,
         flag_alternance=flag_alternance,
         flag_junior=flag_junior,
         flag_senior=flag_senior,
         flag_handicap=flag_handicap,
         headcount_filter=headcount_filter, sort=sort, index=settings.ES_INDEX,
-        rome_code=rome_code)
-    return [company.as_json() for company in companies]
+        rome_code=rome_code, search_after=search_after, facets=True)
+    return result._replace(companies=[company.as_json() for company in result.companies])
+
+
+def encode_cursor(sort, search_after, from_number):
+    """
+    Build an opaque cursor from the position of the last hit of a page (see retrieve_companies_from_elastic_search),
+    made of all its sort values down to its siret, which breaks any tie: e.g. `[score, boosted, shuffle_key, siret]`.
+
+    The cursor lets the next page (starting at `from_number`) be fetched by filtering out
+    every office ranked before this last hit (see build_keyset_filter) instead of making Elasticsearch skip
+    the first `from_number - 1` hits, which gets more and more expensive on deep pages.
+    """
+    payload = json.dumps({'sort': sort, 'values': search_after, 'from': from_number})
+    return base64.urlsafe_b64encode(payload)
+
+
+def decode_cursor(cursor):
+    """
+    Does exactly the reverse operation of encode_cursor: returns a `(sort, search_after, from_number)` tuple.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        sort = payload['sort']
+        search_after = payload['values']
+        from_number = int(payload['from'])
+    except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+        raise CursorException("invalid cursor %s" % cursor)
+    if not isinstance(search_after, list) or len(search_after) != KEYSET_LENGTHS.get(sort):
+        raise CursorException("invalid cursor %s" % cursor)
+    return sort, search_after, from_number
 
 
 def count_companies_for_naf_codes(*args, **kwargs):
@@ -232,92 +624,344 @@ def count_companies_for_naf_codes(*args, **kwargs):
         index = kwargs.pop('index')
     else:
         index = 'labonneboite'
+    params = inspect.getcallargs(build_json_body_elastic_search, *args, **kwargs)
+    if is_national_search(params):
+        national_top = get_national_top(params['rome_code'], index)
+        if national_top:
+            return national_top['office_count']
+
     json_body = build_json_body_elastic_search(*args, **kwargs)
     del json_body["sort"]
-    es = Elasticsearch()
-    res = es.count(index=index, doc_type="office", body=json_body)
+    routing = get_routing(params['latitude'], params['longitude'], params['distance'])
+    key = get_elastic_search_key("count", index, json_body)
+    res = ELASTIC_SEARCH_SINGLE_FLIGHT.run(key, run_elastic_search, "count", index, json_body, routing)
     return res["count"]
 
 
 def get_companies_for_naf_codes(*args, **kwargs):
+    result = search_companies_for_naf_codes(*args, **kwargs)
+    return result.companies, result.companies_count
+
+
+def search_companies_for_naf_codes(*args, **kwargs):
+    """
+    Same as get_companies_for_naf_codes, but returns a SearchResult which also holds the position
+    of the last hit, which can be given back as `search_after` to fetch the following page,
+    and the facets when requested with `facets=True`.
+    """
     if 'index' in kwargs:
         index = kwargs.pop('index')
     else:
         index = 'labonneboite'
+
+    params = inspect.getcallargs(build_json_body_elastic_search, *args, **kwargs)
+    if is_national_search(params) and params['sort'] == 'score' and not params['search_after']:
+        national_top = get_national_top(params['rome_code'], index)
+        from_number, to_number = params['from_number'], params['to_number']
+        if national_top and from_number and to_number and to_number <= len(national_top['offices']):
+            return search_national_top(national_top, params)
+
     json_body = build_json_body_elastic_search(*args, **kwargs)
     try:
         distance_sort = kwargs['sort'] == 'distance'
     except KeyError:
         distance_sort = True
-    companies, companies_count = retrieve_companies_from_elastic_search(
+    # Identical concurrent searches share a single Elasticsearch request and database query.
+    key = get_elastic_search_key("search", index, json_body)
+    return ELASTIC_SEARCH_SINGLE_FLIGHT.run(
+        key,
+        retrieve_companies_from_elastic_search,
         json_body,
         index=index,
-        distance_sort=distance_sort
+        distance_sort=distance_sort,
+        routing=get_routing(params['latitude'], params['longitude'], params['distance']),
         )
 
+
+def is_national_search(params):
+    """
+    Whether a search (given as the parameters of build_json_body_elastic_search)
+    can be answered from the national top of offices of its rome_code:
+    a "France entière" search from metropolitan France, without any other filter.
+    """
+    if not params['rome_code'] or int(params['distance']) < NATIONAL_DISTANCE:
+        return False
     try:
-        rome_code = kwargs['rome_code']
-    except KeyError:
-        rome_code = None
-    companies = shuffle_companies(companies, distance_sort, rome_code)
-    return companies, companies_count
+        headcount_filter = int(params['headcount_filter'])
+    except ValueError:
+        headcount_filter = settings.HEADCOUNT_WHATEVER
+    if headcount_filter != settings.HEADCOUNT_WHATEVER:
+        return False
+    if any(params[flag] for flag in ['flag_alternance', 'flag_junior', 'flag_senior', 'flag_handicap']):
+        return False
+    # every naf code of the rome_code, i.e. no naf filter
+    if set(params['naf_codes']) != set(mapping_util.Rome2NafMapper().map([params['rome_code']])):
+        return False
+    west, south, east, north = METROPOLITAN_FRANCE_BOUNDING_BOX
+    return south <= float(params['latitude']) <= north and west <= float(params['longitude']) <= east
+
+
+def get_routing(latitude, longitude, distance):
+    """
+    Returns the routing of the offices located within `distance` km of a location,
+    i.e. the departements intersecting this circle, comma separated (e.g. "54,55,57").
+    Returns None (all shards are queried) when there are more than ROUTING_DEPARTEMENTS_MAXIMUM of them.
+
+    Offices are indexed with their departement as routing, see get_office_routing.
+    """
+    distance = float(distance) + ROUTING_MARGIN_IN_KM
+    if distance > NATIONAL_DISTANCE:
+        return None
+    latitude, longitude = float(latitude), float(longitude)
+    departements = []
+    for departement, (west, south, east, north) in geocoding.load_departement_bounding_boxes().iteritems():
+        # closest point of the bounding box of the departement
+        closest_latitude = max(south, min(latitude, north))
+        closest_longitude = max(west, min(longitude, east))
+        if get_arc_distance(latitude, longitude, closest_latitude, closest_longitude) <= distance:
+            departements.append(departement)
+            if len(departements) > ROUTING_DEPARTEMENTS_MAXIMUM:
+                return None
+    if not departements:
+        return None
+    return ",".join(sorted(departements))
+
+
+def get_office_routing(office):
+    """
+    Returns the routing of an office in the index: its departement, as the first 2 digits of its zipcode
+    (Corsica is "20" and all overseas departements are "97"), consistently with get_routing.
+    The `office` parameter can be an `Office` or an `OfficeAdminAdd` instance.
+    """
+    return office.zipcode[:2]
 
 
-def shuffle_companies(companies, distance_sort, rome_code):
+def get_national_top(rome_code, index):
     """
-    Slightly shuffle the results of a company search this way:
-    1) in case of sort by score (default)
-    - split results in groups of companies having the exact same stars (e.g. 2.3 or 4.9)
-    - shuffle each of these groups in a predictable reproductible way
-    Note that the scores are adjusted to the contextual rome_code.
-    2) in case of sort by distance
-    same things as 1°, grouping instead companies having the same distance in km.
+    Returns the national top of offices of a rome_code (see create_index.create_national_tops),
+    None if it is not available.
     """
-    buckets = collections.OrderedDict()
-    for company in companies:
-        if distance_sort:
-            key = company.distance
-        else:
-            if company.score == 100:
-                # make an exception for offices which were manually boosted (score 100)
-                # to ensure they consistently appear on top of results
-                # and are not shuffled with other offices having 5.0 stars,
-                # but only score 99 and not 100
-                key = 100  # special value designed to be distinct from 5.0 stars
-            else:
-                key = company.get_stars_for_rome_code(rome_code)
-        if key not in buckets:
-            buckets[key] = []
-        buckets[key].append(company)
+    es = Elasticsearch(timeout=settings.ES_TIMEOUT)
+    try:
+        res = es.get(index=index, doc_type=NATIONAL_TOP_TYPE, id=rome_code, ignore=404)
+    except (ConnectionError, TransportError) as e:
+        logger.info("national top unavailable for %s: %s", rome_code, e)
+        return None
+    if not res.get('found'):
+        return None
+    return res['_source']
+
+
+def get_arc_distance(latitude1, longitude1, latitude2, longitude2):
+    """
+    Distance in km between two points, computed as Elasticsearch `arc` distances.
+    """
+    latitude1, longitude1, latitude2, longitude2 = [
+        math.radians(float(value)) for value in [latitude1, longitude1, latitude2, longitude2]
+    ]
+    haversine = (
+        math.sin((latitude2 - latitude1) / 2) ** 2 +
+        math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_IN_KM * math.asin(min(1, math.sqrt(haversine)))
+
+
+def search_national_top(national_top, params):
+    """
+    Same as retrieve_companies_from_elastic_search for a national search (see is_national_search),
+    answered from the national top of offices of its rome_code. No facets are computed.
+    The position of the last office is returned in the same form as the sort values of Elasticsearch,
+    so that the following pages can be fetched from Elasticsearch.
+    """
+    # Same order as build_json_body_elastic_search: by score, then boosted offices first,
+    # then by the shuffle key of the day, which is derived from the siret, then by siret.
+    shuffle_key_field = get_shuffle_key_field()
+
+    def get_sort_values(office):
+        return [
+            office['score'],
+            int(office['boosted']),
+            get_shuffle_keys(office['siret'])[shuffle_key_field],
+            office['siret'],
+        ]
+
+    offices = sorted(
+        national_top['offices'],
+        key=lambda office: (-office['score'], not office['boosted']) + tuple(get_sort_values(office)[2:]),
+    )
+    offices = offices[params['from_number'] - 1:params['to_number']]
+    next_search_after = get_sort_values(offices[-1]) if offices else None
+
+    distances = {
+        office['siret']: int(round(get_arc_distance(
+            params['latitude'], params['longitude'], office['lat'], office['lon'])))
+        for office in offices
+    }
+    company_dict = {}
+    if distances:
+        for obj in Office.query.filter(Office.siret.in_(distances.keys())):
+            obj.distance = distances[obj.siret]
+            company_dict[obj.siret] = obj
+
+    companies = []
+    for office in offices:
+        company = company_dict.get(office['siret'])
+        if company and company.has_city():
+            companies.append(company)
+    return SearchResult(companies, national_top['office_count'], next_search_after, None, False)
+
+
+def build_bounding_box_filter(bounding_box):
+    west, south, east, north = bounding_box
+    return {
+        "geo_bounding_box": {
+            "location": {
+                "top_left": {
+                    "lat": north,
+                    "lon": west
+                },
+                "bottom_right": {
+                    "lat": south,
+                    "lon": east
+                }
+            }
+        }
+    }
+
 
-    # generating now predictable yet divergent seed for shuffle
-    # the list of results should be noticeably different from one day to the other,
-    # but stay the same for a given day
-    day_of_year = datetime.now().timetuple().tm_yday
-    shuffle_seed = day_of_year / 366.0
+def get_geohash_precision(zoom):
+    zoom = max(0, min(zoom, len(GEOHASH_PRECISION_BY_ZOOM) - 1))
+    return GEOHASH_PRECISION_BY_ZOOM[zoom]
 
-    for _, bucket in buckets.iteritems():
-        random.shuffle(bucket, lambda: shuffle_seed)
-    companies = list(itertools.chain.from_iterable(buckets.values()))
 
-    return companies
+def get_clusters_for_naf_codes(naf_codes, latitude, longitude, distance, bounding_box, zoom, **kwargs):
+    """
+    Returns the offices found with the same filters as build_json_body_elastic_search
+    and located in the `(west, south, east, north)` bounding box of a map,
+    aggregated by geohash cells whose size depends on the `zoom` level of the map:
+    [
+        {'geohash': u'u0u6', 'count': 12, 'latitude': 49.1, 'longitude': 6.0, 'best_score': 87},
+        ...
+    ]
+    `latitude` and `longitude` are the centroid of the offices of the cluster,
+    `best_score` is their best score, adjusted to the `rome_code` if given.
+
+    The size of the result only depends on the zoom level, whatever the number of offices found.
+    """
+    index = kwargs.pop('index', 'labonneboite')
+    rome_code = kwargs.get('rome_code')
+
+    # Reuse the filters of the regular search, without any sort nor shuffle.
+    json_body = build_json_body_elastic_search(naf_codes, latitude, longitude, distance, **kwargs)
+    filtered_query = json_body["query"]
+    filtered_query["filtered"]["filter"]["bool"]["must"].append(build_bounding_box_filter(bounding_box))
+
+    json_body = {
+        "size": 0,
+        "query": filtered_query,
+        "aggs": {
+            "clusters": {
+                "geohash_grid": {
+                    "field": "location",
+                    "precision": get_geohash_precision(zoom),
+                    "size": MAP_CLUSTERS_MAXIMUM
+                },
+                "aggs": {
+                    # Elasticsearch 1.7 has no geo_centroid aggregation.
+                    "latitude": {
+                        "avg": {
+                            "field": "location.lat"
+                        }
+                    },
+                    "longitude": {
+                        "avg": {
+                            "field": "location.lon"
+                        }
+                    },
+                    "best_score": build_best_score_aggregation(rome_code),
+                }
+            }
+        }
+    }
+
+    logger.info("Elastic Search request : %s", json_body)
+    routing = get_routing(latitude, longitude, distance)
+    key = get_elastic_search_key("search", index, json_body)
+    res = ELASTIC_SEARCH_SINGLE_FLIGHT.run(key, run_elastic_search, "search", index, json_body, routing)
+    return [
+        {
+            'geohash': bucket['key'],
+            'count': bucket['doc_count'],
+            'latitude': bucket['latitude']['value'],
+            'longitude': bucket['longitude']['value'],
+            'best_score': get_best_score_from_aggregation(bucket['best_score']),
+        }
+        for bucket in res['aggregations']['clusters']['buckets']
+    ]
+
+
+def get_shuffle_keys(siret):
+    """
+    Returns the `{"shuffle_key_<n>": key}` of an office, stored in its document (see create_index.get_office_as_es_doc):
+    SHUFFLE_KEY_COUNT pseudo-random keys derived from its siret, so that they do not change from one build to another.
+    """
+    return {
+        "shuffle_key_%s" % n: int(hashlib.md5("%s:%s" % (siret, n)).hexdigest()[:7], 16)
+        for n in range(SHUFFLE_KEY_COUNT)
+    }
+
+
+def get_shuffle_key_field():
+    """
+    Returns the field of the key shuffling offices sharing the same stars or the same distance:
+    the list of results should be noticeably different from one day to the other,
+    but stay the same for a given day (and thus from one page to another).
+    """
+    return "shuffle_key_%s" % (date.today().toordinal() % SHUFFLE_KEY_COUNT)
 
 
 def build_json_body_elastic_search(
         naf_codes, latitude, longitude, distance,
         from_number=None, to_number=None, headcount_filter=settings.HEADCOUNT_WHATEVER,
         sort="distance", flag_alternance=0, flag_junior=0, flag_senior=0, flag_handicap=0,
-        rome_code=None):
+        rome_code=None, search_after=None, facets=False):
+    """
+    Offices are slightly shuffled this way:
+    1) in case of sort by score (default)
+    - offices having the exact same stars (e.g. 2.3 or 4.9) are ordered by the shuffle key of the day
+    (see get_shuffle_key_field), offices manually boosted (score 100) first
+    Note that the scores are adjusted to the contextual rome_code.
+    2) in case of sort by distance
+    same thing as 1°, shuffling instead offices having the same distance.
+    Offices are finally ordered by siret, so that each office has a unique position.
+
+    `search_after` : optional sort values of the last hit of the previous page (see encode_cursor).
+    When given, the page is fetched from this hit onwards instead of using a `from` offset.
+
+    `facets` : when True, the request also counts the offices matching each value of the naf,
+    headcount, flag_alternance and public filters (see get_facets_from_aggregations).
+    The filters of those dimensions are then applied as a post filter: the counts of a dimension
+    take into account the filters of all the other dimensions, but not its own filter.
+    """
 
     sort_attrs = []
 
+    filters = []
+
+    # Filters of the dimensions which can be faceted, by dimension.
+    # The naf dimension can only be faceted when searching for a rome_code,
+    # the other offices of the naf codes mapped to it being identified by the score_for_rome filter.
+    facet_filters = collections.OrderedDict()
+
     naf_filter = {
         "terms": {
             "naf": naf_codes
         }
     }
-
-    filters = [naf_filter]
+    if facets and rome_code is not None:
+        facet_filters['naf'] = naf_filter
+    else:
+        filters.append(naf_filter)
 
     # in some cases, a string is given as input, let's ensure it is an int from now on
     try:
@@ -325,56 +969,25 @@ def build_json_body_elastic_search(
     except ValueError:
         headcount_filter = settings.HEADCOUNT_WHATEVER
 
-    min_office_size = None
-    max_office_size = None
-    if headcount_filter == settings.HEADCOUNT_SMALL_ONLY:
-        max_office_size = settings.HEADCOUNT_SMALL_ONLY_MAXIMUM
-    elif headcount_filter == settings.HEADCOUNT_BIG_ONLY:
-        min_office_size = settings.HEADCOUNT_BIG_ONLY_MINIMUM
-
-    if min_office_size or max_office_size:
-        if min_office_size:
-            headcount_filter = {"gte": min_office_size}
-        if max_office_size:
-            headcount_filter = {"lte": max_office_size}
-        headcount_filter_dic = {
-            "numeric_range": {
-                "headcount": headcount_filter
-            }
-        }      
-        filters += [headcount_filter_dic]
+    headcount_filter_dic = build_headcount_filter(headcount_filter)
+    if headcount_filter_dic:
+        facet_filters['headcount'] = headcount_filter_dic
 
     if flag_alternance == 1:
-        flag_alternance_filter = {
-            "term": {
-                "flag_alternance": 1
-            }
-        }
-        filters += [flag_alternance_filter]
+        facet_filters['flag_alternance'] = build_flag_filter('flag_alternance')
 
     if flag_junior == 1:
-        flag_junior_filter = {
-            "term": {
-                "flag_junior": 1
-            }
-        }
-        filters += [flag_junior_filter]
+        facet_filters['public'] = build_flag_filter('flag_junior')
 
     if flag_senior == 1:
-        flag_senior_filter = {
-            "term": {
-                "flag_senior": 1
-            }
-        }
-        filters += [flag_senior_filter]
+        facet_filters['public'] = build_flag_filter('flag_senior')
 
     if flag_handicap == 1:
-        flag_handicap_filter = {
-            "term": {
-                "flag_handicap": 1
-            }
-        }
-        filters += [flag_handicap_filter]
+        facet_filters['public'] = build_flag_filter('flag_handicap')
+
+    if not facets:
+        filters += facet_filters.values()
+        facet_filters.clear()
 
     if sort not in ['distance', 'score']:
         logger.info('sort should be distance or score: %s', sort)
@@ -387,35 +1000,50 @@ def build_json_body_elastic_search(
                 "lon": longitude
             },
             "order": "asc",
-            "unit": "km"
+            "unit": "km",
+            # same algorithm as in build_keyset_filter so that distances can be compared
+            "distance_type": "arc"
         }
     }
 
-    if rome_code is None:
-        score_sort = {
-            "score": {
-                "order": "desc"
-            }
-        }
-    else:
-        field_name = "score_for_rome_%s" % rome_code
-        score_sort = {
-            field_name: {
-                "order": "desc"
-            }
+    # key of the day used to shuffle offices having the same stars or distance
+    shuffle_sort = {
+        get_shuffle_key_field(): {
+            "order": "asc",
+            # indexes built before the shuffle keys were stored can still be searched
+            "unmapped_type": "integer"
         }
-        score_for_rome_filter = {
-            "exists": {
-                "field": field_name
-            }
+    }
+
+    # siret is unique and guarantees a total order, which is required by cursor pagination
+    siret_sort = {
+        "siret": {
+            "order": "asc"
         }
-        filters.append(score_for_rome_filter)
+    }
+
+    if rome_code is not None:
+        filters.append(build_score_for_rome_filter(rome_code))
+    score_sort = build_score_sort(rome_code)
 
     if sort == "distance":
         sort_attrs.append(distance_sort)
-        sort_attrs.append(score_sort)
+        sort_attrs.append(shuffle_sort)
+        sort_attrs.append(siret_sort)
     elif sort == "score":
         sort_attrs.append(score_sort)
+        # make an exception for offices which were manually boosted (score 100)
+        # to ensure they consistently appear on top of results
+        # and are not shuffled with other offices having the same stars
+        sort_attrs.append({
+            "boosted": {
+                "order": "desc",
+                "unmapped_type": "integer"
+            }
+        })
+        sort_attrs.append(shuffle_sort)
+        sort_attrs.append(siret_sort)
+        # the distance is not used for ordering but is displayed in results
         sort_attrs.append(distance_sort)
 
     filters.append({
@@ -441,8 +1069,25 @@ def build_json_body_elastic_search(
         }
     }
 
+    post_filters = facet_filters.values()
+    if search_after:
+        post_filters.append(build_keyset_filter(sort, rome_code, latitude, longitude, search_after))
+
+    if post_filters:
+        # Post filters do not alter the total count of offices, computed by an aggregation instead.
+        json_body["post_filter"] = build_and_filter(post_filters)
+        json_body["aggs"] = {
+            "companies_count": {
+                "filter": build_and_filter(facet_filters.values())
+            }
+        }
+
+    if facets:
+        json_body.setdefault("aggs", {}).update(build_facet_aggregations(facet_filters))
+
     if from_number:
-        json_body["from"] = from_number - 1
+        if not search_after:
+            json_body["from"] = from_number - 1
         if to_number:
             if to_number < from_number:
                 # this should never happen
@@ -452,22 +1097,341 @@ def build_json_body_elastic_search(
     return json_body
 
 
-def retrieve_companies_from_elastic_search(json_body, distance_sort=True, index="labonneboite"):
-    es = Elasticsearch()
-    res = es.search(index=index, doc_type="office", body=json_body)
+def build_score_sort(rome_code=None):
+    """
+    Sort offices by decreasing score, adjusted to the rome_code if given,
+    whatever the layout of the scores in the index (see settings.ES_COMPACT_SCORES_FOR_ROME).
+    """
+    if rome_code is None:
+        return {
+            "score": {
+                "order": "desc"
+            }
+        }
+    if settings.ES_COMPACT_SCORES_FOR_ROME:
+        return {
+            "%s.score" % SCORES_FOR_ROME_PATH: {
+                "order": "desc",
+                "nested_path": SCORES_FOR_ROME_PATH,
+                "nested_filter": {
+                    "term": {
+                        "%s.rome_code" % SCORES_FOR_ROME_PATH: rome_code
+                    }
+                }
+            }
+        }
+    return {
+        "score_for_rome_%s" % rome_code: {
+            "order": "desc"
+        }
+    }
+
+
+def build_score_for_rome_filter(rome_code, score_range=None):
+    """
+    Returns the filter matching the offices having a score adjusted to the rome_code,
+    within the `score_range` if given (e.g. `{"lte": 80}`).
+    """
+    if settings.ES_COMPACT_SCORES_FOR_ROME:
+        filters = [{
+            "term": {
+                "%s.rome_code" % SCORES_FOR_ROME_PATH: rome_code
+            }
+        }]
+        if score_range:
+            filters.append({
+                "range": {
+                    "%s.score" % SCORES_FOR_ROME_PATH: score_range
+                }
+            })
+        return {
+            "nested": {
+                "path": SCORES_FOR_ROME_PATH,
+                "filter": build_and_filter(filters)
+            }
+        }
+    field_name = "score_for_rome_%s" % rome_code
+    if score_range:
+        return {
+            "range": {
+                field_name: score_range
+            }
+        }
+    return {
+        "exists": {
+            "field": field_name
+        }
+    }
+
+
+def build_best_score_aggregation(rome_code=None):
+    """
+    Aggregation of the best score of offices, adjusted to the rome_code if given.
+    Its value is read with get_best_score_from_aggregation.
+    """
+    if rome_code is None:
+        return {
+            "max": {
+                "field": "score"
+            }
+        }
+    if settings.ES_COMPACT_SCORES_FOR_ROME:
+        return {
+            "nested": {
+                "path": SCORES_FOR_ROME_PATH
+            },
+            "aggs": {
+                "rome": {
+                    "filter": {
+                        "term": {
+                            "%s.rome_code" % SCORES_FOR_ROME_PATH: rome_code
+                        }
+                    },
+                    "aggs": {
+                        "score": {
+                            "max": {
+                                "field": "%s.score" % SCORES_FOR_ROME_PATH
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    return {
+        "max": {
+            "field": "score_for_rome_%s" % rome_code
+        }
+    }
+
+
+def get_best_score_from_aggregation(aggregation):
+    if 'rome' in aggregation:
+        return aggregation['rome']['score']['value']
+    return aggregation['value']
+
+
+def build_headcount_filter(headcount_filter):
+    """
+    Returns the filter matching a HEADCOUNT_* setting, None if any headcount matches.
+    """
+    if headcount_filter == settings.HEADCOUNT_SMALL_ONLY:
+        headcount_range = {"lte": settings.HEADCOUNT_SMALL_ONLY_MAXIMUM}
+    elif headcount_filter == settings.HEADCOUNT_BIG_ONLY:
+        headcount_range = {"gte": settings.HEADCOUNT_BIG_ONLY_MINIMUM}
+    else:
+        return None
+    return {
+        "numeric_range": {
+            "headcount": headcount_range
+        }
+    }
+
+
+def build_flag_filter(flag_name):
+    return {
+        "term": {
+            flag_name: 1
+        }
+    }
+
+
+def build_and_filter(filters):
+    if not filters:
+        return {
+            "match_all": {}
+        }
+    return {
+        "bool": {
+            "must": filters
+        }
+    }
+
+
+# Values of the non-naf facets, along with the filter of each value.
+# A None filter is the value matching any office, e.g. HEADCOUNT_WHATEVER.
+FACET_VALUES = collections.OrderedDict([
+    ('headcount', [
+        (settings.HEADCOUNT_WHATEVER, None),
+        (settings.HEADCOUNT_SMALL_ONLY, build_headcount_filter(settings.HEADCOUNT_SMALL_ONLY)),
+        (settings.HEADCOUNT_BIG_ONLY, build_headcount_filter(settings.HEADCOUNT_BIG_ONLY)),
+    ]),
+    ('flag_alternance', [
+        (0, None),
+        (1, build_flag_filter('flag_alternance')),
+    ]),
+    ('public', [
+        (PUBLIC_ALL, None),
+        (PUBLIC_JUNIOR, build_flag_filter('flag_junior')),
+        (PUBLIC_SENIOR, build_flag_filter('flag_senior')),
+        (PUBLIC_HANDICAP, build_flag_filter('flag_handicap')),
+    ]),
+])
+
+
+def build_facet_aggregations(facet_filters):
+    """
+    Build one aggregation per facet, each one being restricted by the filters of all the other facets.
+    """
+    def other_facets_filter(facet_name):
+        return build_and_filter([
+            facet_filter for name, facet_filter in facet_filters.iteritems() if name != facet_name
+        ])
+
+    aggregations = {}
+    if 'naf' in facet_filters:
+        aggregations['facet_naf'] = {
+            "filter": other_facets_filter('naf'),
+            "aggs": {
+                "values": {
+                    "terms": {
+                        "field": "naf",
+                        "size": 0
+                    }
+                }
+            }
+        }
+    for facet_name, values in FACET_VALUES.iteritems():
+        aggregations['facet_%s' % facet_name] = {
+            "filter": other_facets_filter(facet_name),
+            "aggs": {
+                "values": {
+                    "filters": {
+                        "filters": {
+                            str(value): value_filter for value, value_filter in values if value_filter
+                        }
+                    }
+                }
+            }
+        }
+    return aggregations
+
+
+def get_facets_from_aggregations(aggregations):
+    """
+    Returns the facets counted by the aggregations built with build_facet_aggregations, e.g.:
+    {
+        'naf': {'4711D': 12, '4711F': 3},
+        'headcount': {1: 15, 2: 10, 3: 5},
+        'flag_alternance': {0: 15, 1: 4},
+        'public': {0: 15, 1: 2, 2: 0, 3: 1},
+    }
+    Values are the ones of the search filters (e.g. HEADCOUNT_* settings or PUBLIC_* constants).
+    """
+    facets = {}
+    if 'facet_naf' in aggregations:
+        facets['naf'] = {
+            bucket['key']: bucket['doc_count'] for bucket in aggregations['facet_naf']['values']['buckets']
+        }
+    for facet_name, values in FACET_VALUES.iteritems():
+        aggregation = aggregations['facet_%s' % facet_name]
+        facets[facet_name] = {}
+        for value, value_filter in values:
+            if value_filter:
+                count = aggregation['values']['buckets'][str(value)]['doc_count']
+            else:
+                count = aggregation['doc_count']
+            facets[facet_name][value] = count
+    return facets
+
+
+def build_keyset_filter(sort, rome_code, latitude, longitude, search_after):
+    """
+    Build a filter excluding every office ranked before the last hit of the previous page, or being this hit.
+
+    `search_after` holds the sort values of the last hit (see build_json_body_elastic_search), e.g.
+    `[score, boosted, shuffle_key, siret]`: the offices kept are the ones ranked after it on the first sort value,
+    or having the same first sort value and ranked after it on the second one, and so on.
+    The siret being unique, each office is either kept or excluded, so that no `from` offset is needed.
+
+    Elasticsearch 1.7 does not support `search_after`, hence this filter.
+    """
+    def build_distance_filter(distance_range):
+        distance_filter = {
+            "location": {
+                "lat": latitude,
+                "lon": longitude
+            },
+            "distance_type": "arc"
+        }
+        for operator, value in distance_range.iteritems():
+            distance_filter[operator] = "%rkm" % max(0, value)
+        return {
+            "geo_distance_range": distance_filter
+        }
+
+    def build_score_filter(score_range):
+        if rome_code is None:
+            return build_range_filter("score")(score_range)
+        return build_score_for_rome_filter(rome_code, score_range)
+
+    def build_range_filter(field):
+        return lambda value_range: {
+            "range": {
+                field: value_range
+            }
+        }
+
+    # (filter builder, descending order, tolerance) of each sort value
+    shuffle_key_field = get_shuffle_key_field()
+    if sort == "distance":
+        keys = [
+            (build_distance_filter, False, KEYSET_DISTANCE_TOLERANCE),
+            (build_range_filter(shuffle_key_field), False, 0),
+            (build_range_filter("siret"), False, 0),
+        ]
+    else:
+        keys = [
+            (build_score_filter, True, 0),
+            (build_range_filter("boosted"), True, 0),
+            (build_range_filter(shuffle_key_field), False, 0),
+            (build_range_filter("siret"), False, 0),
+        ]
+
+    after_filters = []
+    same_value_filters = []
+    for (build_filter, descending, tolerance), value in zip(keys, search_after):
+        if descending:
+            after_range = {"lt": value - tolerance if tolerance else value}
+        else:
+            after_range = {"gt": value + tolerance if tolerance else value}
+        after_filters.append(build_and_filter(same_value_filters + [build_filter(after_range)]))
+        if tolerance:
+            same_value_filters.append(build_filter({"gte": value - tolerance, "lte": value + tolerance}))
+        else:
+            same_value_filters.append(build_filter({"gte": value, "lte": value}))
+    return {
+        "bool": {
+            "should": after_filters
+        }
+    }
+
+
+def retrieve_companies_from_elastic_search(
+        json_body, distance_sort=True, index="labonneboite", routing=None):
+    """
+    Returns a SearchResult made of the companies of the page, the total count of companies,
+    the position of the last hit of the page, made of its sort values (see build_keyset_filter),
+    the facets (see get_facets_from_aggregations) if they were requested, None otherwise,
+    and whether the result is stale (see run_elastic_search).
+    """
+    res = run_elastic_search("search", index, json_body, routing)
     logger.info("Elastic Search request : %s", json_body)
     companies = []
     siret_list = []
     distances = {}
     if distance_sort:
         distance_sort_index = 0
+        keyset_length = KEYSET_LENGTHS['distance']
     else:
-        distance_sort_index = 1
+        distance_sort_index = 4
+        keyset_length = KEYSET_LENGTHS['score']
 
+    next_search_after = None
     for office in res['hits']['hits']:
         siret = office["_source"]["siret"]
         siret_list.append(siret)
         distances[siret] = int(round(office["sort"][distance_sort_index]))
+        next_search_after = office["sort"][:keyset_length]
 
     if siret_list:
         company_objects = Office.query.filter(Office.siret.in_(siret_list))
@@ -484,8 +1448,17 @@ def retrieve_companies_from_elastic_search(json_body, distance_sort=True, index=
             else:
                 logging.info("company siret %s does not have city, ignoring...", siret)
 
-    companies_count = res['hits']['total']
-    return companies, companies_count
+    aggregations = res.get('aggregations', {})
+    if 'companies_count' in aggregations:
+        companies_count = aggregations['companies_count']['doc_count']
+    else:
+        companies_count = res['hits']['total']
+
+    facets = None
+    if 'facet_headcount' in aggregations:
+        facets = get_facets_from_aggregations(aggregations)
+
+    return SearchResult(companies, companies_count, next_search_after, facets, res.get('stale', False))
 
 
 def build_location_suggestions(term):
@@ -55,6 +55,27 @@ MANUAL_ROME_NAF_FILENAME = "rome_naf_filter.csv"
 
 ES_INDEX = 'labonneboite'
 
+# Timeout (in seconds) of Elasticsearch searches.
+ES_TIMEOUT = 5
+
+# Circuit breaker around Elasticsearch searches (see search.CircuitBreaker).
+ES_CIRCUIT_BREAKER_WINDOW = 20
+ES_CIRCUIT_BREAKER_FAILURE_RATIO = 0.5
+ES_CIRCUIT_BREAKER_SLOW_CALL_DURATION = 2
+ES_CIRCUIT_BREAKER_OPEN_DURATION = 30
+
+# Number of search results kept by each process to be served when Elasticsearch is unavailable.
+ES_STALE_RESULTS_MAXIMUM = 500
+
+# Layout of the scores of offices adjusted to each ROME code in the index:
+# - False: one `score_for_rome_<code>` field per ROME code (about 550 fields in the mapping)
+# - True: nested `scores_for_rome` documents made of a `rome_code` and a `score` (2 fields in the mapping)
+# The index has to be rebuilt when it changes (create_index -d 1).
+ES_COMPACT_SCORES_FOR_ROME = False
+
+# JSON file holding the profiling report of the last build of the index in each mode (see create_index.BuildProfiler).
+INDEX_PROFILING_REPORT_FILENAME = '/srv/lbb/backups/create_index_profiling.json'
+
 LOGSTASH_HOST = "localhost"
 LOGSTASH_PORT = 5959
 
@@ -9,11 +9,10 @@ We train a machine learning algorithm on companies and employment data to create
 
 We use the scikit-learn library : more info http://scikit-learn.org/stable/documentation.html
 """
+import resource
 import sys
 
 from datetime import date, datetime
-from dateutil.relativedelta import relativedelta
-from operator import getitem
 
 import pandas as pd
 import numpy as np
@@ -22,6 +21,7 @@ from sqlalchemy.pool import NullPool
 from labonneboite.importer import settings as importer_settings
 from labonneboite.importer.models.computing import DpaeStatistics
 from labonneboite.importer import util as import_util
+from labonneboite.importer import partition
 from labonneboite.common import scoring as scoring_util
 from labonneboite.common.database import get_db_string
 import pickle
@@ -45,6 +45,8 @@ DEBUG_SIRETS = ["19240023200018", "33530956300047", "26760168000015"]
 # see http://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
 pd.options.mode.chained_assignment = None  # default='warn'
 
+CATEGORICAL_COLUMNS = ['codenaf', 'departement', 'trancheeffectif']
+
 
 class NotEnoughDataException(Exception):
     pass
@@ -155,7 +157,49 @@ def merge_and_normalize_websites(websites):
         return ""
 
 
+def normalize_websites(df_etab):
+    """
+    Merge and normalize the website1 and website2 columns into a website column.
+    Most offices share the same couple of websites (mostly empty ones): each couple is only normalized once.
+    """
+    normalized_websites = {}
+    websites = []
+    for couple in zip(df_etab['website1'].values, df_etab['website2'].values):
+        try:
+            websites.append(normalized_websites[couple])
+        except KeyError:
+            website = merge_and_normalize_websites(couple)
+            normalized_websites[couple] = website
+            websites.append(website)
+    return pd.Series(websites, index=df_etab.index, dtype=object)
+
+
+def tranche_to_effectif(tranche):
+    map_tranche_to_effectif = {
+        '00': 0,
+        '01': 1,
+        '02': 3,
+        '03': 6,
+        '11': 10,
+        '12': 20,
+        '21': 50,
+        '22': 100,
+        '31': 200,
+        '32': 250,
+        '41': 500,
+        '42': 1000,
+        '51': 2000,
+        '52': 5000,
+        '53': 10000
+    }
+    if tranche not in map_tranche_to_effectif.keys():
+        return 1
+    return map_tranche_to_effectif[tranche]
+
+
 def load_df(engine, etablissement_table, dpae_table, departement, most_recent_data_date):
+    if importer_settings.SCORE_COMPUTING_COMPACT_LOAD or importer_settings.SCORE_COMPUTING_PARTITIONS:
+        return load_df_compact(engine, etablissement_table, dpae_table, departement, most_recent_data_date)
     logger.debug("reading data with most recent data date %s..." % most_recent_data_date)
     if departement:
         logger.debug("filtering by departement (%s)...", departement)
@@ -176,9 +220,7 @@ def load_df(engine, etablissement_table, dpae_table, departement, most_recent_da
         if "website1" not in list(df_etab.columns):
             raise Exception("missing website1 column")
 
-        # tricky dataframe operation: merge two columns into one using an element wise function
-        # http://stackoverflow.com/questions/13331698/how-to-apply-a-function-to-two-columns-of-pandas-dataframe
-        df_etab["website"] = df_etab[['website1', 'website2']].apply(merge_and_normalize_websites, axis=1)
+        df_etab["website"] = normalize_websites(df_etab)
         debug_df(df_etab, "after processing website")
         del df_etab['website1']
         del df_etab['website2']
@@ -231,28 +273,6 @@ def load_df(engine, etablissement_table, dpae_table, departement, most_recent_da
     df_final = df_final.fillna(0)
 
     # Add effectif from trancheeffectif
-    def tranche_to_effectif(tranche):
-        map_tranche_to_effectif = {
-            '00': 0,
-            '01': 1,
-            '02': 3,
-            '03': 6,
-            '11': 10,
-            '12': 20,
-            '21': 50,
-            '22': 100,
-            '31': 200,
-            '32': 250,
-            '41': 500,
-            '42': 1000,
-            '51': 2000,
-            '52': 5000,
-            '53': 10000
-        }
-        if tranche not in map_tranche_to_effectif.keys():
-            return 1
-        return map_tranche_to_effectif[tranche]
-
     logger.debug("adding effectif (%s)...", departement)
     df_final['effectif'] = df_final['trancheeffectif'].map(tranche_to_effectif)
     logger.debug("effectif done (%s)!", departement)
@@ -260,6 +280,83 @@ def load_df(engine, etablissement_table, dpae_table, departement, most_recent_da
     return df_final, df3
 
 
+def load_df_compact(engine, etablissement_table, dpae_table, departement, most_recent_data_date):
+    """
+    Same as load_df, using much less memory:
+    - only the needed columns are loaded,
+    - hirings are counted by month into an int32 pivot table, instead of a float one,
+    - NAF codes, departements and trancheeffectif are categorical columns,
+    - NULL values are replaced column by column, instead of copying the whole merged dataframe.
+
+    With SCORE_COMPUTING_PARTITIONS, data is read from the partition files of the departement
+    (see partition.export_partitions) instead of MySQL.
+    """
+    logger.debug("reading compact data with most recent data date %s..." % most_recent_data_date)
+    if importer_settings.SCORE_COMPUTING_PARTITIONS:
+        df = partition.load_partition(
+            importer_settings.SCORE_COMPUTING_PARTITIONS_FOLDER, partition.DPAE, departement)
+    else:
+        # keep only contract_type = 2 (CDI) and contract_type = 1 (CDD which last at least one month)
+        df = pd.read_sql_query("""
+            select %s from %s where departement = %s
+            and (contract_type = 2 or (contract_type = 1 and contract_duration > 31))
+            and hiring_date >= %%(first_day)s and hiring_date <= %%(last_day)s
+            """ % (", ".join(partition.DPAE_COLUMNS), dpae_table, departement), engine, params={
+                'first_day': importer_settings.FIRST_DAY_DPAE,
+                'last_day': most_recent_data_date,
+            })
+    debug_df(df, "after loading from dpae table")
+    if df.empty:
+        logger.warning("no dpae data for departement %s" % departement)
+        return None
+
+    logger.debug("reading data from etablissements (%s)", departement)
+    if importer_settings.SCORE_COMPUTING_PARTITIONS:
+        df_etab = partition.load_partition(
+            importer_settings.SCORE_COMPUTING_PARTITIONS_FOLDER, partition.ETABLISSEMENTS, departement)
+    else:
+        df_etab = pd.read_sql_query("""
+            select %s from %s where departement = %s and siret != ''
+            """ % (", ".join(partition.ETABLISSEMENT_COLUMNS), etablissement_table, departement), engine)
+    debug_df(df_etab, "after loading from etablissements_prod table")
+    if df_etab.empty:
+        logger.warning("dataframe empty for departement %s" % departement)
+        return None
+    df_etab["website"] = normalize_websites(df_etab)
+    del df_etab['website1']
+    del df_etab['website2']
+    for column in df_etab.columns:
+        if column != 'siret':
+            df_etab[column] = df_etab[column].fillna(0)
+    for column in CATEGORICAL_COLUMNS:
+        df_etab[column] = df_etab[column].astype('category')
+    debug_df(df_etab, "after processing website")
+    logger.debug("loading data (%s) OK (%i etablissements)!", departement, len(df_etab))
+
+    hiring_dates = pd.DatetimeIndex(df["hiring_date"])
+    df3 = df.groupby([df["siret"], hiring_dates.year, hiring_dates.month]).size().astype(np.int32)
+    del df
+    logger.debug("pivoting table dpae (%s)...", departement)
+    df3 = df3.unstack(level=[1, 2], fill_value=0).astype(np.int32, copy=False)
+    df3.columns = [u'(%s, %s)' % (year, month) for year, month in df3.columns.values]
+    df3.index.name = 'siret'
+    df3 = df3.reset_index()
+    debug_df(df3, "after pivot")
+
+    logger.debug("merging dpae with etablissements (%s)...", departement)
+    # inner join to keep only etabs which have at least one dpae
+    df_final = pd.merge(df3, df_etab, on='siret', how="inner")
+    del df_etab
+    debug_df(df_final, "after merge")
+    logger.debug("merging done with %s offices(%s)!", len(df_final), departement)
+
+    logger.debug("adding effectif (%s)...", departement)
+    df_final['effectif'] = df_final['trancheeffectif'].astype(object).map(tranche_to_effectif)
+    logger.debug("effectif done (%s)!", departement)
+
+    return df_final, df3
+
+
 def compute_reference_date(most_recent_data_date):
     # let's decide what is the reference date
     # that is, the date from which we will make predictions (for the next 6 months)
@@ -283,16 +380,26 @@ def compute_reference_date(most_recent_data_date):
     return reference_date
 
 
-def has_hired_semester(semester):
-    def f(office):
-        return office[semester] > 0
-    return f
+def has_hired_semester(df, semester):
+    """
+    Whether each office has hired during the semester.
+    """
+    return pd.Series(df[semester].values > 0, index=df.index)
 
 
-def total_hired_semester(semester):
-    def f(office):
-        return office[semester]
-    return f
+def total_hired_semester(df, semester):
+    """
+    Hirings of each office during the semester.
+    """
+    return pd.Series(df[semester].values, index=df.index)
+
+
+def get_month_column(month_offset):
+    """
+    Column of the hirings of a month (counted in months since year 0) in the dataframe built by load_df.
+    """
+    year, month = divmod(month_offset, 12)
+    return u'(%s, %s)' % (year, month + 1)
 
 
 def create_feature_vector(df, semester_lag, debug_msg="Unnamed", get_feature_names=False):
@@ -316,27 +423,31 @@ def create_feature_vector(df, semester_lag, debug_msg="Unnamed", get_feature_nam
 
 
 def add_features(df_final, departement, reference_date, feature_semester_count, semester_lag, get_feature_names=False):
-    def hiring_count_semester(office, minus):
-        start_date = reference_date + relativedelta(months=-6 * minus - 1)
-        columns = []
-        for i in range(1, feature_semester_count):
-            current_date = start_date + relativedelta(months=+i)
-            columns.append(u'(%s, %s)' % (current_date.year, current_date.month))
-        dpae_semester = []
-        for column in columns:
-            try:
-                each_month = getitem(office, column)
-            except KeyError:
-                each_month = 0
-            dpae_semester.append(each_month)
-        return sum(dpae_semester)
-
     logger.debug("computing dpae aggregates (%s)...", departement)
 
+    # The hirings of the semester `semester-i` are those of the `feature_semester_count - 1` months starting
+    # 6 * i months before the reference date. The hirings of all these months are kept in a dense matrix,
+    # with one column per month offset from the first of them (zeros for months without any hiring).
+    reference_month = reference_date.year * 12 + reference_date.month - 1
+    window = feature_semester_count - 1
+    first_month = reference_month - 6 * feature_semester_count
+    month_columns = [get_month_column(month) for month in range(first_month, reference_month - 6 + window)]
+    month_values = [df_final[column].values for column in month_columns if column in df_final.columns]
+    dtype = np.result_type(*month_values) if month_values else np.int64
+    monthly_hirings = np.zeros((len(df_final), len(month_columns)), dtype=dtype)
+    for offset, column in enumerate(month_columns):
+        if column in df_final.columns:
+            monthly_hirings[:, offset] = df_final[column].values
+
     semester_count_columns = []
     for i in range(1, feature_semester_count + 1):
         column = 'semester-%s' % i
-        df_final[column] = df_final.apply(lambda office: hiring_count_semester(office, i), axis=1)
+        start = reference_month - 6 * i - first_month
+        # windowed sum of columns, month after month, as the former row-wise sum did
+        hirings = np.zeros(len(df_final), dtype=dtype)
+        for offset in range(start, start + window):
+            hirings = hirings + monthly_hirings[:, offset]
+        df_final[column] = hirings
         semester_count_columns.append(column)
     logger.debug("finished calculating temporal features (%s)!", departement)
 
@@ -354,8 +465,8 @@ def add_features(df_final, departement, reference_date, feature_semester_count,
 
     semester = 'semester-%i' % (semester_lag + 1)
     logger.debug("outcome: has hired in %s" % semester)
-    y = df_final.apply(has_hired_semester(semester), axis=1)
-    y_regr = df_final.apply(total_hired_semester(semester), axis=1)
+    y = has_hired_semester(df_final, semester)
+    y_regr = total_hired_semester(df_final, semester)
     if get_feature_names:
         return df_final, X, y, y_regr, X_feature_names
     else:
@@ -405,9 +516,9 @@ def train(df_final, departement, reference_date, semester_lag, feature_semester_
 
     X_test, X_test_feature_names = create_feature_vector(df_final, 0, debug_msg="X_test", get_feature_names=True)
     logger.debug("X_test_feature_names: %s" % X_test_feature_names)
-    y_test_bin = df_final.apply(has_hired_semester('semester-1'), axis=1)
+    y_test_bin = has_hired_semester(df_final, 'semester-1')
     y_test_bin_pred = clf.predict(X_test)
-    y_test_regr = df_final.apply(total_hired_semester('semester-1'), axis=1)
+    y_test_regr = total_hired_semester(df_final, 'semester-1')
     y_test_regr_pred = regr.predict(X_test)
 
     X_live, X_live_feature_names = create_feature_vector(df_final, -2 + semester_lag, debug_msg="X_live", get_feature_names=True)
@@ -486,6 +597,10 @@ def export(engine, df_final, departement):
             return str(x["departement"])
 
     df_final['departement'] = df_final.apply(departement_to_str, axis=1)
+    # categorical columns of load_df_compact are written as plain values
+    for column in df_final.columns:
+        if str(df_final[column].dtype) == 'category':
+            df_final[column] = df_final[column].astype(object)
 
     df_final.to_sql("etablissements_%s" % departement, engine, if_exists='replace', chunksize=10000)
     logger.debug("sql done (%s)!", departement)
@@ -542,6 +657,9 @@ def run(source_etablissement_table, dpae_table, departement, dpae_date, semester
         export(engine, df, departement)
     else:
         logger.warn("no result for departement %s", departement)
+    # in kilobytes on Linux
+    logger.info("peak memory used for departement %s: %iMB", departement,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
     return result
 
 
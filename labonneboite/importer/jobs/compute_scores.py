@@ -8,17 +8,18 @@ bypassing the Global Interpreter Lock limits.
 Each compute_score job is launched on a given departement.
 """
 
+import json
+import multiprocessing
+import Queue
+import resource
 import sys
+import time
 import traceback
 from collections import deque
 
-import multiprocessing
-
-from multiprocessing.dummy import Pool as ThreadPool
-from functools import partial
-
 from labonneboite.importer import settings
 from labonneboite.importer import compute_score
+from labonneboite.importer import partition
 from labonneboite.importer import util as import_util
 from labonneboite.importer.models.computing import DpaeStatistics
 from base import Job
@@ -42,23 +43,6 @@ COMPUTE_SCORES_DEBUG_MODE = False
 COMPUTE_SCORES_DEBUG_DEPARTEMENTS = ["90"]
 
 
-def abortable_worker(func, etab_table, dpae_table, departement, dpae_date, **kwargs):
-    timeout = kwargs.get('timeout', None)
-    p = ThreadPool(1)
-    res = p.apply_async(func, args=(etab_table, dpae_table, departement, dpae_date))
-    try:
-        out = res.get(timeout)  # Wait timeout seconds for func to complete.
-        logger.info("got result before timeout(%s)", departement)
-        return out
-    except multiprocessing.TimeoutError:
-        logger.warning("timeout error for departement (%s)", departement)
-        p.terminate()
-        return None
-    except:
-        logger.error("abortable_worker traceback: %s", traceback.format_exc())
-        return None
-
-
 def compute(etab, dpae, departement, dpae_date):
     try:
         result = compute_score.run(etab, dpae, departement, dpae_date)
@@ -70,53 +54,197 @@ def compute(etab, dpae, departement, dpae_date):
     return result
 
 
+def compute_in_process(result_queue, etab, dpae, departement, dpae_date):
+    """
+    Run in a process of its own: report whether scores were computed, along with the peak memory of the process.
+    """
+    result = compute(etab, dpae, departement, dpae_date)
+    # in kilobytes on Linux
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result_queue.put((departement, bool(result), peak_memory_mb))
+
+
+def load_statistics():
+    """
+    Runtime and peak memory of each departement during the previous runs, see save_statistics.
+    """
+    try:
+        with open(settings.SCORE_COMPUTING_STATISTICS_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_statistics(statistics):
+    try:
+        with open(settings.SCORE_COMPUTING_STATISTICS_FILE, 'w') as f:
+            json.dump(statistics, f, indent=2, sort_keys=True)
+    except IOError:
+        logger.warning("could not save statistics into %s", settings.SCORE_COMPUTING_STATISTICS_FILE)
+
+
+def get_departement_row_counts():
+    """
+    Number of dpae and offices of each departement, each counted by a single scan of its table.
+    """
+    counts = {}
+    con, cur = import_util.create_cursor()
+    for table in [settings.DPAE_TABLE, settings.OFFICE_TABLE]:
+        cur.execute("select departement, count(1) from %s group by departement" % table)
+        for departement, count in cur.fetchall():
+            counts[departement] = counts.get(departement, 0) + count
+    con.close()
+    return counts
+
+
+def get_departement_costs(departements, statistics, row_counts):
+    """
+    Estimated runtime of each departement, in seconds: the runtime of its previous run if any,
+    else its number of rows times the mean runtime per row of the departements which have run before.
+    When no departement has run before, costs are the numbers of rows.
+    """
+    runtimes = dict(
+        (departement, statistics[departement]['runtime'])
+        for departement in departements if departement in statistics
+    )
+    total_rows = sum(row_counts.get(departement, 0) for departement in runtimes)
+    seconds_per_row = float(sum(runtimes.values())) / total_rows if total_rows else 1
+    costs = {}
+    for departement in departements:
+        if departement in runtimes:
+            costs[departement] = runtimes[departement]
+        else:
+            costs[departement] = row_counts.get(departement, 0) * seconds_per_row
+    return costs
+
+
+def get_available_memory_mb():
+    """
+    Memory available for new processes, None if unknown (only Linux is supported).
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    return None
+
+
+def get_worker_count(statistics, compact):
+    """
+    Number of departements to compute at once: one per core, as long as the available memory
+    can hold that many of the most memory hungry departement.
+    """
+    peak_memories = [
+        departement_statistics['peak_memory_mb'] for departement_statistics in statistics.values()
+        if departement_statistics.get('compact') == compact
+    ]
+    if peak_memories:
+        memory_per_process_mb = max(peak_memories)
+    elif compact:
+        memory_per_process_mb = settings.SCORE_COMPUTING_COMPACT_MEMORY_PER_PROCESS_MB
+    else:
+        memory_per_process_mb = settings.SCORE_COMPUTING_MEMORY_PER_PROCESS_MB
+    worker_count = multiprocessing.cpu_count()
+    available_memory_mb = get_available_memory_mb()
+    if available_memory_mb is not None:
+        worker_count = min(worker_count, int(available_memory_mb / memory_per_process_mb))
+    return max(1, worker_count)
+
+
 class ScoreComputingJob(Job):
 
     def run(self):
         """
-        Tricky parallelization.
-        In some cases the jobs take a long time to run, so there's COMPUTE_SCORE_TIMEOUT for that.
-        If a job was not finished before the timeout, it will be added to a list to be processed sequentially.
+        Compute scores of all departements, each one in a process of its own.
+
+        Departements are scheduled by decreasing estimated runtime, so that the longest ones (75 first)
+        do not start last. A departement which does not finish before COMPUTE_SCORE_TIMEOUT is killed,
+        then computed again up to SCORE_COMPUTING_MAX_RETRIES times, as is a departement whose process died.
+        The runtime and peak memory of each departement are saved for the estimates of the next run.
         """
         results = []
-        pool = multiprocessing.Pool(processes=8, maxtasksperchild=1)
-        async_results = {}
         most_recent_data_date = DpaeStatistics.get_most_recent_data_date()
+        compact = settings.SCORE_COMPUTING_COMPACT_LOAD or settings.SCORE_COMPUTING_PARTITIONS
+        if settings.SCORE_COMPUTING_PARTITIONS:
+            partition.export_partitions(settings.SCORE_COMPUTING_PARTITIONS_FOLDER,
+                settings.OFFICE_TABLE, settings.DPAE_TABLE, most_recent_data_date)
 
-        if '75' in settings.DEPARTEMENTS:
-            departements = deque(settings.DEPARTEMENTS)
-            departements.remove('75')
-            departements.appendleft('75')
-        else:
-            departements = list(settings.DEPARTEMENTS)
-
+        departements = list(settings.DEPARTEMENTS)
         if COMPUTE_SCORES_DEBUG_MODE:
             if len(COMPUTE_SCORES_DEBUG_DEPARTEMENTS) >= 1:
                 departements = COMPUTE_SCORES_DEBUG_DEPARTEMENTS
 
-        for departement in departements:
-            abortable_func = partial(abortable_worker, compute, timeout=COMPUTE_SCORE_TIMEOUT)
-            async_result = pool.apply_async(
-                abortable_func,
-                args=(settings.OFFICE_TABLE, settings.DPAE_TABLE, departement, most_recent_data_date)
-            )
-            async_results[departement] = async_result
-
-        logger.info("going to close process pool...")
-        pool.close()
-        logger.info("going to join pool")
-        pool.join()
-        logger.info("all compute_score done, analyzing results...")
-
-        for departement, async_result in async_results.iteritems():
+        statistics = load_statistics()
+        if all(departement in statistics for departement in departements):
+            row_counts = {}
+        else:
+            row_counts = get_departement_row_counts()
+        costs = get_departement_costs(departements, statistics, row_counts)
+        pending = deque(sorted(departements, key=lambda departement: costs[departement], reverse=True))
+        worker_count = get_worker_count(statistics, compact)
+        logger.info("computing scores of %i departements with %i processes, in this order: %s",
+            len(pending), worker_count, ", ".join(pending))
+
+        result_queue = multiprocessing.Queue()
+        running = {}
+        attempts = {}
+        reports = {}
+        while pending or running:
+            while pending and len(running) < worker_count:
+                departement = pending.popleft()
+                attempts[departement] = attempts.get(departement, 0) + 1
+                process = multiprocessing.Process(
+                    target=compute_in_process,
+                    args=(result_queue, settings.OFFICE_TABLE, settings.DPAE_TABLE, departement, most_recent_data_date),
+                )
+                process.start()
+                running[departement] = (process, time.time())
+                logger.info("started departement %s (attempt %i)", departement, attempts[departement])
+
             try:
-                result = async_result.get()
-                if not bool(result):
-                    logger.info("departement with error : %s", departement)
-                results.append([departement, bool(result)])
-            except:
-                logger.error("traceback for unprocessed_departement: %s", traceback.format_exc())
+                departement, success, peak_memory_mb = result_queue.get(timeout=1)
+                reports[departement] = (success, peak_memory_mb)
+            except Queue.Empty:
+                pass
+
+            for departement, (process, start_time) in running.items():
+                runtime = time.time() - start_time
+                if process.is_alive() and runtime < COMPUTE_SCORE_TIMEOUT:
+                    continue
+                if process.is_alive():
+                    logger.warning("timeout error for departement (%s), killing its process", departement)
+                    process.terminate()
+                process.join()
+                # the report of a process is sent just before it exits
+                while departement not in reports and not result_queue.empty():
+                    other_departement, success, peak_memory_mb = result_queue.get()
+                    reports[other_departement] = (success, peak_memory_mb)
+                del running[departement]
+
+                if departement in reports:
+                    success, peak_memory_mb = reports.pop(departement)
+                    if not success:
+                        logger.info("departement with error : %s", departement)
+                    else:
+                        statistics[departement] = {
+                            'runtime': runtime,
+                            'peak_memory_mb': peak_memory_mb,
+                            'compact': compact,
+                        }
+                    results.append([departement, success])
+                elif attempts[departement] <= settings.SCORE_COMPUTING_MAX_RETRIES:
+                    logger.warning("departement %s did not finish (exit code %s), retrying it...",
+                        departement, process.exitcode)
+                    pending.append(departement)
+                else:
+                    logger.error("departement %s did not finish (exit code %s), giving up",
+                        departement, process.exitcode)
+                    results.append([departement, False])
 
+        save_statistics(statistics)
         logger.info("compute_scores FINISHED")
         return results
 
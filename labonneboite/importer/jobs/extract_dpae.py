@@ -7,6 +7,7 @@ It is assumed the extract function will not be called twice for the same file
 For each extraction, we record its extraction datetime and its most recent dpae date.
 """
 import re
+import tempfile
 import time
 from datetime import datetime
 import sys
@@ -14,7 +15,6 @@ from sqlalchemy.exc import OperationalError
 
 from labonneboite.importer import settings
 from labonneboite.importer import util as import_util
-from labonneboite.importer.util import parse_dpae_line, DepartementException, TooFewFieldsException
 from base import Job
 from labonneboite.importer.models.computing import DpaeStatistics, ImportTask
 
@@ -28,10 +28,17 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+DPAE_COLUMNS = (
+    'siret', 'hiring_date', 'zipcode', 'contract_type', 'departement',
+    'contract_duration', 'iiann', 'tranche_age', 'handicap_label',
+)
+
+
 class DpaeExtractJob(Job):
     file_type = "dpae"
     import_type = ImportTask.DPAE
     table_name = settings.DPAE_TABLE
+    use_load_data = settings.DPAE_LOAD_DATA
 
     def __init__(self, dpae_gz_filename):
         self.input_filename = dpae_gz_filename
@@ -57,58 +64,68 @@ class DpaeExtractJob(Job):
         else:
             raise Exception("couldn't find a date pattern in filename. filename should be dpae_XYZ_20xxxxxx.tar.gz")
 
-        count = 0
-        statements = []
-        something_new = False
-        query = "INSERT into %s(siret, hiring_date, zipcode, contract_type, departement, contract_duration, iiann, tranche_age, handicap_label) values(%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)" % settings.DPAE_TABLE
-        imported_dpae = 0
-        imported_dpae_distribution = {}
-        not_imported_dpae = 0
         initial_most_recent_data_date = DpaeStatistics.get_most_recent_data_date()
 
         logger.info("will now extract all dpae with hiring_date between %s and %s" % (
             initial_most_recent_data_date, self.most_recent_data_date
         ))
 
+        con, cur = import_util.create_cursor(local_infile=self.use_load_data)
+        count, imported_dpae, not_imported_dpae = self.extract(
+            con, cur, initial_most_recent_data_date, self.most_recent_data_date)
+        something_new = True
+
+        logger.info("processed %i dpae...", count)
+        logger.info("imported dpae: %i", imported_dpae)
+        logger.info("not imported dpae: %i", not_imported_dpae)
+        logger.info("zipcode errors: %i", self.zipcode_errors)
+        logger.info("invalid_row errors: %i", self.invalid_row_errors)
+        if self.zipcode_errors >= 100:
+            raise Exception('too many zipcode errors')
+        if self.invalid_row_errors >= 100:
+            raise Exception('too many invalid_row errors')
+        statistics = DpaeStatistics(last_import=datetime.now(), most_recent_data_date=self.most_recent_data_date)
+        statistics.save()
+        con.commit()
+        logger.info("finished importing dpae...")
+        return something_new
+
+    def extract(self, con, cur, from_date, to_date):
+        """
+        Insert into the table the dpae of the input file whose hiring date is after `from_date` and until `to_date`.
+        Return the number of lines read, of dpae imported and of dpae not imported.
+        """
+        count = 0
+        rows = []
+        imported_dpae = 0
+        imported_dpae_distribution = {}
+        not_imported_dpae = 0
+        flush_size = settings.DPAE_LOAD_DATA_ROWS if self.use_load_data else settings.DPAE_INSERT_ROWS
+
         with import_util.get_reader(self.input_filename) as myfile:
-            con, cur = import_util.create_cursor()
             header_line = myfile.readline().strip()
-            if "siret" not in header_line:
-                logger.debug(header_line)
-                raise Exception("wrong header line")
-            for line in myfile:
-                count += 1
-                if not count % 100000:
-                    logger.debug("reading line %i", count)
-                    try:
-                        try:
-                            cur.executemany(query, statements)
-                        except OperationalError:  # retry once in case of deadlock error
-                            time.sleep(10)
-                            cur.executemany(query, statements)
-                        statements = []
-                        con.commit()
-                        something_new = True
-                    except:
-                        logger.error("error in executing statement into dpae table: %s", sys.exc_info()[1])
-                        statements = []
-                        raise
-                try:
-                    siret, hiring_date, zipcode, contract_type, departement, contract_duration, iiann, tranche_age, handicap_label = parse_dpae_line(line)
-                except ValueError:
-                    self.zipcode_errors += 1
-                    continue
-                except DepartementException:
-                    self.zipcode_errors += 1
-                    continue
-                except TooFewFieldsException:
-                    logger.info("invalid_row met at row: %i", count)
-                    self.invalid_row_errors += 1
-                    continue
-
-                if hiring_date > initial_most_recent_data_date and hiring_date <= self.most_recent_data_date:
-                    statement = (siret, hiring_date, zipcode, contract_type, departement, contract_duration, iiann, tranche_age, handicap_label)
-                    statements.append(statement)
+        if "siret" not in header_line:
+            logger.debug(header_line)
+            raise Exception("wrong header line")
+
+        blocks = import_util.parse_dpae_file(
+            self.input_filename, settings.DPAE_PARSE_PROCESSES, settings.DPAE_PARSE_BLOCK_LINES)
+        for line_count, parsed_rows, zipcode_errors, invalid_rows in blocks:
+            for index in invalid_rows:
+                logger.info("invalid_row met at row: %i", count + index + 1)
+            if (count + line_count) // 100000 > count // 100000:
+                logger.debug("reading line %i", count + line_count)
+            count += line_count
+            self.zipcode_errors += zipcode_errors
+            self.invalid_row_errors += len(invalid_rows)
+
+            for row in parsed_rows:
+                hiring_date = row[1]
+                if hiring_date > from_date and hiring_date <= to_date:
+                    if len(rows) >= flush_size:
+                        self.write_rows(con, cur, rows)
+                        rows = []
+                    rows.append(row)
                     imported_dpae += 1
 
                     if hiring_date.year not in imported_dpae_distribution:
@@ -122,27 +139,43 @@ class DpaeExtractJob(Job):
                     not_imported_dpae += 1
 
         # run remaining statements
+        self.write_rows(con, cur, rows)
+        return count, imported_dpae, not_imported_dpae
+
+    def write_rows(self, con, cur, rows):
+        """
+        Write rows into the table in a single transaction, retrying once in case of deadlock error.
+        """
+        if not rows:
+            return
+        write = self.load_rows if self.use_load_data else self.insert_rows
         try:
-            cur.executemany(query, statements)
-            something_new = True
+            try:
+                write(cur, rows)
+            except OperationalError:  # retry once in case of deadlock error
+                time.sleep(10)
+                write(cur, rows)
+            con.commit()
         except:
             logger.error("error in executing statement into dpae table: %s", sys.exc_info()[1])
             raise
 
-        logger.info("processed %i dpae...", count)
-        logger.info("imported dpae: %i", imported_dpae)
-        logger.info("not imported dpae: %i", not_imported_dpae)
-        logger.info("zipcode errors: %i", self.zipcode_errors)
-        logger.info("invalid_row errors: %i", self.invalid_row_errors)
-        if self.zipcode_errors >= 100:
-            raise Exception('too many zipcode errors')
-        if self.invalid_row_errors >= 100:
-            raise Exception('too many invalid_row errors')
-        statistics = DpaeStatistics(last_import=datetime.now(), most_recent_data_date=self.most_recent_data_date)
-        statistics.save()
-        con.commit()
-        logger.info("finished importing dpae...")
-        return something_new
+    def insert_rows(self, cur, rows):
+        query = "INSERT into %s(%s) values(%s)" % (
+            self.table_name, ", ".join(DPAE_COLUMNS), ", ".join(["%s"] * len(DPAE_COLUMNS)))
+        cur.executemany(query, rows)
+
+    def load_rows(self, cur, rows):
+        """
+        Write rows into a temporary tab separated file, loaded with a single LOAD DATA statement.
+        """
+        with tempfile.NamedTemporaryFile(suffix='.tsv') as f:
+            for row in rows:
+                f.write("\t".join(import_util.get_load_data_field(value) for value in row) + "\n")
+            f.flush()
+            query = "LOAD DATA LOCAL INFILE %%s INTO TABLE %s CHARACTER SET utf8 (%s)" % (
+                self.table_name, ", ".join(DPAE_COLUMNS))
+            cur.execute(query, (f.name,))
 
 
 if __name__ == "__main__":
@@ -3,7 +3,13 @@ Extracts offices("etablissements").
 
 To be done.
 """
+import cPickle
+import hashlib
+import heapq
 import sys
+import tempfile
+
+from MySQLdb.cursors import SSCursor
 
 from labonneboite.importer import settings
 from labonneboite.importer import util as import_util
@@ -21,6 +27,10 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+MAX_COUNT_EXECUTE = 500
+MAX_COUNT_DELETE = 1000
+
+
 class DepartementException(Exception):
     pass
 
@@ -46,41 +56,154 @@ def extract_departement_from_zipcode(zipcode, siret):
     return departement
 
 
+def get_departement_counts():
+    """
+    Return the number of offices of each departement, computed by a single scan of the table.
+    """
+    con, cur = import_util.create_cursor()
+    cur.execute("select departement, count(1) from %s group by departement" % settings.OFFICE_TABLE)
+    counts = dict(cur.fetchall())
+    con.close()
+    return counts
+
+
 def check_departements(departements):
+    counts = get_departement_counts()
     for dep in departements:
-        con, cur = import_util.create_cursor()
-        cur.execute("select count(1) from %s where departement='%s'" % (settings.OFFICE_TABLE, dep))
-        con.commit()
-        count = cur.fetchone()[0]
+        count = counts.get(dep, 0)
         if count < 1000:
             logger.error("only %s results for departement %s", count, dep)
 
 
+def delete_offices(con, cur, sirets):
+    """
+    Delete offices by batches of MAX_COUNT_DELETE sirets, each batch being committed on its own
+    so that the table is never locked for long.
+    """
+    sirets = list(sirets)
+    for start in range(0, len(sirets), MAX_COUNT_DELETE):
+        batch = sirets[start:start + MAX_COUNT_DELETE]
+        query = "DELETE FROM %s where siret IN (%s)" % (settings.OFFICE_TABLE, ", ".join(["%s"] * len(batch)))
+        try:
+            cur.execute(query, batch)
+            con.commit()
+        except:
+            logger.warning("deletable_sirets=%s" % batch)
+            raise
+        logger.info("%i/%i offices deleted...", start + len(batch), len(sirets))
+
+
+def get_create_query():
+    return """INSERT into %s(siret, raisonsociale, enseigne, codenaf, numerorue,
+            libellerue, codecommune, codepostal, email, tel, departement, trancheeffectif,
+            website1, website2, content_hash)
+        values(%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)""" % settings.OFFICE_TABLE
+
+
+def get_update_query():
+    return """UPDATE %s SET
+            raisonsociale=%%s,
+            enseigne=%%s,
+            codenaf=%%s,
+            numerorue=%%s,
+            libellerue=%%s,
+            codecommune=%%s,
+            codepostal=%%s,
+            email=%%s,
+            tel=%%s,
+            departement=%%s,
+            trancheeffectif=%%s,
+            website1=%%s,
+            website2=%%s,
+            content_hash=%%s
+        where siret=%%s""" % settings.OFFICE_TABLE
+
+
+def get_update_fields(create_fields):
+    """
+    The fields of the update query are the fields of the create query, siret being moved last.
+    """
+    return tuple(create_fields[1:]) + (create_fields[0],)
+
+
+def get_content_hash(fields):
+    """
+    Hash of the content of an office (all the fields of the create query but siret),
+    stored along with the office so that unchanged offices are not updated.
+    """
+    content = u"\x1f".join(field.decode('utf-8') if isinstance(field, str) else field for field in fields)
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+
+def write_sorted_run(rows):
+    """
+    Sort rows and write them into a temporary file, returned ready to be read by read_sorted_run.
+    """
+    rows.sort()
+    run = tempfile.TemporaryFile()
+    for row in rows:
+        cPickle.dump(row, run, cPickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def read_sorted_run(run):
+    while True:
+        try:
+            yield cPickle.load(run)
+        except EOFError:
+            return
+
+
+def merge_join(sorted_offices, sorted_hashes):
+    """
+    Join offices of the file and content hashes of the offices of the database, both sorted by siret.
+    Yield for each siret found in either of them: the siret, the fields of the office in the file (None if not
+    in the file) and whether the siret is in the database along with its content hash.
+    """
+    office = next(sorted_offices, None)
+    existing = next(sorted_hashes, None)
+    while office is not None or existing is not None:
+        if existing is None or (office is not None and office[0] < existing[0]):
+            yield office[0], office[1], False, None
+            office = next(sorted_offices, None)
+        elif office is None or existing[0] < office[0]:
+            yield existing[0], None, True, existing[1]
+            existing = next(sorted_hashes, None)
+        else:
+            yield office[0], office[1], True, existing[1]
+            office = next(sorted_offices, None)
+            existing = next(sorted_hashes, None)
+
+
 class EtablissementExtractJob(Job):
     file_type = "etablissements"
     import_type = ImportTask.ETABLISSEMENT
     table_name = settings.OFFICE_TABLE
+    streaming = settings.ETABLISSEMENT_STREAMING
+    sort_buffer_rows = settings.ETABLISSEMENT_SORT_BUFFER_ROWS
 
     def __init__(self, etablissement_filename):
         self.input_filename = etablissement_filename
+        self.existing_hashes = {}
+        self.updated_count = 0
+        self.unchanged_count = 0
 
     def after_check(self):
-        con, cur = import_util.create_cursor()
+        counts = get_departement_counts()
         for departement in settings.DEPARTEMENTS:
-            query = "select count(1) from %s where departement='%s'" % (
-                settings.OFFICE_TABLE,
-                departement)
-            cur.execute(query)
-            result = cur.fetchone()
-            count = result[0]
+            count = counts.get(departement, 0)
             logger.info("number of companies in departement %s : %i", departement, count)
             if count <= 1000:
                 raise "too few companies"
 
     def run_task(self):
+        if self.streaming:
+            return self.run_task_streaming()
         self.csv_offices = self.get_offices_from_file()
         self.csv_sirets = self.csv_offices.keys()
-        self.existing_sirets = self.get_sirets_from_database()
+        self.existing_hashes = self.get_content_hashes_from_database()
+        self.existing_sirets = self.existing_hashes.keys()
         csv_set = set(self.csv_sirets)
         existing_set = set(self.existing_sirets)
         # 1 - create offices which did not exist before
@@ -89,11 +212,60 @@ class EtablissementExtractJob(Job):
         # 2 - delete offices which no longer exist
         self.deletable_sirets = existing_set - csv_set
         self.delete_deletable_offices()
-        # 3 - update existing offices
+        # 3 - update existing offices whose content changed
         self.updatable_sirets = existing_set - self.deletable_sirets
         self.update_updatable_offices()
         return num_created
 
+    def run_task_streaming(self):
+        """
+        Same as run_task, without holding the offices of the file nor the sirets of the database in memory:
+        offices of the file sorted by siret (see sort_offices_from_file) are merge-joined with the content hashes
+        of the offices of the database, streamed in the same order, into batches of offices to create,
+        update (only when their content changed) or delete.
+        """
+        con, cur = import_util.create_cursor()
+        batches = {'create': [], 'update': [], 'delete': []}
+        counts = {'create': 0, 'update': 0, 'delete': 0}
+
+        def flush(operation):
+            statements = batches[operation]
+            if not statements:
+                return
+            if operation == 'create':
+                cur.executemany(get_create_query(), statements)
+            elif operation == 'update':
+                cur.executemany(get_update_query(), statements)
+            else:
+                delete_offices(con, cur, [siret for siret, in statements])
+            con.commit()
+            counts[operation] += len(statements)
+            batches[operation] = []
+
+        sorted_offices = self.sort_offices_from_file(self.sort_buffer_rows)
+        sorted_hashes = self.iter_content_hashes_from_database()
+        for siret, create_fields, exists, content_hash in merge_join(sorted_offices, sorted_hashes):
+            if create_fields is None:
+                operation, statement = 'delete', (siret,)
+            elif exists and content_hash == create_fields[-1]:
+                self.unchanged_count += 1
+                continue
+            elif exists:
+                operation, statement = 'update', get_update_fields(create_fields)
+            else:
+                operation, statement = 'create', create_fields
+            batches[operation].append(statement)
+            if len(batches[operation]) >= (MAX_COUNT_DELETE if operation == 'delete' else MAX_COUNT_EXECUTE):
+                flush(operation)
+        for operation in batches.keys():
+            flush(operation)
+
+        logger.info("%i new etablissements created.", counts['create'])
+        logger.info("%i old offices deleted.", counts['delete'])
+        self.updated_count = counts['update']
+        logger.info("%i etablissements updated, %i unchanged.", self.updated_count, self.unchanged_count)
+        return counts['create']
+
     def get_sirets_from_database(self):
         query = "select siret from %s where siret != ''" % settings.OFFICE_TABLE
         logger.info("get etablissements from database")
@@ -102,55 +274,70 @@ class EtablissementExtractJob(Job):
         rows = cur.fetchall()
         return [row[0] for row in rows]
 
+    def get_content_hashes_from_database(self):
+        """
+        Return the content hash of each office of the database, by siret.
+        """
+        query = "select siret, content_hash from %s where siret != ''" % settings.OFFICE_TABLE
+        logger.info("get etablissements from database")
+        con, cur = import_util.create_cursor()
+        cur.execute(query)
+        return dict(cur.fetchall())
+
+    def iter_content_hashes_from_database(self):
+        """
+        Yield the siret and the content hash of each office of the database in ascending siret order,
+        streamed by a server-side cursor.
+        """
+        query = "select siret, content_hash from %s where siret != '' order by siret" % settings.OFFICE_TABLE
+        logger.info("stream etablissements from database")
+        con, _ = import_util.create_cursor()
+        cur = con.cursor(SSCursor)
+        try:
+            cur.execute(query)
+            previous_siret = None
+            for siret, content_hash in cur:
+                # the merge join relies on MySQL and Python sorting sirets the same way
+                if previous_siret is not None and siret < previous_siret:
+                    raise Exception("sirets of the database are not sorted: %s after %s" % (siret, previous_siret))
+                previous_siret = siret
+                yield siret, content_hash
+        finally:
+            cur.close()
+            con.close()
+
     def update_updatable_offices(self):
         con, cur = import_util.create_cursor()
-        query = """UPDATE %s SET
-            raisonsociale=%%s,
-            enseigne=%%s,
-            codenaf=%%s,
-            numerorue=%%s,
-            libellerue=%%s,
-            codecommune=%%s,
-            codepostal=%%s,
-            email=%%s,
-            tel=%%s,
-            departement=%%s,
-            trancheeffectif=%%s,
-            website1=%%s,
-            website2=%%s
-        where siret=%%s""" % settings.OFFICE_TABLE
+        query = get_update_query()
 
-        count = 1
         logger.info("update updatable etablissements in table %s" % settings.OFFICE_TABLE)
         statements = []
-        MAX_COUNT_EXECUTE = 500
         for siret in self.updatable_sirets:
-            statement = self.csv_offices[siret]["update_fields"]
-            statements.append(statement)
-            count += 1
-            if not count % MAX_COUNT_EXECUTE:
+            office = self.csv_offices[siret]
+            if self.existing_hashes.get(siret) == office["content_hash"]:
+                self.unchanged_count += 1
+                continue
+            statements.append(office["update_fields"])
+            self.updated_count += 1
+            if len(statements) >= MAX_COUNT_EXECUTE:
                 cur.executemany(query, statements)
                 con.commit()
                 statements = []
         if statements:
             cur.executemany(query, statements)
             con.commit()
-        logger.info("%i etablissements updated.", count)
+        logger.info("%i etablissements updated, %i unchanged.", self.updated_count, self.unchanged_count)
 
     def create_creatable_offices(self):
         """
         create new etablissements (that are not yet in our etablissement table)
         """
         con, cur = import_util.create_cursor()
-        query = """INSERT into %s(siret, raisonsociale, enseigne, codenaf, numerorue,
-            libellerue, codecommune, codepostal, email, tel, departement, trancheeffectif,
-            website1, website2)
-        values(%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)""" % settings.OFFICE_TABLE
+        query = get_create_query()
 
         count = 1
         logger.info("create new etablissements in table %s" % settings.OFFICE_TABLE)
         statements = []
-        MAX_COUNT_EXECUTE = 500
         for siret in self.creatable_sirets:
             statement = self.csv_offices[siret]["create_fields"]
             statements.append(statement)
@@ -167,18 +354,54 @@ class EtablissementExtractJob(Job):
     def delete_deletable_offices(self):
         con, cur = import_util.create_cursor()
         if self.deletable_sirets:
-            stringified_siret_list = ",".join(self.deletable_sirets)
             logger.info("going to delete %i offices...", len(self.deletable_sirets))
-            query = """DELETE FROM %s where siret IN (%s)""" % (settings.OFFICE_TABLE, stringified_siret_list)
-            try:
-                cur.execute(query)
-                con.commit()
-            except:
-                logger.warning("deletable_sirets=%s" % self.deletable_sirets)
-                raise
+            delete_offices(con, cur, self.deletable_sirets)
             logger.info("%i old offices deleted.", len(self.deletable_sirets))
 
     def get_offices_from_file(self):
+        etablissements = {}
+        for siret, create_fields in self.iter_offices_from_file():
+            etablissements[siret] = {
+                "create_fields": create_fields,
+                "update_fields": get_update_fields(create_fields),
+                "content_hash": create_fields[-1],
+            }
+        return etablissements
+
+    def sort_offices_from_file(self, buffer_rows):
+        """
+        Yield the siret and the fields of the create query of each office of the file, in ascending siret order.
+
+        Offices are sorted by an external merge sort: runs of at most `buffer_rows` offices are sorted
+        in memory and written to temporary files, which are then merged.
+        As in get_offices_from_file, the last office of the file wins when a siret is found several times.
+        """
+        runs = []
+        rows = []
+        try:
+            for line_number, (siret, create_fields) in enumerate(self.iter_offices_from_file()):
+                rows.append((siret, line_number, create_fields))
+                if len(rows) >= buffer_rows:
+                    runs.append(write_sorted_run(rows))
+                    rows = []
+            rows.sort()
+            merged_rows = heapq.merge(rows, *[read_sorted_run(run) for run in runs])
+            previous_office = None
+            for siret, _, create_fields in merged_rows:
+                if previous_office is not None and siret != previous_office[0]:
+                    yield previous_office
+                previous_office = (siret, create_fields)
+            if previous_office is not None:
+                yield previous_office
+        finally:
+            for run in runs:
+                run.close()
+
+    def iter_offices_from_file(self):
+        """
+        Yield the siret and the fields of the create query of each office of the file.
+        Checks on the whole file are run once the file has been read.
+        """
         logger.info("extracting %s...", self.input_filename)
         departements = settings.DEPARTEMENTS
         count = 0
@@ -186,9 +409,7 @@ class EtablissementExtractJob(Job):
         departement_errors = 0
         unprocessable_departement_errors = 0
         format_errors = 0
-        con, cur = import_util.create_cursor()
         departement_counter_dic = {}
-        etablissements = {}
 
         with import_util.get_reader(self.input_filename) as myfile:
             header_line = myfile.readline().strip()
@@ -228,19 +449,15 @@ class EtablissementExtractJob(Job):
 
                             if len(codepostal) == 4:
                                 codepostal = "0%s" % codepostal
-                            etab_create_fields = siret, raisonsociale, enseigne, codenaf, numerorue, libellerue, \
+                            etab_content_fields = raisonsociale, enseigne, codenaf, numerorue, libellerue, \
                                 codecommune, codepostal, email, tel, departement, trancheeffectif_etablissement, \
                                 website1, website2
-                            etab_update_fields = raisonsociale, enseigne, codenaf, numerorue, libellerue, \
-                                codecommune, codepostal, email, tel, departement, trancheeffectif_etablissement, \
-                                website1, website2, siret
+                            etab_create_fields = (siret,) + etab_content_fields + (
+                                get_content_hash(etab_content_fields),)
                             if codepostal.startswith(departement):
                                 departement_counter_dic.setdefault(departement, 0)
                                 departement_counter_dic[departement] += 1
-                                etablissements[siret] = {
-                                    "create_fields": etab_create_fields,
-                                    "update_fields": etab_update_fields,
-                                }
+                                yield siret, etab_create_fields
                             else:
                                 logger.info("zipcode and departement dont match code commune: %s, code postal: %s, departement: %s", codecommune, codepostal, departement)
                         else:
@@ -278,8 +495,6 @@ class EtablissementExtractJob(Job):
                     logger.exception("only %s etablissements in departement %s" % (count, departement))
                     raise "not enough etablissements in at least one departement"
 
-        return etablissements
-
 
 if __name__ == "__main__":
     etablissement_filename = sys.argv[1]
@@ -1,3 +1,4 @@
+import collections
 import logging
 import os
 import tarfile
@@ -8,6 +9,7 @@ from datetime import datetime
 from labonneboite.importer import util as import_util
 from labonneboite.importer import settings
 from labonneboite.importer.models.computing import ImportTask
+from labonneboite.scripts import index_artifact
 from base import Job
 
 logger = logging.getLogger('main')
@@ -17,6 +19,27 @@ handler = logging.StreamHandler()
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+# Columns of the exported offices, under the names of the attributes of an `Office`,
+# which the documents of the index artifact are built from (see create_index.get_office_as_es_doc).
+EXPORTED_OFFICE_COLUMNS = collections.OrderedDict([
+    ('siret', 'siret'),
+    ('naf', 'codenaf'),
+    ('score', 'score'),
+    ('headcount', 'trancheeffectif'),
+    ('office_name', 'enseigne'),
+    ('email', 'email'),
+    ('tel', 'tel'),
+    ('website', 'website'),
+    ('flag_alternance', 'flag_alternance'),
+    ('flag_junior', 'flag_junior'),
+    ('flag_senior', 'flag_senior'),
+    ('flag_handicap', 'flag_handicap'),
+    ('zipcode', 'codepostal'),
+    ('x', 'coordinates_x'),
+    ('y', 'coordinates_y'),
+])
+ExportedOffice = collections.namedtuple('ExportedOffice', EXPORTED_OFFICE_COLUMNS.keys())
+
 
 def populate_flags():
     logger.info("going to populate office boolean flags...")
@@ -128,6 +151,22 @@ def prepare_flag_handicap():
     run_sql_script(sql_script)
     logger.info("completed preparing flag_handicap.")
 
+def get_exported_offices():
+    """
+    Yield the offices of the export table as `ExportedOffice` instances.
+    """
+    con, cur = import_util.create_cursor()
+    query = "select %s from %s" % (
+        ", ".join(EXPORTED_OFFICE_COLUMNS.values()), settings.EXPORT_ETABLISSEMENT_TABLE)
+    cur.execute(query)
+    for row in cur.fetchall():
+        office = ExportedOffice(*row)
+        # flags are returned as integers, and as booleans by the `Office` model: the row hash must be the same
+        yield office._replace(**{flag: bool(getattr(office, flag)) for flag in import_util.OFFICE_FLAGS})
+    cur.close()
+    con.close()
+
+
 def dump():
     timestamp = settings.NOW.strftime('%Y_%m_%d_%H%M')
 
@@ -138,10 +177,16 @@ def dump():
         "export_etablissement", timestamp, copy_to_remote_server,
         rename_table=True)
 
+    # Ready-to-index documents of the exported offices, so that web servers do not have to build them
+    # (see scripts/index_artifact.py).
+    logger.info("exporting index artifact")
+    artifact_path = index_artifact.export_artifact(settings.BACKUP_OUTPUT_FOLDER, offices=get_exported_offices())
+
     tar_filename = os.path.join(settings.BACKUP_FOLDER, "%s.tar.bz2" % timestamp)
     with tarfile.open(tar_filename, "w:bz2") as tar:
         logger.info("creating tar file %s..." % tar_filename)
         tar.add(etab_result, arcname=os.path.basename(etab_result))
+        tar.add(artifact_path, arcname=os.path.basename(artifact_path))
         tar.close()
     return tar_filename
 
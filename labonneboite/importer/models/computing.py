@@ -46,6 +46,8 @@ class Office(CRUDMixin, Base):
 
     departement = Column(String(8))
     headcount = Column('trancheeffectif', String(2))
+    # see jobs/extract_etablissements.get_content_hash
+    content_hash = Column(String(32))
 
 
 class Geolocation(CRUDMixin, Base):
@@ -0,0 +1,137 @@
+# coding: utf-8
+"""
+Partitions of the data needed to compute scores, by departement, as files on local disk.
+
+The dpae and etablissements tables are each scanned once, and their rows are written into compressed
+`.npz` files by departement: `dpae_<departement>_<chunk>.npz` and `etablissements_<departement>_<chunk>.npz`.
+compute_score then reads the files of its departement instead of querying MySQL,
+so that score computations running in parallel do not compete for the database.
+
+Rows are buffered in memory by departement, and written by chunks whenever the buffers hold too many rows.
+"""
+import glob
+import os
+
+from MySQLdb.cursors import SSCursor
+import numpy as np
+import pandas as pd
+
+from labonneboite.importer import settings as importer_settings
+from labonneboite.importer import util as import_util
+
+import logging
+logger = logging.getLogger('main')
+
+DPAE = 'dpae'
+ETABLISSEMENTS = 'etablissements'
+
+# Only CDI (contract_type = 2) and CDD which last at least one month (contract_type = 1) are used to compute scores.
+DPAE_COLUMNS = ['siret', 'hiring_date']
+DPAE_DTYPES = {
+    'siret': np.unicode_,
+    'hiring_date': 'datetime64[s]',
+}
+
+# Columns of the etablissements read by compute_score.load_df_compact. Values can be NULL, thus stored as objects.
+ETABLISSEMENT_COLUMNS = [
+    'siret', 'raisonsociale', 'enseigne', 'codenaf', 'trancheeffectif', 'numerorue', 'libellerue',
+    'codepostal', 'tel', 'email', 'website1', 'website2', 'codecommune', 'departement',
+]
+
+
+class PartitionWriter(object):
+    """
+    Buffers rows by departement, and writes them into a new chunk file of each departement
+    once `buffer_rows` rows are buffered.
+    """
+
+    def __init__(self, folder, name, columns, dtypes, buffer_rows):
+        self.folder = folder
+        self.name = name
+        self.columns = columns
+        self.dtypes = dtypes
+        self.buffer_rows = buffer_rows
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.chunk = 0
+        self.row_count = 0
+
+    def add(self, departement, row):
+        self.buffers.setdefault(departement, []).append(row)
+        self.buffered_rows += 1
+        self.row_count += 1
+        if self.buffered_rows >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        for departement, rows in self.buffers.iteritems():
+            arrays = {}
+            for index, column in enumerate(self.columns):
+                arrays[column] = np.array([row[index] for row in rows], dtype=self.dtypes.get(column, object))
+            filename = get_partition_filename(self.folder, self.name, departement, self.chunk)
+            np.savez_compressed(filename, **arrays)
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.chunk += 1
+
+
+def get_partition_filename(folder, name, departement, chunk):
+    return os.path.join(folder, "%s_%s_%04d.npz" % (name, departement, chunk))
+
+
+def export_table(folder, name, query, params, columns, dtypes):
+    """
+    Stream the rows of the query, whose first column is the departement, into partition files.
+    Return the number of rows exported.
+    """
+    con, _ = import_util.create_cursor()
+    cur = con.cursor(SSCursor)
+    writer = PartitionWriter(folder, name, columns, dtypes, importer_settings.SCORE_COMPUTING_PARTITION_BUFFER_ROWS)
+    try:
+        cur.execute(query, params)
+        for row in cur:
+            writer.add(row[0], row[1:])
+        writer.flush()
+    finally:
+        cur.close()
+        con.close()
+    logger.info("exported %i rows of %s into partitions", writer.row_count, name)
+    return writer.row_count
+
+
+def export_partitions(folder, etablissement_table, dpae_table, most_recent_data_date):
+    """
+    Replace the partition files of `folder` by new ones, built with a single scan of each table.
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for filename in glob.glob(os.path.join(folder, "*.npz")):
+        os.remove(filename)
+
+    logger.info("exporting partitions of %s and %s into %s...", dpae_table, etablissement_table, folder)
+    export_table(folder, DPAE, """
+        select departement, %s from %s
+        where siret is not null
+        and (contract_type = 2 or (contract_type = 1 and contract_duration > 31))
+        and hiring_date >= %%s and hiring_date <= %%s
+        """ % (", ".join(DPAE_COLUMNS), dpae_table),
+        (importer_settings.FIRST_DAY_DPAE, most_recent_data_date), DPAE_COLUMNS, DPAE_DTYPES)
+    export_table(folder, ETABLISSEMENTS, """
+        select departement, %s from %s where siret != ''
+        """ % (", ".join(ETABLISSEMENT_COLUMNS), etablissement_table),
+        None, ETABLISSEMENT_COLUMNS, {})
+    logger.info("partitions exported!")
+
+
+def load_partition(folder, name, departement):
+    """
+    Return the rows of a departement as a dataframe, empty if there is none.
+    """
+    columns = DPAE_COLUMNS if name == DPAE else ETABLISSEMENT_COLUMNS
+    frames = []
+    for filename in sorted(glob.glob(os.path.join(folder, "%s_%s_*.npz" % (name, departement)))):
+        with np.load(filename, allow_pickle=True) as arrays:
+            frames.append(pd.DataFrame({column: arrays[column] for column in columns}, columns=columns))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
@@ -1,3 +1,4 @@
+import multiprocessing
 from datetime import datetime
 
 SCORE_COMPUTING_MAX_DIFF_MEAN = 30
@@ -26,6 +27,35 @@ MOST_RECENT_DPAE_DATE = datetime(2012, 1, 1)
 
 DPAE_ERROR_RATE_MAX = 0.1
 
+# Extraction of DPAE (see jobs/extract_dpae.py): rows are either inserted with batches of INSERT statements,
+# or written into temporary files loaded with LOAD DATA LOCAL INFILE (which requires `local_infile` on the server).
+DPAE_LOAD_DATA = False
+DPAE_INSERT_ROWS = 100000
+DPAE_LOAD_DATA_ROWS = 1000000
+# Lines of DPAE files are parsed by blocks in a pool of processes (sequentially in the current process if 1).
+DPAE_PARSE_PROCESSES = multiprocessing.cpu_count()
+DPAE_PARSE_BLOCK_LINES = 20000
+
+# Extraction of etablissements (see jobs/extract_etablissements.py): in streaming mode, offices of the file are
+# sorted on disk and merged with the offices of the database, holding at most this number of offices in memory.
+ETABLISSEMENT_STREAMING = False
+ETABLISSEMENT_SORT_BUFFER_ROWS = 500000
+
+# Loading of data by compute_score.load_df: the compact mode only loads the needed columns, with compact dtypes.
+# It uses much less memory, so that more departements can be computed in parallel (see jobs/compute_scores.py).
+SCORE_COMPUTING_COMPACT_LOAD = False
+# Memory used by the computation of a departement, until the peak memory of previous runs is known.
+SCORE_COMPUTING_MEMORY_PER_PROCESS_MB = 8000
+SCORE_COMPUTING_COMPACT_MEMORY_PER_PROCESS_MB = 4000
+# Runtime and peak memory of each departement, saved by each run of jobs/compute_scores.py for the next one.
+SCORE_COMPUTING_STATISTICS_FILE = '/srv/lbb/backups/compute_scores_statistics.json'
+SCORE_COMPUTING_MAX_RETRIES = 1
+# With partitions, the dpae and etablissements tables are scanned once and split by departement into files
+# of this folder (see partition.py), then read by the compact mode of compute_score.load_df instead of MySQL.
+SCORE_COMPUTING_PARTITIONS = False
+SCORE_COMPUTING_PARTITIONS_FOLDER = '/srv/lbb/partitions'
+SCORE_COMPUTING_PARTITION_BUFFER_ROWS = 2000000
+
 MYSQL_NO_PASSWORD = False
 
 
@@ -1,8 +1,17 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import random
+import shutil
+import tempfile
 
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from labonneboite.common.database import get_db_string
 from labonneboite.common.models import Office
 from labonneboite.importer import compute_score
+from labonneboite.importer import partition
 from labonneboite.importer import settings
 from labonneboite.importer.models.computing import Dpae
 from labonneboite.importer.tests.test_base import DatabaseTest
@@ -29,6 +38,22 @@ def make_dpae():
         dpae.save()
 
 
+def hiring_count_semester(office, reference_date, minus, feature_semester_count):
+    """
+    Former row-wise computation of the hirings of a semester, see compute_score.add_features.
+    """
+    start_date = reference_date + relativedelta(months=-6 * minus - 1)
+    dpae_semester = []
+    for i in range(1, feature_semester_count):
+        current_date = start_date + relativedelta(months=+i)
+        try:
+            each_month = office[u'(%s, %s)' % (current_date.year, current_date.month)]
+        except KeyError:
+            each_month = 0
+        dpae_semester.append(each_month)
+    return sum(dpae_semester)
+
+
 class TestComputeScore(DatabaseTest):
 
     def test_happy_path(self):
@@ -40,6 +65,63 @@ class TestComputeScore(DatabaseTest):
         departement = "57"
         compute_score.run(settings.OFFICE_TABLE, settings.DPAE_TABLE, departement, dpae_date)
 
+    def test_happy_path_with_compact_load(self):
+        settings.SCORE_COEFFICIENT_OF_VARIATION_MAX = 1.0
+        settings.HIGH_SCORE_COMPANIES_COUNT_MIN = 0
+        make_office()
+        make_dpae()
+        dpae_date = datetime.now()
+        engine = sqlalchemy.create_engine(get_db_string())
+        settings.SCORE_COMPUTING_COMPACT_LOAD = True
+        try:
+            df, _ = compute_score.load_df(engine,
+                settings.OFFICE_TABLE, settings.DPAE_TABLE, "57", dpae_date)
+            compute_score.run(settings.OFFICE_TABLE, settings.DPAE_TABLE, "57", dpae_date)
+        finally:
+            settings.SCORE_COMPUTING_COMPACT_LOAD = False
+        expected_df, _ = compute_score.load_df(engine,
+            settings.OFFICE_TABLE, settings.DPAE_TABLE, "57", dpae_date)
+        self.assertEqual(sorted(df.siret), sorted(expected_df.siret))
+        self.assertEqual(str(df.codenaf.dtype), 'category')
+        month_columns = [column for column in expected_df.columns if column.startswith('(2')]
+        df = df.set_index('siret').sort_index()
+        expected_df = expected_df.set_index('siret').sort_index()
+        for column in month_columns:
+            self.assertTrue(np.array_equal(df[column].values, expected_df[column].values))
+        self.assertTrue(np.array_equal(df.effectif.values, expected_df.effectif.values))
+
+    def test_load_df_from_partitions(self):
+        make_office()
+        make_dpae()
+        dpae_date = datetime.now()
+        engine = sqlalchemy.create_engine(get_db_string())
+        folder = tempfile.mkdtemp()
+        settings.SCORE_COMPUTING_COMPACT_LOAD = True
+        try:
+            expected_df, _ = compute_score.load_df(engine, settings.OFFICE_TABLE, settings.DPAE_TABLE, "57", dpae_date)
+            partition.export_partitions(folder, settings.OFFICE_TABLE, settings.DPAE_TABLE, dpae_date)
+            settings.SCORE_COMPUTING_PARTITIONS = True
+            settings.SCORE_COMPUTING_PARTITIONS_FOLDER = folder
+            df, _ = compute_score.load_df(engine, settings.OFFICE_TABLE, settings.DPAE_TABLE, "57", dpae_date)
+            self.assertIsNone(compute_score.load_df(engine, settings.OFFICE_TABLE, settings.DPAE_TABLE, "58", dpae_date))
+        finally:
+            settings.SCORE_COMPUTING_COMPACT_LOAD = False
+            settings.SCORE_COMPUTING_PARTITIONS = False
+            shutil.rmtree(folder)
+        df = df.set_index('siret').sort_index()
+        expected_df = expected_df.set_index('siret').sort_index()
+        self.assertEqual(list(df.columns), list(expected_df.columns))
+        for column in expected_df.columns:
+            self.assertEqual(list(df[column]), list(expected_df[column]))
+
+    def test_normalize_websites(self):
+        df = pd.DataFrame({
+            'website1': ['abc.fr', None, 'abc@def.fr', 'abc.fr'],
+            'website2': [None, 'def.fr', 'def.fr', None],
+        })
+        self.assertEqual(list(compute_score.normalize_websites(df)),
+            ['http://abc.fr', 'http://def.fr', 'http://def.fr', 'http://abc.fr'])
+
     def test_normalize_url(self):
         self.assertEqual(compute_score.normalize_website_url(None), None)
         self.assertEqual(compute_score.normalize_website_url(''), None)
@@ -49,3 +131,28 @@ class TestComputeScore(DatabaseTest):
         self.assertEqual(compute_score.normalize_website_url('http://abc.fr'), 'http://abc.fr')
         self.assertEqual(compute_score.normalize_website_url('https://abc.fr'), 'https://abc.fr')
         self.assertEqual(compute_score.normalize_website_url('abc@def.fr'), None)
+
+    def test_add_features(self):
+        # months of hirings from 2013 to 2016, some months missing
+        random.seed(99)
+        columns = [u'(%s, %s)' % (year, month) for year in range(2013, 2017) for month in range(1, 13)
+            if random.random() > 0.1]
+        df = pd.DataFrame(
+            np.array([[float(random.randint(0, 5)) for _ in columns] for _ in range(100)]),
+            columns=columns,
+        )
+        df['siret'] = [str(i) for i in range(100)]
+        df['effectif'] = 10
+        reference_date = date(2017, 2, 1)
+        expected = {}
+        for i in range(1, 8):
+            expected[i] = df.apply(lambda office: hiring_count_semester(office, reference_date, i, 7), axis=1)
+
+        # departement 20 skips the check of the coefficient of variation
+        df, _, y, y_regr = compute_score.add_features(df, "20", reference_date, 7, 1)
+        for i in range(1, 8):
+            semester = df['semester-%s' % i]
+            self.assertEqual(semester.dtype, expected[i].dtype)
+            self.assertTrue(np.array_equal(semester.values, expected[i].values))
+        self.assertTrue(np.array_equal(y.values, df['semester-2'].values > 0))
+        self.assertTrue(np.array_equal(y_regr.values, expected[2].values))
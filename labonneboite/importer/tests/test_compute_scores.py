@@ -1,3 +1,4 @@
+import multiprocessing
 import time
 
 from labonneboite.importer.jobs import compute_scores
@@ -20,3 +21,29 @@ class TestComputeScores(DatabaseTest):
         job = compute_scores.ScoreComputingJob()
         compute_scores.COMPUTE_SCORE_TIMEOUT = 0.01
         job.run(DPAE_TABLE, OFFICE_TABLE)
+
+    def test_departement_costs(self):
+        statistics = {
+            '75': {'runtime': 1000, 'peak_memory_mb': 4000, 'compact': False},
+            '90': {'runtime': 10, 'peak_memory_mb': 500, 'compact': False},
+        }
+        row_counts = {'75': 10000, '90': 100, '13': 5000, '57': 2000}
+        costs = compute_scores.get_departement_costs(['13', '57', '75', '90'], statistics, row_counts)
+        # 0.1 second per row from previous runs
+        self.assertEqual(costs, {'75': 1000, '90': 10, '13': 500, '57': 200})
+        self.assertEqual(sorted(costs, key=costs.get, reverse=True), ['75', '13', '57', '90'])
+
+        # without any previous run, costs are row counts
+        costs = compute_scores.get_departement_costs(['13', '57'], {}, row_counts)
+        self.assertEqual(costs, {'13': 5000, '57': 2000})
+
+    def test_worker_count(self):
+        get_available_memory_mb = compute_scores.get_available_memory_mb
+        compute_scores.get_available_memory_mb = lambda: 10000
+        try:
+            statistics = {'75': {'runtime': 1000, 'peak_memory_mb': 4000, 'compact': False}}
+            self.assertEqual(compute_scores.get_worker_count(statistics, False), min(2, multiprocessing.cpu_count()))
+            compute_scores.get_available_memory_mb = lambda: 100
+            self.assertEqual(compute_scores.get_worker_count(statistics, False), 1)
+        finally:
+            compute_scores.get_available_memory_mb = get_available_memory_mb
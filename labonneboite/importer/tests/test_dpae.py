@@ -1,8 +1,11 @@
+from datetime import datetime
+
 from labonneboite.importer.jobs import check_dpae
 from labonneboite.importer.jobs import extract_dpae
 from labonneboite.importer.models.computing import Dpae
 from labonneboite.importer.tests.test_base import DatabaseTest
-from labonneboite.importer.util import extract_departement_from_zipcode
+from labonneboite.importer.util import extract_departement_from_zipcode, get_fields_from_csv_line
+from labonneboite.importer.util import parse_dpae_date, parse_dpae_file
 
 
 class TestDpae(DatabaseTest):
@@ -31,6 +34,33 @@ class TestDpae(DatabaseTest):
         task.run()
         self.assertEquals(Dpae.query.count(), 6+2)
 
+    def test_extract_dpae_with_load_data(self):
+        filename = self.get_data_file_path("LBB_XDPDPA_DPAE_20151010_20161110_20161110_174915.csv")
+        extract_dpae.DpaeExtractJob.backup_first = False
+        task = extract_dpae.DpaeExtractJob(filename)
+        task.use_load_data = True
+        task.run()
+        self.assertEquals(Dpae.query.count(), 6)
+
+    def test_parse_dpae_file_in_parallel(self):
+        filename = self.get_data_file_path("LBB_XDPDPA_DPAE_20151010_20161110_20161110_174915.csv.gz")
+        sequential_blocks = list(parse_dpae_file(filename, processes=1, block_lines=2))
+        parallel_blocks = list(parse_dpae_file(filename, processes=3, block_lines=2))
+        self.assertEqual(parallel_blocks, sequential_blocks)
+        self.assertEqual(sum(line_count for line_count, _, _, _ in parallel_blocks), 6)
+
+    def test_get_fields_from_csv_line(self):
+        # utf-8 line
+        self.assertEqual(get_fields_from_csv_line('"a\xc2\xa5caf\xc3\xa9\xc2\xa5"\n'), [u"a", u"caf\xe9", u""])
+        # line mixing encodings: fields are decoded one by one
+        self.assertEqual(get_fields_from_csv_line('N\xb0 1\xc2\xa5caf\xc3\xa3\xa9\n'), [u"N\xb0 1", u"caf\xe9"])
+
+    def test_parse_dpae_date(self):
+        self.assertEqual(parse_dpae_date("2016-10-11 08:30:00"), datetime(2016, 10, 11, 8, 30))
+        self.assertEqual(parse_dpae_date("2016-10-11 08:30:00"), datetime(2016, 10, 11, 8, 30))
+        with self.assertRaises(ValueError):
+            parse_dpae_date("11/10/2016")
+
     def test_extract_departement(self):
         departement = extract_departement_from_zipcode("6600", None)
         self.assertEqual(departement, "06")
@@ -1,4 +1,7 @@
 from labonneboite.common.models import Office
+from labonneboite.importer import settings
+from labonneboite.importer import util as import_util
+from labonneboite.importer.jobs import extract_etablissements
 from labonneboite.importer.jobs.extract_etablissements import EtablissementExtractJob
 from labonneboite.importer.tests.test_base import DatabaseTest
 
@@ -57,3 +60,65 @@ class TestEtablissements(DatabaseTest):
         task.delete_deletable_offices()
         self.assertEquals(len(Office.query.all()), 1)
         self.assertEquals(Office.query.first().siret, "00685016800011")
+
+    def test_delete_offices_by_batches(self):
+        filename = self.get_data_file_path("LBB_EGCEMP_ENTREPRISE_20151119_20161219_20161219_153447.csv")
+        task = EtablissementExtractJob(filename)
+        task.csv_offices = task.get_offices_from_file()
+        task.creatable_sirets = task.csv_offices.keys()
+        task.create_creatable_offices()
+        task.deletable_sirets = set(task.csv_offices.keys()[:5])
+        max_count_delete = extract_etablissements.MAX_COUNT_DELETE
+        extract_etablissements.MAX_COUNT_DELETE = 2
+        try:
+            task.delete_deletable_offices()
+        finally:
+            extract_etablissements.MAX_COUNT_DELETE = max_count_delete
+        self.assertEquals(len(Office.query.all()), 24 - 5)
+        counts = extract_etablissements.get_departement_counts()
+        self.assertEquals(sum(counts.values()), 24 - 5)
+
+    def test_sort_offices_from_file(self):
+        filename = self.get_data_file_path("LBB_EGCEMP_ENTREPRISE_20151119_20161219_20161219_153447.csv")
+        task = EtablissementExtractJob(filename)
+        etabs = task.get_offices_from_file()
+        sorted_offices = list(task.sort_offices_from_file(buffer_rows=5))
+        self.assertEquals([siret for siret, _ in sorted_offices], sorted(etabs.keys()))
+        for siret, create_fields in sorted_offices:
+            self.assertEquals(create_fields, etabs[siret]["create_fields"])
+
+    def test_run_task_streaming(self):
+        filename = self.get_data_file_path("LBB_EGCEMP_ENTREPRISE_20151119_20161219_20161219_153447.csv")
+        make_geocoded_office()
+        task = EtablissementExtractJob(filename)
+        task.streaming = True
+        task.sort_buffer_rows = 5
+        num_created = task.run_task()
+        self.assertEquals(num_created, 24)
+        self.assertEquals(len(Office.query.all()), 24)
+        self.assertIsNone(Office.query.filter_by(siret="1234").first())
+        # a second run neither creates nor updates offices
+        task = EtablissementExtractJob(filename)
+        task.streaming = True
+        task.sort_buffer_rows = 5
+        self.assertEquals(task.run_task(), 0)
+        self.assertEquals(len(Office.query.all()), 24)
+        self.assertEquals(task.updated_count, 0)
+        self.assertEquals(task.unchanged_count, 24)
+
+    def test_update_only_changed_offices(self):
+        filename = self.get_data_file_path("LBB_EGCEMP_ENTREPRISE_20151119_20161219_20161219_153447.csv")
+        task = EtablissementExtractJob(filename)
+        self.assertEquals(task.run_task(), 24)
+        # an office imported before content hashes were introduced
+        con, cur = import_util.create_cursor()
+        cur.execute("update %s set raisonsociale='CHANGED', content_hash=NULL where siret='00565014800033'" % (
+            settings.OFFICE_TABLE))
+        con.commit()
+
+        task = EtablissementExtractJob(filename)
+        self.assertEquals(task.run_task(), 0)
+        self.assertEquals(task.updated_count, 1)
+        self.assertEquals(task.unchanged_count, 23)
+        cur.execute("select raisonsociale from %s where siret='00565014800033'" % settings.OFFICE_TABLE)
+        self.assertNotEquals(cur.fetchone()[0], "CHANGED")
@@ -1,8 +1,11 @@
 import os
 import gzip
 import bz2
+import multiprocessing
+import Queue
 import re
 import subprocess
+from collections import deque
 from datetime import datetime
 
 import MySQLdb as mdb
@@ -31,9 +34,15 @@ class TooFewFieldsException(Exception):
     pass
 
 
-def create_cursor():
+def create_cursor(local_infile=False):
+    """
+    `local_infile` allows the connection to run LOAD DATA LOCAL INFILE statements.
+    """
+    kwargs = {}
+    if local_infile:
+        kwargs['local_infile'] = 1
     con = mdb.connect('localhost', DATABASE['USER'], DATABASE['PASSWORD'], DATABASE['NAME'],
-        use_unicode=True, charset="utf8")
+        use_unicode=True, charset="utf8", **kwargs)
     cur = con.cursor()
     return con, cur
 
@@ -246,8 +255,33 @@ def get_fields_from_csv_line(line):
     if (line[-1] in ["'", '"']):
         line = line[:-1]
     # split using delimiter special character \xa5
-    fields = [encoding_util.sanitize_string(f) for f in line.split('\xa5')]
-    return fields
+    # Most lines are valid UTF-8 once split: decode them at once, with the delimiter replaced by a character
+    # which cannot be found in a line, and only sanitize the fields of the other lines one by one.
+    try:
+        return line.replace('\xa5', '\n').decode('utf-8').split(u'\n')
+    except UnicodeDecodeError:
+        return [encoding_util.sanitize_string(f) for f in line.split('\xa5')]
+
+
+# Hiring dates of DPAE files are made of few distinct values, parsed only once.
+DPAE_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+DPAE_DATE_CACHE = {}
+DPAE_DATE_CACHE_MAXIMUM = 100000
+
+
+def parse_dpae_date(value):
+    """
+    Same as datetime.strptime(value, DPAE_DATE_FORMAT), with a cache.
+    """
+    try:
+        return DPAE_DATE_CACHE[value]
+    except KeyError:
+        pass
+    date = datetime.strptime(value, DPAE_DATE_FORMAT)
+    if len(DPAE_DATE_CACHE) >= DPAE_DATE_CACHE_MAXIMUM:
+        DPAE_DATE_CACHE.clear()
+    DPAE_DATE_CACHE[value] = date
+    return date
 
 
 def parse_dpae_line(line):
@@ -265,7 +299,7 @@ def parse_dpae_line(line):
 
     siret = fields[0]
     hiring_date_raw = fields[7]
-    hiring_date = datetime.strptime(hiring_date_raw, "%Y-%m-%d %H:%M:%S")
+    hiring_date = parse_dpae_date(hiring_date_raw)
 
     try:
         zipcode = int(fields[3])
@@ -305,6 +339,115 @@ def parse_dpae_line(line):
     return siret, hiring_date, zipcode, contract_type, departement, contract_duration, iiann, tranche_age, handicap_label
 
 
+def parse_dpae_block(lines):
+    """
+    Parse a block of lines of a DPAE file, see parse_dpae_line.
+    Return the parsed rows of the valid lines, the number of zipcode errors,
+    and the indexes in the block of the lines having too few fields.
+    """
+    rows = []
+    zipcode_errors = 0
+    invalid_rows = []
+    for index, line in enumerate(lines):
+        try:
+            rows.append(parse_dpae_line(line))
+        except (ValueError, DepartementException):
+            zipcode_errors += 1
+        except TooFewFieldsException:
+            invalid_rows.append(index)
+    return rows, zipcode_errors, invalid_rows
+
+
+def read_dpae_blocks(filename, queue, block_lines):
+    """
+    Run in a reader process: decompress the DPAE file and put its lines, without the header line,
+    into the queue by blocks of `block_lines` lines. None is put once the file has been read.
+    """
+    with get_reader(filename) as myfile:
+        myfile.readline()
+        block = []
+        for line in myfile:
+            block.append(line)
+            if len(block) >= block_lines:
+                queue.put(block)
+                block = []
+        if block:
+            queue.put(block)
+    queue.put(None)
+
+
+def parse_dpae_file(filename, processes, block_lines):
+    """
+    Parse the lines of a DPAE file, without its header line, by blocks of `block_lines` lines.
+
+    The file is decompressed in a reader process and its blocks are parsed by a pool of `processes` processes.
+    Yield, in the order of the file, the number of lines of each block along with the result of parse_dpae_block.
+    """
+    if processes <= 1:
+        with get_reader(filename) as myfile:
+            myfile.readline()
+            block = []
+            for line in myfile:
+                block.append(line)
+                if len(block) >= block_lines:
+                    yield (len(block),) + parse_dpae_block(block)
+                    block = []
+            if block:
+                yield (len(block),) + parse_dpae_block(block)
+        return
+
+    # Bound the number of blocks read ahead and parsed ahead, so that memory does not depend on the file size.
+    queue = multiprocessing.Queue(maxsize=2 * processes)
+    reader = multiprocessing.Process(target=read_dpae_blocks, args=(filename, queue, block_lines))
+    reader.start()
+    pool = multiprocessing.Pool(processes=processes)
+    pending = deque()
+
+    def get_block():
+        while True:
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                if not reader.is_alive():
+                    raise Exception("error while reading %s (exit code %s)" % (filename, reader.exitcode))
+
+    try:
+        block = get_block()
+        while block is not None or pending:
+            # parsed blocks are consumed in order, while the pool parses the next ones
+            while block is not None and len(pending) < 2 * processes:
+                pending.append((len(block), pool.apply_async(parse_dpae_block, (block,))))
+                block = get_block()
+            line_count, async_result = pending.popleft()
+            yield (line_count,) + async_result.get()
+        reader.join()
+        if reader.exitcode != 0:
+            raise Exception("error while reading %s (exit code %s)" % (filename, reader.exitcode))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if reader.is_alive():
+            reader.terminate()
+            reader.join()
+
+
+def get_load_data_field(value):
+    """
+    Format a value as a field of a file loaded by LOAD DATA INFILE with the default options:
+    fields separated by tabs, special characters escaped by backslashes, NULL written as \\N.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        value = value.strftime("%Y-%m-%d %H:%M:%S")
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
 def get_file_extension(filename):
     _, file_extension = os.path.splitext(filename)
     return file_extension
@@ -0,0 +1,52 @@
+"""
+Compares the throughput of the two ways of extracting DPAE (see importer/jobs/extract_dpae.py):
+batches of INSERT statements, and LOAD DATA LOCAL INFILE of temporary files.
+
+Each extraction is run into a scratch copy of the dpae table, with all hiring dates, e.g.:
+    python scripts/benchmark_extract_dpae.py /srv/lbb/data/LBB_XDPDPA_DPAE_20151010_20161110_20161110_174915.csv.gz
+"""
+import sys
+import time
+from datetime import datetime
+
+from labonneboite.importer import settings
+from labonneboite.importer import util as import_util
+from labonneboite.importer.jobs.extract_dpae import DpaeExtractJob
+
+import logging
+
+logger = logging.getLogger('main')
+formatter = logging.Formatter("%(levelname)s - IMPORTER - %(message)s")
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+BENCHMARK_TABLE = 'dpae_benchmark'
+
+
+def benchmark_extract(filename, use_load_data):
+    """
+    Returns the number of rows imported from the file and the duration of the extraction, in seconds.
+    """
+    con, cur = import_util.create_cursor(local_infile=use_load_data)
+    cur.execute("drop table if exists %s" % BENCHMARK_TABLE)
+    cur.execute("create table %s like %s" % (BENCHMARK_TABLE, settings.DPAE_TABLE))
+    job = DpaeExtractJob(filename)
+    job.table_name = BENCHMARK_TABLE
+    job.use_load_data = use_load_data
+    try:
+        start = time.time()
+        _, imported_dpae, _ = job.extract(con, cur, datetime.min, datetime.max)
+        duration = time.time() - start
+    finally:
+        cur.execute("drop table if exists %s" % BENCHMARK_TABLE)
+        con.close()
+    return imported_dpae, duration
+
+
+if __name__ == "__main__":
+    filename = sys.argv[1]
+    for name, use_load_data in [("INSERT", False), ("LOAD DATA", True)]:
+        rows, duration = benchmark_extract(filename, use_load_data)
+        logger.info("%s: %i rows in %.1fs (%.0f rows/s)", name, rows, duration, rows / max(duration, 0.001))
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark of the decoding of lines and the parsing of hiring dates of the importer (see importer/util.py),
+against their former implementations: each field sanitized one by one, and datetime.strptime for each DPAE.
+
+The lines of the input files (by default the fixtures of importer/tests/data) are parsed
+a given number of times with both implementations, whose outputs must be equal, e.g.:
+    python scripts/benchmark_parse_lines.py -n 10000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+from labonneboite.common import encoding as encoding_util
+from labonneboite.importer import util as import_util
+
+import logging
+
+logger = logging.getLogger('main')
+formatter = logging.Formatter("%(levelname)s - IMPORTER - %(message)s")
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "importer", "tests", "data")
+
+
+def get_fields_from_csv_line_reference(line):
+    """
+    Former implementation of util.get_fields_from_csv_line.
+    """
+    line = line.strip().replace('\xc2', '')
+    if (line[0] in ["'", '"']):
+        line = line[1:]
+    if (line[-1] in ["'", '"']):
+        line = line[:-1]
+    return [encoding_util.sanitize_string(f) for f in line.split('\xa5')]
+
+
+def parse_dpae_date_reference(value):
+    """
+    Former implementation of util.parse_dpae_date.
+    """
+    return datetime.strptime(value, import_util.DPAE_DATE_FORMAT)
+
+
+def read_lines(filenames):
+    lines = []
+    for filename in filenames:
+        with import_util.get_reader(filename) as myfile:
+            myfile.readline()
+            lines.extend(line for line in myfile if line.strip())
+    return lines
+
+
+def parse_lines(lines, repeat, get_fields, parse_date):
+    """
+    Return the fields and hiring dates of the lines, and the duration of `repeat` parsings of the lines.
+    """
+    start = time.time()
+    for _ in xrange(repeat):
+        results = []
+        for line in lines:
+            fields = get_fields(line)
+            # only DPAE lines have 24 fields, the hiring date being the 8th one
+            hiring_date = parse_date(fields[7]) if len(fields) == 24 else None
+            results.append((fields, hiring_date))
+    return results, time.time() - start
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Compare the former and current parsing of the lines of input files")
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=1000, help="Number of parsings of the lines")
+    parser.add_argument('filenames', nargs='*', help="Input files (default: the fixtures of the importer tests)")
+    args = parser.parse_args()
+
+    filenames = args.filenames or [
+        os.path.join(DATA_FOLDER, name) for name in sorted(os.listdir(DATA_FOLDER)) if name.endswith('.csv')
+    ]
+    lines = read_lines(filenames)
+    logger.info("parsing %i lines of %i files %i times...", len(lines), len(filenames), args.repeat)
+
+    reference_results, reference_duration = parse_lines(
+        lines, args.repeat, get_fields_from_csv_line_reference, parse_dpae_date_reference)
+    results, duration = parse_lines(
+        lines, args.repeat, import_util.get_fields_from_csv_line, import_util.parse_dpae_date)
+
+    logger.info("former parsing: %.3fs", reference_duration)
+    logger.info("current parsing: %.3fs (x%.1f)", duration, reference_duration / max(duration, 0.001))
+    if results != reference_results:
+        logger.error("the current parsing gives a different output!")
+        sys.exit(1)
+    logger.info("both parsings give the same output")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,130 @@
+# coding: utf8
+"""
+Compare the two layouts of the scores adjusted to ROME codes in the index (see settings.ES_COMPACT_SCORES_FOR_ROME):
+build the offices of the database with each layout in a temporary index, then report the build time,
+the index size and the heap used by the index, and check that popular searches return the same offices.
+"""
+import argparse
+import json
+import logging
+import time
+
+from elasticsearch import Elasticsearch
+
+from labonneboite.common import geocoding
+from labonneboite.common import mapping as mapping_util
+from labonneboite.common import search
+from labonneboite.conf import settings
+from labonneboite.scripts import create_index as script
+from labonneboite.scripts import warm_up_cache
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+ES_TIMEOUT = 300
+
+LAYOUTS = [
+    ('fields', False),
+    ('compact', True),
+]
+
+
+def build_index(index, compact):
+    """
+    Build the offices of the database in `index` with the given layout.
+    Returns the wall and CPU durations of the build, in seconds.
+    """
+    settings.ES_COMPACT_SCORES_FOR_ROME = compact
+    script.add_scores_to_request_body()
+    script.drop_and_create_index(index=index)
+    start, start_cpu = time.time(), script.get_cpu_seconds()
+    script.create_offices(index=index)
+    Elasticsearch(timeout=ES_TIMEOUT).indices.refresh(index=index)
+    return time.time() - start, script.get_cpu_seconds() - start_cpu
+
+
+def run_searches(es, index, searches, coordinates):
+    """
+    Runs the first results page of each search sorted by score.
+    Returns the sirets found by each search, and the sorted durations of the searches.
+    """
+    sirets = []
+    durations = []
+    for searched in searches:
+        latitude, longitude = coordinates[searched.zipcode]
+        naf_codes = mapping_util.Rome2NafMapper().map([searched.rome])
+        json_body = search.build_json_body_elastic_search(
+            naf_codes, latitude, longitude, searched.distance,
+            from_number=1, to_number=settings.PAGINATION_COMPANIES_PER_PAGE,
+            sort='score', rome_code=searched.rome)
+        start = time.time()
+        res = es.search(index=index, doc_type=script.OFFICE_TYPE, body=json_body,
+            routing=search.get_routing(latitude, longitude, searched.distance))
+        durations.append(time.time() - start)
+        sirets.append([hit['_source']['siret'] for hit in res['hits']['hits']])
+    return sirets, sorted(durations)
+
+
+def get_index_stats(es, index):
+    stats = es.indices.stats(index=index, metric='docs,store,segments,fielddata')['indices'][index]['primaries']
+    return {
+        'documents': stats['docs']['count'],
+        'store_bytes': stats['store']['size_in_bytes'],
+        'segments_memory_bytes': stats['segments']['memory_in_bytes'],
+        'fielddata_memory_bytes': stats['fielddata']['memory_size_in_bytes'],
+        'mapping_bytes': len(json.dumps(es.indices.get_mapping(index=index, doc_type=script.OFFICE_TYPE))),
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Compare the layouts of the scores adjusted to ROME codes")
+    parser.add_argument('-i', '--index-prefix', dest='index_prefix', default='benchmark_scores',
+        help="Prefix of the temporary indexes")
+    parser.add_argument('-n', '--count', dest='count', type=int, default=200, help="Number of searches to compare")
+    parser.add_argument('-k', '--keep-indexes', dest='keep_indexes', action='store_true',
+        help="Do not delete the temporary indexes")
+    args = parser.parse_args()
+
+    es = Elasticsearch(timeout=ES_TIMEOUT)
+    coordinates = geocoding.load_coordinates()
+    searches = [
+        searched for searched in warm_up_cache.get_searches_from_sitemap(args.count)
+        if searched.zipcode in coordinates
+    ]
+    compact_setting = settings.ES_COMPACT_SCORES_FOR_ROME
+
+    results = {}
+    try:
+        for name, compact in LAYOUTS:
+            index = "%s_%s" % (args.index_prefix, name)
+            logging.info("building index %s...", index)
+            wall, cpu = build_index(index, compact)
+            sirets, durations = run_searches(es, index, searches, coordinates)
+            results[name] = dict(get_index_stats(es, index),
+                build_seconds=wall,
+                build_cpu_seconds=cpu,
+                search_p50_ms=warm_up_cache.get_percentile(durations, 50) * 1000 if durations else None,
+                search_p90_ms=warm_up_cache.get_percentile(durations, 90) * 1000 if durations else None,
+                sirets=sirets,
+            )
+            if not args.keep_indexes:
+                es.indices.delete(index=index, ignore=[404])
+    finally:
+        settings.ES_COMPACT_SCORES_FOR_ROME = compact_setting
+        script.add_scores_to_request_body()
+
+    different_searches = [
+        searched for searched, fields_sirets, compact_sirets
+        in zip(searches, results['fields'].pop('sirets'), results['compact'].pop('sirets'))
+        if fields_sirets != compact_sirets
+    ]
+    for name, _ in LAYOUTS:
+        logging.info("%s: %s", name, json.dumps(results[name], sort_keys=True))
+    logging.info("%s searches out of %s return different offices", len(different_searches), len(searches))
+    for searched in different_searches:
+        logging.info("different offices for %s", searched)
+
+
+if __name__ == '__main__':
+    run()
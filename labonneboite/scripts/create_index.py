@@ -1,10 +1,19 @@
 # coding: utf8
 import argparse
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
 import logging
+import os
+import resource
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from elasticsearch import Elasticsearch
-from elasticsearch import TransportError
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import expand_action, scan
 from sqlalchemy import inspect
 
 from labonneboite.common import encoding as encoding_util
@@ -17,6 +26,7 @@ from labonneboite.common.models import OfficeAdminAdd, OfficeAdminUpdate, Office
 from labonneboite.conf import settings
 from labonneboite.common import scoring as scoring_util
 from labonneboite.common import mapping as mapping_util
+from labonneboite.common import search as search_util
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
@@ -26,6 +36,30 @@ INDEX_NAME = 'labonneboite'
 OFFICE_TYPE = 'office'
 ES_TIMEOUT = 30
 SCORE_FOR_ROME_MINIMUM = 20  # at least 1.0 stars over 5.0
+NATIONAL_TOP_OFFICES_PER_ROME = 1000
+
+# Bulk ingestion tuning, see bulk_index.
+BULK_CHUNK_SIZE = 5000
+BULK_CONCURRENCY = 4
+BULK_MAX_RETRIES = 3
+BULK_RETRY_DELAY = 1  # seconds, doubled at each retry
+
+# Profiling report of the index build (see BuildProfiler), written in settings.INDEX_PROFILING_REPORT_FILENAME.
+# A phase is reported as a regression when it takes that much longer than in the previous build...
+PROFILING_REGRESSION_RATIO = 0.2
+# ... and at least that many more seconds.
+PROFILING_REGRESSION_MINIMUM_SECONDS = 5
+
+# Fields of the `Office` model which an office document is built from, see get_office_row_hash.
+OFFICE_ROW_HASH_FIELDS = [
+    'siret', 'naf', 'score', 'headcount', 'office_name', 'email', 'tel', 'website',
+    'flag_alternance', 'flag_junior', 'flag_senior', 'flag_handicap', 'zipcode', 'x', 'y',
+]
+# Number of changed offices loaded from DB at a time by sync_offices.
+SYNC_CHUNK_SIZE = 1000
+
+# An office as currently indexed, see get_indexed_office_hashes.
+IndexedOffice = collections.namedtuple('IndexedOffice', ['content_hash', 'row_hash', 'routing', 'naf'])
 
 
 class StatTracker:
@@ -33,16 +67,142 @@ class StatTracker:
         self.office_count = 0
         self.indexed_office_count = 0
         self.office_score_for_rome_count = 0
+        self.score_injection_seconds = 0.0
     def increment_office_count(self):
         self.office_count += 1
     def increment_indexed_office_count(self):
         self.indexed_office_count += 1
     def increment_office_score_for_rome_count(self):
         self.office_score_for_rome_count += 1
+    def add_score_injection_seconds(self, seconds):
+        self.score_injection_seconds += seconds
 
 st = StatTracker()
 
 
+class BuildProfiler(object):
+    """
+    Record the resources used by each phase of an index build run in a given mode (see run):
+    wall time, CPU time, peak RSS of the process so far and the counters of the phase (rows read, documents built or sent...).
+
+    A phase run within another one is a sub-phase of it, reported as `parent/child`, e.g. `admin_overrides/bulk_send`:
+    the time of a sub-phase is part of the time of its parent, only top-level phases do not overlap.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.phases = collections.OrderedDict()
+        self.current_phases = []
+
+    def get_phase_name(self, name):
+        return '/'.join(self.current_phases + [name])
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Measure the code run within this context, which can be run several times for the same phase.
+        Yield the counters of the phase.
+        """
+        counters = self.phases.setdefault(self.get_phase_name(name), collections.Counter())
+        self.current_phases.append(name)
+        start, start_cpu = time.time(), get_cpu_seconds()
+        try:
+            yield counters
+        finally:
+            counters['wall_seconds'] += time.time() - start
+            counters['cpu_seconds'] += get_cpu_seconds() - start_cpu
+            # ru_maxrss is the peak of the whole process up to the end of the phase, in kilobytes on Linux
+            counters['process_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.current_phases.pop()
+
+    def record(self, name, **counters):
+        """
+        Add counters measured by the caller to a sub-phase of the current phase,
+        for code run too many times to be measured by `phase` (e.g. `wall_seconds=12.3, docs=1000`).
+        """
+        self.phases.setdefault(self.get_phase_name(name), collections.Counter()).update(counters)
+
+    def get_report(self):
+        phases = collections.OrderedDict()
+        for name, counters in self.phases.iteritems():
+            phase = dict(counters)
+            for count_name in ['rows', 'docs']:
+                if count_name in counters and counters['wall_seconds']:
+                    phase['%s_per_second' % count_name] = counters[count_name] / counters['wall_seconds']
+            phases[name] = phase
+        return {
+            'created_at': datetime.now().isoformat(),
+            'mode': self.mode,
+            'phases': phases,
+        }
+
+def get_cpu_seconds():
+    """
+    Return the user and system CPU time of the process, in seconds.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+# Profiler of the build run by run(), None when the functions of this module are used by other scripts.
+profiler = None
+
+
+@contextlib.contextmanager
+def profiled_phase(name):
+    """
+    Measure a phase of the build with the current profiler, if any. Yield the counters of the phase.
+    """
+    if profiler is None:
+        yield collections.Counter()
+    else:
+        with profiler.phase(name) as counters:
+            yield counters
+
+
+def get_profiling_regressions(previous_report, report):
+    """
+    Return the phases of the report which took significantly longer than in the previous report,
+    as `(phase, previous_seconds, seconds)` tuples. Reports of builds run in different modes are not compared.
+    """
+    regressions = []
+    if previous_report.get('mode') != report.get('mode'):
+        return regressions
+    for name, phase in report['phases'].iteritems():
+        previous_phase = previous_report['phases'].get(name)
+        if not previous_phase:
+            continue
+        previous_seconds, seconds = previous_phase['wall_seconds'], phase['wall_seconds']
+        if (seconds > previous_seconds * (1 + PROFILING_REGRESSION_RATIO)
+                and seconds - previous_seconds >= PROFILING_REGRESSION_MINIMUM_SECONDS):
+            regressions.append((name, previous_seconds, seconds))
+    return regressions
+
+
+def write_profiling_report(report, filename=settings.INDEX_PROFILING_REPORT_FILENAME):
+    """
+    Write the profiling report of the build into a JSON file holding the last report of each mode,
+    and log the regressions since the previous report of the same mode.
+    """
+    reports = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            reports = json.load(f)
+        # a single report, written before reports were kept by mode
+        if 'phases' in reports:
+            reports = {}
+    previous_report = reports.get(report['mode'])
+    if previous_report:
+        for name, previous_seconds, seconds in get_profiling_regressions(previous_report, report):
+            logging.warning("regression of phase %s: %.1fs instead of %.1fs on %s",
+                name, seconds, previous_seconds, previous_report['created_at'])
+    reports[report['mode']] = report
+    if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        json.dump(reports, f, indent=2)
+    logging.info("profiling report written in %s", filename)
+
+
 filters = {
     "stop_francais": {
         "type": "stop",
@@ -202,8 +362,48 @@ mapping_office = {
             "type": "integer",
             "index": "not_analyzed",
         },
+        # whether the office was manually boosted (score 100), see search.build_json_body_elastic_search
+        "boosted": {
+            "type": "integer",
+            "index": "not_analyzed",
+        },
         "location": {
             "type": "geo_point",
+            # index latitude and longitude as numeric fields to aggregate them (see search.get_clusters_for_naf_codes)
+            "lat_lon": True,
+        },
+        # only stored to detect the offices which changed since they were indexed, see sync_offices
+        "content_hash": {
+            "type": "string",
+            "index": "no",
+        },
+        "row_hash": {
+            "type": "string",
+            "index": "no",
+        },
+    },
+}
+
+# keys shuffling offices having the same stars or distance, see search.get_shuffle_keys
+for shuffle_key_field in search_util.get_shuffle_keys(u"").keys():
+    mapping_office["properties"][shuffle_key_field] = {
+        "type": "integer",
+        "index": "not_analyzed",
+    }
+
+mapping_national_top = {
+    "properties": {
+        "rome_code": {
+            "type": "string",
+            "index": "not_analyzed",
+        },
+        "office_count": {
+            "type": "integer",
+        },
+        # only stored to be returned as is, see search.search_national_top
+        "offices": {
+            "type": "object",
+            "enabled": False,
         },
     },
 }
@@ -221,12 +421,38 @@ request_body = {
         "ogr": mapping_ogr,
         "location": mapping_location,
         "office": mapping_office,
+        search_util.NATIONAL_TOP_TYPE: mapping_national_top,
     },
 }
 
 def add_scores_to_request_body():
+    """
+    Add the scores of offices adjusted to each ROME code to the `office` mapping,
+    with the layout given by settings.ES_COMPACT_SCORES_FOR_ROME.
+    """
+    properties = request_body["mappings"]["office"]["properties"]
+    for field_name in properties.keys():
+        if field_name.startswith("score_for_rome_") or field_name == search_util.SCORES_FOR_ROME_PATH:
+            del properties[field_name]
+
+    if settings.ES_COMPACT_SCORES_FOR_ROME:
+        properties[search_util.SCORES_FOR_ROME_PATH] = {
+            "type": "nested",
+            "properties": {
+                "rome_code": {
+                    "type": "string",
+                    "index": "not_analyzed",
+                },
+                "score": {
+                    "type": "integer",
+                    "index": "not_analyzed",
+                },
+            },
+        }
+        return
+
     for rome_code in settings.ROME_DESCRIPTIONS.keys():
-        request_body["mappings"]["office"]["properties"]["score_for_rome_%s" % rome_code] = {
+        properties["score_for_rome_%s" % rome_code] = {
             "type": "integer",
             "index": "not_analyzed"    
         }
@@ -242,17 +468,99 @@ def drop_and_create_index(index=INDEX_NAME):
     es.indices.create(index=index, body=request_body)
 
 
+def bulk_index(es, actions, chunk_size=BULK_CHUNK_SIZE, concurrency=BULK_CONCURRENCY,
+        max_retries=BULK_MAX_RETRIES, ignore_not_found=False):
+    """
+    Send the actions to ElasticSearch in bulk requests of `chunk_size` actions, `concurrency` requests at a time.
+
+    Items rejected by an overloaded cluster (status 429) are retried up to `max_retries` times,
+    waiting longer and longer between retries. Any other failed item is logged, instead of failing on the first one.
+    With `ignore_not_found`, documents missing from the index are not considered as errors.
+
+    Return the stats of the ingestion: `{'indexed': 12, 'failed': 0, 'rejected': 3, 'retried': 3}`.
+    """
+    start = time.time()
+
+    def send_chunk(chunk):
+        chunk_stats = collections.Counter()
+        for attempt in range(max_retries + 1):
+            if attempt:
+                chunk_stats['retried'] += len(chunk)
+                time.sleep(BULK_RETRY_DELAY * 2 ** (attempt - 1))
+            body = []
+            for action in chunk:
+                action_line, data = expand_action(dict(action))
+                body.append(action_line)
+                if data is not None:
+                    body.append(data)
+            response = es.bulk(body=body)
+
+            rejected_actions = []
+            for action, item in zip(chunk, response['items']):
+                op_type, result = item.items()[0]
+                status = result.get('status', 500)
+                if 200 <= status < 300 or (ignore_not_found and status == 404):
+                    chunk_stats['indexed'] += 1
+                elif status == 429:
+                    chunk_stats['rejected'] += 1
+                    rejected_actions.append(action)
+                else:
+                    chunk_stats['failed'] += 1
+                    logging.info("failed to %s document %s: %s", op_type, result.get('_id'), result.get('error', status))
+            chunk = rejected_actions
+            if not chunk:
+                break
+
+        if chunk:
+            chunk_stats['failed'] += len(chunk)
+            logging.info("gave up %s documents rejected %s times", len(chunk), max_retries + 1)
+        return chunk_stats
+
+    def get_chunks():
+        actions_iterator = iter(actions)
+        chunk = list(itertools.islice(actions_iterator, chunk_size))
+        while chunk:
+            yield chunk
+            chunk = list(itertools.islice(actions_iterator, chunk_size))
+
+    stats = collections.Counter({'indexed': 0, 'failed': 0, 'rejected': 0, 'retried': 0})
+    with profiled_phase('bulk_send') as counters:
+        pool = ThreadPool(concurrency)
+        try:
+            for chunk_stats in pool.imap_unordered(send_chunk, get_chunks()):
+                stats.update(chunk_stats)
+        finally:
+            pool.close()
+            pool.join()
+        counters.update(stats)
+        counters['docs'] += stats['indexed']
+
+    elapsed = time.time() - start
+    logging.info("bulk: %s indexed, %s failed, %s rejected, %s retried in %.1fs (%.0f documents/s)",
+        stats['indexed'], stats['failed'], stats['rejected'], stats['retried'], elapsed,
+        stats['indexed'] / max(elapsed, 0.001))
+    return dict(stats)
+
+
 def create_job_codes(index=INDEX_NAME):
     """
     Create the `ogr` type in ElasticSearch.
     """
     logging.info("create job codes...")
+    es = Elasticsearch(timeout=ES_TIMEOUT)
+    bulk_index(es, get_job_codes_actions(index))
+
+
+def get_job_codes_actions(index=INDEX_NAME):
+    """
+    Return the bulk actions indexing the documents of the `ogr` type.
+    """
     key = 1
     # libelles des appelations pour les codes ROME
     ogr_labels = load_ogr_labels()
     # correspondance appellation vers rome
     ogr_rome_codes = load_ogr_rome_codes()
-    es = Elasticsearch(timeout=ES_TIMEOUT)
+    actions = []
 
     for ogr, description in ogr_labels.iteritems():
         rome_code = ogr_rome_codes[ogr]
@@ -268,16 +576,31 @@ def create_job_codes(index=INDEX_NAME):
             'rome_code': rome_code,
             'rome_description': rome_description
         }
-        es.index(index=index, doc_type='ogr', id=key, body=doc)
+        actions.append({
+            '_op_type': 'index',
+            '_index': index,
+            '_type': 'ogr',
+            '_id': key,
+            '_source': doc,
+        })
         key += 1
 
+    return actions
+
 
 def create_locations(index=INDEX_NAME):
     """
     Create the `location` type in ElasticSearch.
     """
-    all_cities = geocoding.load_coordinates_for_cities()
     es = Elasticsearch(timeout=ES_TIMEOUT)
+    bulk_index(es, get_locations_actions(index))
+
+
+def get_locations_actions(index=INDEX_NAME):
+    """
+    Return the bulk actions indexing the documents of the `location` type.
+    """
+    all_cities = geocoding.load_coordinates_for_cities()
     actions = []
 
     for _, city_name, zipcode, population, latitude, longitude in all_cities:
@@ -302,7 +625,7 @@ def create_locations(index=INDEX_NAME):
             '_source': doc
         }
         actions.append(action)
-    bulk(es, actions)
+    return actions
 
 
 def get_office_as_es_doc(office):
@@ -339,7 +662,9 @@ def get_office_as_es_doc(office):
         'flag_junior': int(office.flag_junior),
         'flag_senior': int(office.flag_senior),
         'flag_handicap': int(office.flag_handicap),
+        'boosted': int(office.score == 100),
     }
+    doc.update(search_util.get_shuffle_keys(office.siret))
 
     if office.y and office.x:
         doc['location'] = {
@@ -349,18 +674,61 @@ def get_office_as_es_doc(office):
 
     doc = inject_office_rome_scores_into_es_doc(office, doc)
 
+    doc['content_hash'] = get_es_doc_hash(doc)
+    doc['row_hash'] = get_office_row_hash(get_office_row_values(office))
+
     return doc
 
 
-def inject_office_rome_scores_into_es_doc(office, doc):
-    # fetch all rome_codes mapped to the naf of this office
-    # as we will compute a score adjusted for each of them
+def get_es_doc_hash(doc):
+    """
+    Return a hash of the content of an office document, used to detect changes (see sync_offices).
+    """
+    content = {key: value for key, value in doc.iteritems() if key not in ['content_hash', 'row_hash']}
+    return hashlib.md5(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+def get_office_row_values(office):
+    """
+    Return the values of the OFFICE_ROW_HASH_FIELDS of an `Office` or an `OfficeAdminAdd` instance.
+    """
+    values = []
+    for field in OFFICE_ROW_HASH_FIELDS:
+        value = getattr(office, field)
+        # The `headcount` field of an `OfficeAdminAdd` instance has a `code` attribute.
+        if hasattr(value, 'code'):
+            value = value.code
+        values.append(value)
+    return values
+
+
+def get_office_row_hash(values):
+    """
+    Return a hash of the values of the OFFICE_ROW_HASH_FIELDS of an office row.
+    Unlike get_es_doc_hash, it does not need to build the document, so that sync_offices can tell
+    which offices changed in DB from their rows only.
+    """
+    return hashlib.md5(json.dumps(list(values))).hexdigest()
+
+
+def get_rome_codes_for_naf(naf):
+    """
+    Return the rome_codes mapped to a naf, for each of which an office of this naf has an adjusted score.
+    """
     try:
-        rome_codes = mapping_util.MANUAL_NAF_ROME_MAPPING[office.naf].keys()
+        return mapping_util.MANUAL_NAF_ROME_MAPPING[naf].keys()
     except KeyError:
         # unfortunately some NAF codes have no matching ROME at all
-        rome_codes = []
+        return []
+
+
+def inject_office_rome_scores_into_es_doc(office, doc):
+    # fetch all rome_codes mapped to the naf of this office
+    # as we will compute a score adjusted for each of them
+    rome_codes = get_rome_codes_for_naf(office.naf)
 
+    scores_for_rome = []
+    start = time.time()
     for rome_code in rome_codes:
         office_score_for_current_rome = scoring_util.get_score_adjusted_to_rome_code_and_naf_code(
             score=office.score,
@@ -369,17 +737,26 @@ def inject_office_rome_scores_into_es_doc(office, doc):
         )
         if office_score_for_current_rome >= SCORE_FOR_ROME_MINIMUM:
             st.increment_office_score_for_rome_count()
-            doc['score_for_rome_%s' % rome_code] = office_score_for_current_rome
+            if settings.ES_COMPACT_SCORES_FOR_ROME:
+                scores_for_rome.append({'rome_code': rome_code, 'score': office_score_for_current_rome})
+            else:
+                doc['score_for_rome_%s' % rome_code] = office_score_for_current_rome
+    # a profiler phase per office would cost more than the score injection itself, see get_offices_actions
+    st.add_score_injection_seconds(time.time() - start)
+
+    if settings.ES_COMPACT_SCORES_FOR_ROME:
+        # Always set, so that a partial update (see update_offices) replaces the previous scores.
+        doc[search_util.SCORES_FOR_ROME_PATH] = scores_for_rome
 
     return doc
 
 
-def chunks(l, n):
+def is_office_reachable(es_doc):
     """
-    Yield successive n-sized chunks from l.
+    Whether the office has a score for at least one ROME code, i.e. can be found by a search.
     """
-    for i in xrange(0, len(l), n):
-        yield l[i:i+n]
+    return bool(es_doc.get(search_util.SCORES_FOR_ROME_PATH)) or any(
+        key.startswith('score_for_rome_') for key in es_doc)
 
 
 def create_offices(index=INDEX_NAME, ignore_unreachable_offices=False):
@@ -387,114 +764,170 @@ def create_offices(index=INDEX_NAME, ignore_unreachable_offices=False):
     Create the `office` type in ElasticSearch.
     """
     es = Elasticsearch(timeout=300)
-
-    actions = []
-
     logging.info("creating offices...")
+    bulk_index(es, get_offices_actions(index, ignore_unreachable_offices))
 
-    for _, office in enumerate(db_session.query(Office).all()):
-
-        st.increment_office_count()
-        if st.office_count % 10000 == 0:
-            logging.info("already processed %s offices, %s were actually indexed...",
-                st.office_count,
-                st.indexed_office_count,
-                )
 
-        es_doc = get_office_as_es_doc(office)
-
-        office_is_reachable = any(key.startswith('score_for_rome_') for key in es_doc)
-
-        if office_is_reachable or not ignore_unreachable_offices:
-            st.increment_indexed_office_count()
-            actions.append({
-                '_op_type': 'index',
-                '_index': index,
-                '_type': OFFICE_TYPE,
-                '_id': office.siret,
-                '_source': es_doc,
-            })
+def get_offices_actions(index=INDEX_NAME, ignore_unreachable_offices=False, offices=None):
+    """
+    Return the bulk actions indexing the documents of the `office` type.
+    The documents are built from the given `offices`, which can be any objects having the attributes
+    of an `Office` (see get_office_as_es_doc), or from the offices of the DB by default.
+    """
+    actions = []
 
-    logging.info("chunking index actions")
-    batch_actions = chunks(actions, 10000)
-    logging.info("chunking done...")
-    chunk = 0
-    for batch_action in batch_actions:
-        logging.info("chunk %s", chunk)
-        chunk += 1
-        bulk(es, batch_action)
+    with profiled_phase('db_read') as counters:
+        if offices is None:
+            offices = db_session.query(Office).all()
+        else:
+            offices = list(offices)
+        counters['rows'] += len(offices)
+
+    with profiled_phase('doc_build') as counters:
+        score_injection_seconds = st.score_injection_seconds
+        for office in offices:
+
+            st.increment_office_count()
+            if st.office_count % 10000 == 0:
+                logging.info("already processed %s offices, %s were actually indexed...",
+                    st.office_count,
+                    st.indexed_office_count,
+                    )
+
+            es_doc = get_office_as_es_doc(office)
+
+            office_is_reachable = is_office_reachable(es_doc)
+
+            if office_is_reachable or not ignore_unreachable_offices:
+                st.increment_indexed_office_count()
+                counters['docs'] += 1
+                actions.append({
+                    '_op_type': 'index',
+                    '_index': index,
+                    '_type': OFFICE_TYPE,
+                    '_id': office.siret,
+                    '_routing': search_util.get_office_routing(office),
+                    '_source': es_doc,
+                })
+        counters['rows'] += len(offices)
+        if profiler is not None:
+            profiler.record('score_injection',
+                wall_seconds=st.score_injection_seconds - score_injection_seconds, docs=len(offices))
+
+    return actions
 
 
 def add_offices(index=INDEX_NAME):
     """
-    Add offices (complete the data provided by the importer).
+    Add offices (complete the data provided by the importer), then refresh the national tops they belong to.
     """
     es = Elasticsearch(timeout=ES_TIMEOUT)
 
-    for office_to_add in db_session.query(OfficeAdminAdd).all():
+    offices_to_add = db_session.query(OfficeAdminAdd).all()
+    existing_sirets = get_existing_office_sirets([office_to_add.siret for office_to_add in offices_to_add])
 
-        office = Office.query.filter_by(siret=office_to_add.siret).first()
+    actions = []
+    rome_codes = set()
+    for office_to_add in offices_to_add:
 
         # Only create a new office if it does not already exist.
         # This guarantees that the importer data will always have precedence.
-        if not office:
-
-            # The `headcount` field of an `OfficeAdminAdd` instance has a `code` attribute.
-            if hasattr(office_to_add.headcount, 'code'):
-                headcount = office_to_add.headcount.code
-            else:
-                headcount = office_to_add.headcount
-
-            # Create the new office in DB.
-            new_office = Office()
-            # Use `inspect` because `Office` columns are named distinctly from attributes.
-            for field_name in inspect(Office).columns.keys():
-                value = getattr(office_to_add, field_name)
-                if field_name == 'headcount':
-                    value = headcount
-                setattr(new_office, field_name, value)
-            db_session.add(new_office)
-            db_session.commit()
+        if office_to_add.siret in existing_sirets:
+            continue
+        existing_sirets.add(office_to_add.siret)
+
+        # The `headcount` field of an `OfficeAdminAdd` instance has a `code` attribute.
+        if hasattr(office_to_add.headcount, 'code'):
+            headcount = office_to_add.headcount.code
+        else:
+            headcount = office_to_add.headcount
+
+        # Create the new office in DB.
+        new_office = Office()
+        # Use `inspect` because `Office` columns are named distinctly from attributes.
+        for field_name in inspect(Office).columns.keys():
+            value = getattr(office_to_add, field_name)
+            if field_name == 'headcount':
+                value = headcount
+            setattr(new_office, field_name, value)
+        new_office.save(commit=False)
+
+        # Create the new office in ES.
+        actions.append({
+            '_op_type': 'create',
+            '_index': index,
+            '_type': OFFICE_TYPE,
+            '_id': office_to_add.siret,
+            '_routing': search_util.get_office_routing(office_to_add),
+            '_source': get_office_as_es_doc(office_to_add),
+        })
+        rome_codes.update(get_rome_codes_for_naf(office_to_add.naf))
 
-            # Create the new office in ES.
-            doc = get_office_as_es_doc(office_to_add)
-            es.create(index=index, doc_type=OFFICE_TYPE, id=office_to_add.siret, body=doc)
+    # Apply all the changes in a single transaction, then in bulk.
+    db_session.commit()
+    bulk_index(es, actions)
+    create_national_tops(index, rome_codes)
 
 
 def remove_offices(index=INDEX_NAME):
     """
-    Remove offices (overload the data provided by the importer).
+    Remove offices (overload the data provided by the importer), then refresh the national tops they belonged to.
     """
     es = Elasticsearch(timeout=ES_TIMEOUT)
 
     # When returning multiple rows, the SQLAlchemy Query class can only give them out as tuples.
     # We need to unpack them explicitly.
     offices_to_remove = [siret for (siret,) in db_session.query(OfficeAdminRemove.siret).all()]
+    offices = get_offices_by_siret(offices_to_remove)
+    # Offices are routed by departement: documents are deleted with the routing they were indexed with,
+    # which is known even for offices which are no longer in the DB.
+    indexed_offices = get_indexed_office_hashes(es, index, offices_to_remove)
 
+    actions = []
+    rome_codes = set()
     for siret in offices_to_remove:
         # Apply changes in ElasticSearch.
-        try:
-            es.delete(index=index, doc_type=OFFICE_TYPE, id=siret)
-        except TransportError as e:
-            if e.status_code != 404:
-                raise
+        indexed = indexed_offices.get(siret)
+        if indexed:
+            rome_codes.update(get_rome_codes_for_naf(indexed.naf))
+            actions.append({
+                '_op_type': 'delete',
+                '_index': index,
+                '_type': OFFICE_TYPE,
+                '_id': siret,
+                '_routing': indexed.routing,
+            })
         # Apply changes in DB.
-        office = Office.query.filter_by(siret=siret).first()
+        office = offices.get(siret)
         if office:
-            office.delete()
-            # Delete the current PDF.
-            pdf_util.delete_file(office)
+            rome_codes.update(get_rome_codes_for_naf(office.naf))
+            office.delete(commit=False)
+
+    db_session.commit()
+    bulk_index(es, actions, ignore_not_found=True)
+    create_national_tops(index, rome_codes)
+
+    # Delete the current PDFs.
+    for office in offices.itervalues():
+        pdf_util.delete_file(office)
 
 
 def update_offices(index=INDEX_NAME):
     """
-    Update offices (overload the data provided by the importer).
+    Update offices (overload the data provided by the importer),
+    then refresh the national tops of the offices whose score changed.
     """
     es = Elasticsearch(timeout=ES_TIMEOUT)
 
-    for office_to_update in db_session.query(OfficeAdminUpdate).all():
+    offices_to_update = db_session.query(OfficeAdminUpdate).all()
+    offices = get_offices_by_siret([office_to_update.siret for office_to_update in offices_to_update])
+
+    actions = []
+    updated_offices = []
+    rome_codes = set()
+    for office_to_update in offices_to_update:
 
-        office = Office.query.filter_by(siret=office_to_update.siret).first()
+        office = offices.get(office_to_update.siret)
 
         if office:
 
@@ -505,17 +938,253 @@ def update_offices(index=INDEX_NAME):
                 office_to_update.new_website or office.website)
             if office_to_update.new_score:
                 office.score = office_to_update.new_score
-            office.save()
+            office.save(commit=False)
+            updated_offices.append(office)
 
             # Apply changes in ElasticSearch.
             body = {'doc': {'email': office.email, 'phone': office.tel, 'website': office.website}}
             if office_to_update.new_score:
                 body['doc']['score'] = office_to_update.new_score
+                body['doc']['boosted'] = int(office_to_update.new_score == 100)
                 body['doc'] = inject_office_rome_scores_into_es_doc(office, body['doc'])
-            es.update(index=index, doc_type=OFFICE_TYPE, id=office_to_update.siret, body=body, ignore=404)
+                rome_codes.update(get_rome_codes_for_naf(office.naf))
+            actions.append({
+                '_op_type': 'update',
+                '_index': index,
+                '_type': OFFICE_TYPE,
+                '_id': office_to_update.siret,
+                '_routing': search_util.get_office_routing(office),
+                '_source': body,
+            })
+
+    db_session.commit()
+    bulk_index(es, actions, ignore_not_found=True)
+    create_national_tops(index, rome_codes)
+
+    # Delete the current PDFs, they will be regenerated at next download attempt.
+    for office in updated_offices:
+        pdf_util.delete_file(office)
+
+
+def get_offices_by_siret(sirets):
+    """
+    Return the `{siret: office}` of the existing offices among the given sirets, in a single query.
+    """
+    if not sirets:
+        return {}
+    return {office.siret: office for office in Office.query.filter(Office.siret.in_(sirets))}
+
+
+def get_existing_office_sirets(sirets):
+    """
+    Return the set of the existing offices sirets among the given sirets, in a single query.
+    """
+    if not sirets:
+        return set()
+    return set(siret for (siret,) in db_session.query(Office.siret).filter(Office.siret.in_(sirets)))
+
+
+def create_national_tops(index=INDEX_NAME, rome_codes=None):
+    """
+    Create the `national_top` type in ElasticSearch: for each rome_code, the count of offices of
+    metropolitan France having a score for this rome_code and at most NATIONAL_TOP_OFFICES_PER_ROME best ones.
+
+    "France entière" searches without any other filter are answered from it (see search.is_national_search)
+    instead of sorting the whole index.
+    It has to be created once all the offices are indexed, then refreshed whenever offices change:
+    only the national tops of the given `rome_codes` are created again, if any.
+
+    Searches order offices having the same stars by their shuffle key of the day, which can only
+    be reproduced for a whole group of offices having the same stars: the offices having the last stars
+    of a full top are left out of it, as they may only be a part of their group.
+    """
+    if rome_codes is None:
+        rome_codes = settings.ROME_DESCRIPTIONS.keys()
+    else:
+        rome_codes = sorted(rome_code for rome_code in rome_codes if rome_code in settings.ROME_DESCRIPTIONS)
+    if not rome_codes:
+        return
+    logging.info("creating national tops of %s rome codes...", len(rome_codes))
+    es = Elasticsearch(timeout=ES_TIMEOUT)
+    es.indices.refresh(index=index)
+    actions = []
+
+    for rome_code in rome_codes:
+        body = {
+            "size": NATIONAL_TOP_OFFICES_PER_ROME,
+            "_source": ["siret", "score", "location"],
+            "sort": [
+                search_util.build_score_sort(rome_code),
+                {"siret": {"order": "asc"}},
+            ],
+            "query": {
+                "filtered": {
+                    "filter": {
+                        "bool": {
+                            "must": [
+                                search_util.build_score_for_rome_filter(rome_code),
+                                search_util.build_bounding_box_filter(search_util.METROPOLITAN_FRANCE_BOUNDING_BOX),
+                            ]
+                        }
+                    }
+                }
+            }
+        }
+        res = es.search(index=index, doc_type=OFFICE_TYPE, body=body)
+        offices = [{
+            'siret': hit['_source']['siret'],
+            'score': hit['sort'][0],
+            'boosted': hit['_source']['score'] == 100,
+            'lat': hit['_source']['location']['lat'],
+            'lon': hit['_source']['location']['lon'],
+        } for hit in res['hits']['hits']]
+        if offices and res['hits']['total'] > len(offices):
+            last_score = offices[-1]['score']
+            offices = [office for office in offices if office['score'] != last_score]
+        actions.append({
+            '_op_type': 'index',
+            '_index': index,
+            '_type': search_util.NATIONAL_TOP_TYPE,
+            '_id': rome_code,
+            '_source': {
+                'rome_code': rome_code,
+                'office_count': res['hits']['total'],
+                'offices': offices,
+            },
+        })
+
+    # national tops are large documents
+    bulk_index(es, actions, chunk_size=50)
+
+
+def get_indexed_office_hashes(es, index, sirets=None):
+    """
+    Return the `{siret: IndexedOffice}` of the offices currently in the index,
+    or only of the given `sirets` which are in the index.
+    """
+    if sirets is None:
+        query = {"match_all": {}}
+    elif not sirets:
+        return {}
+    else:
+        query = {"ids": {"type": OFFICE_TYPE, "values": list(sirets)}}
+    body = {
+        "query": query,
+        "fields": ["_routing", "content_hash", "row_hash", "naf"],
+    }
+    hashes = {}
+    for hit in scan(es, index=index, doc_type=OFFICE_TYPE, query=body, size=5000):
+        fields = hit.get('fields', {})
+        routing = hit.get('_routing', fields.get('_routing'))
+        # non-metadata fields are returned as lists
+        content_hash, row_hash, naf = [
+            value[0] if isinstance(value, list) else value
+            for value in [fields.get('content_hash'), fields.get('row_hash'), fields.get('naf')]
+        ]
+        hashes[hit['_id']] = IndexedOffice(content_hash, row_hash, routing, naf)
+    return hashes
+
+
+def get_changed_office_sirets(indexed_hashes):
+    """
+    Return the sirets of the offices of the DB whose row changed since they were indexed, or which are not indexed,
+    by comparing the hash of their row (see get_office_row_hash) without building their document.
+    The offices overridden by admins are always returned: update_offices only sends partial documents,
+    which leaves the hashes of their documents outdated.
+    The unchanged offices are removed from `indexed_hashes`. Return the changed sirets and the count of unchanged offices.
+    """
+    override_sirets = set(siret for (siret,) in db_session.query(OfficeAdminAdd.siret))
+    override_sirets.update(siret for (siret,) in db_session.query(OfficeAdminUpdate.siret))
+
+    columns = [getattr(Office, field) for field in OFFICE_ROW_HASH_FIELDS]
+    changed_sirets = []
+    unchanged_count = 0
+    for row in db_session.query(*columns):
+        siret = row[0]
+        indexed = indexed_hashes.get(siret)
+        if not indexed or indexed.row_hash != get_office_row_hash(row) or siret in override_sirets:
+            changed_sirets.append(siret)
+        else:
+            del indexed_hashes[siret]
+            unchanged_count += 1
+    return changed_sirets, unchanged_count
+
+
+def sync_offices(index=INDEX_NAME):
+    """
+    Incrementally bring the `office` type in line with the DB, instead of rebuilding it:
+    only the offices added, changed or deleted since they were indexed are sent to ElasticSearch.
+
+    Only the rows of the DB are read to find the offices which changed (see get_changed_office_sirets):
+    documents are built for these offices only, then the ones whose content hash did not change are not sent.
+    Offices which are not reachable by any search are removed, as in a full rebuild. As they are not indexed,
+    their documents are built again at each sync. A change of the scoring or of the NAF/ROME mapping is not detected:
+    it needs a full rebuild.
+    The national tops of the offices added, updated or deleted are then refreshed.
+    Return the counts of added, updated, deleted and unchanged offices.
+    """
+    es = Elasticsearch(timeout=ES_TIMEOUT)
 
-            # Delete the current PDF, it will be regenerated at next download attempt.
-            pdf_util.delete_file(office)
+    logging.info("syncing offices...")
+    indexed_hashes = get_indexed_office_hashes(es, index)
+    logging.info("%s offices currently indexed", len(indexed_hashes))
+
+    changed_sirets, unchanged_count = get_changed_office_sirets(indexed_hashes)
+    logging.info("%s offices changed in DB", len(changed_sirets))
+
+    counts = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': unchanged_count}
+    actions = []
+    rome_codes = set()
+    for start in range(0, len(changed_sirets), SYNC_CHUNK_SIZE):
+        for office in get_offices_by_siret(changed_sirets[start:start + SYNC_CHUNK_SIZE]).itervalues():
+            es_doc = get_office_as_es_doc(office)
+            if not is_office_reachable(es_doc):
+                continue
+            indexed = indexed_hashes.pop(office.siret, None)
+            if indexed and (indexed.content_hash, indexed.row_hash) == (es_doc['content_hash'], es_doc['row_hash']):
+                counts['unchanged'] += 1
+                continue
+            counts['updated' if indexed else 'added'] += 1
+            rome_codes.update(get_rome_codes_for_naf(office.naf))
+            if indexed:
+                rome_codes.update(get_rome_codes_for_naf(indexed.naf))
+            routing = search_util.get_office_routing(office)
+            if indexed and indexed.routing != routing:
+                # The office moved to another departement: its document lives in another shard.
+                actions.append({
+                    '_op_type': 'delete',
+                    '_index': index,
+                    '_type': OFFICE_TYPE,
+                    '_id': office.siret,
+                    '_routing': indexed.routing,
+                })
+            actions.append({
+                '_op_type': 'index',
+                '_index': index,
+                '_type': OFFICE_TYPE,
+                '_id': office.siret,
+                '_routing': routing,
+                '_source': es_doc,
+            })
+
+    # The remaining indexed offices are no longer in the DB (or are no longer reachable).
+    for siret, indexed in indexed_hashes.iteritems():
+        counts['deleted'] += 1
+        rome_codes.update(get_rome_codes_for_naf(indexed.naf))
+        actions.append({
+            '_op_type': 'delete',
+            '_index': index,
+            '_type': OFFICE_TYPE,
+            '_id': siret,
+            '_routing': indexed.routing,
+        })
+
+    bulk_index(es, actions, ignore_not_found=True)
+    create_national_tops(index, rome_codes)
+
+    logging.info("synced offices: %(added)s added, %(updated)s updated, %(deleted)s deleted, "
+        "%(unchanged)s unchanged", counts)
+    return counts
 
 
 def display_performance_stats():
@@ -537,22 +1206,44 @@ def display_performance_stats():
 def run():
     parser = argparse.ArgumentParser(description="Update etablissement data with geographic coordinates")
     parser.add_argument('-d', '--drop-indexes', dest='drop_indexes', help="Drop indexs before updating documents")
+    parser.add_argument('-s', '--sync-offices', dest='sync_offices', action='store_true',
+        help="Only send the offices which changed in DB since they were indexed")
+    parser.add_argument('-p', '--profiling-report', dest='profiling_report', default=settings.INDEX_PROFILING_REPORT_FILENAME,
+        help="JSON profiling report of the build, compared to the one of the previous build")
     args = parser.parse_args()
 
+    global profiler
+    if args.drop_indexes:
+        profiler = BuildProfiler('drop_indexes')
+    elif args.sync_offices:
+        profiler = BuildProfiler('sync')
+    else:
+        profiler = BuildProfiler('default')
+
     if args.drop_indexes:
         logging.info("drop index")
         drop_and_create_index()
         create_offices(ignore_unreachable_offices=True)
         create_job_codes()
         create_locations()
+        with profiled_phase('refresh'):
+            Elasticsearch(timeout=ES_TIMEOUT).indices.refresh(index=INDEX_NAME)
+        with profiled_phase('national_tops'):
+            create_national_tops()
 
     # Upon requests received from employers we can add, remove or update offices.
     # This permits us to complete or overload the data provided by the importer.
-    add_offices()
-    remove_offices()
-    update_offices()
+    with profiled_phase('admin_overrides'):
+        add_offices()
+        remove_offices()
+        update_offices()
+
+    if args.sync_offices and not args.drop_indexes:
+        with profiled_phase('sync'):
+            sync_offices()
 
     display_performance_stats()
+    write_profiling_report(profiler.get_report(), args.profiling_report)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,6 @@
 # coding: utf8
 
 from datetime import datetime
-import operator
 import os
 from flask import Flask, render_template
 from flask_script import Manager
@@ -24,9 +23,7 @@ def sitemap():
     now = datetime.now()
     now_str = now.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-    cities = geocoding.load_coordinates_for_cities()
-    cities = [city for city in cities if city[2][-2:] == "00"]
-    top_cities = [(slugify(l[1].lower()), l[2]) for l in sorted(cities, key=operator.itemgetter(3), reverse=True)[:94]]
+    top_cities = [(slugify(l[1].lower()), l[2]) for l in geocoding.load_top_cities(94)]
 
     rome_descriptions = settings.ROME_DESCRIPTIONS.values()
 
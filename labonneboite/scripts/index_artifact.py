@@ -0,0 +1,204 @@
+# coding: utf8
+"""
+Offline artifact of the index: the importer builds the ready-to-index documents once, web servers restore them.
+
+An artifact is a directory made of:
+- one gzipped JSON lines file of bulk actions per document type (`office.jsonl.gz`, `ogr.jsonl.gz`...)
+- a `manifest.json` file holding the version of the artifact, the mapping of the index,
+  and the count of documents and SHA-256 checksum of each file.
+
+Restoring an artifact does not need to build any document: it is I/O bound and gives the same index every time.
+It is restored into a new index, which the index name is then switched to as an alias, without any downtime.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+
+from elasticsearch import Elasticsearch
+
+from labonneboite.conf import settings
+from labonneboite.scripts import create_index as script
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+ARTIFACT_FORMAT = 1
+MANIFEST_FILENAME = 'manifest.json'
+
+
+class ArtifactException(Exception):
+    pass
+
+
+def get_file_checksum(filename):
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def write_actions(filename, actions):
+    """
+    Write the bulk actions into a gzipped JSON lines file, without their target index.
+    Return the number of actions written.
+    """
+    count = 0
+    with gzip.open(filename, 'wb') as f:
+        for action in actions:
+            action = {key: value for key, value in action.iteritems() if key not in ['_index', '_op_type']}
+            f.write(json.dumps(action) + '\n')
+            count += 1
+    return count
+
+
+def read_actions(filename, index):
+    """
+    Yield the bulk actions of a file written by write_actions, targeting the given index.
+    """
+    with gzip.open(filename, 'rb') as f:
+        for line in f:
+            action = json.loads(line)
+            action['_op_type'] = 'index'
+            action['_index'] = index
+            yield action
+
+
+def export_artifact(output_folder, offices=None):
+    """
+    Build the documents of the index into a new artifact in `output_folder`.
+    The office documents are built from the given `offices` (see create_index.get_offices_actions),
+    or from the offices of the DB by default.
+    Return the path of the artifact.
+    """
+    version = datetime.now().strftime('%Y_%m_%d_%H%M%S')
+    path = os.path.join(output_folder, 'index_%s' % version)
+    os.makedirs(path)
+
+    files = {}
+    for doc_type, get_actions in [
+            ('ogr', script.get_job_codes_actions),
+            ('location', script.get_locations_actions),
+            (script.OFFICE_TYPE, lambda: script.get_offices_actions(ignore_unreachable_offices=True, offices=offices)),
+    ]:
+        filename = '%s.jsonl.gz' % doc_type
+        logging.info("exporting %s documents...", doc_type)
+        count = write_actions(os.path.join(path, filename), get_actions())
+        files[filename] = {
+            'count': count,
+            'sha256': get_file_checksum(os.path.join(path, filename)),
+        }
+        logging.info("exported %s %s documents", count, doc_type)
+
+    manifest = {
+        'format': ARTIFACT_FORMAT,
+        'version': version,
+        'compact_scores_for_rome': settings.ES_COMPACT_SCORES_FOR_ROME,
+        'mapping': script.request_body,
+        'files': files,
+    }
+    with open(os.path.join(path, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    logging.info("artifact %s created", path)
+    return path
+
+
+def load_manifest(path):
+    """
+    Return the manifest of an artifact, once the checksums of its files have been verified.
+    """
+    with open(os.path.join(path, MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+    if manifest['format'] != ARTIFACT_FORMAT:
+        raise ArtifactException("unsupported artifact format %s" % manifest['format'])
+    if manifest['compact_scores_for_rome'] != settings.ES_COMPACT_SCORES_FOR_ROME:
+        raise ArtifactException("the layout of scores of the artifact does not match ES_COMPACT_SCORES_FOR_ROME")
+    for filename, description in manifest['files'].iteritems():
+        if get_file_checksum(os.path.join(path, filename)) != description['sha256']:
+            raise ArtifactException("invalid checksum for %s" % filename)
+    return manifest
+
+
+def switch_alias(es, alias, index):
+    """
+    Point the `alias` to the `index` only, then delete the indexes it pointed to.
+    Searches keep being served by the previous index until the alias is switched, in a single atomic request.
+    """
+    if es.indices.exists_alias(name=alias):
+        previous_indexes = es.indices.get_alias(name=alias).keys()
+    else:
+        previous_indexes = []
+        # An index built by create_index has the name of the alias: it has to be deleted first,
+        # which leaves no index to search for a moment, once only.
+        if es.indices.exists(index=alias):
+            logging.info("deleting index %s to replace it by an alias...", alias)
+            es.indices.delete(index=alias)
+
+    actions = [{"remove": {"index": previous_index, "alias": alias}} for previous_index in previous_indexes]
+    actions.append({"add": {"index": index, "alias": alias}})
+    es.indices.update_aliases(body={"actions": actions})
+    logging.info("alias %s switched to index %s", alias, index)
+
+    for previous_index in previous_indexes:
+        if previous_index != index:
+            es.indices.delete(index=previous_index, ignore=[404])
+
+
+def restore_artifact(path, index=script.INDEX_NAME, concurrency=script.BULK_CONCURRENCY):
+    """
+    Restore the documents of the artifact into a new index, apply the admin overrides
+    and create the national tops in it, then switch the `index` alias to it (see switch_alias).
+    Return the name of the new index.
+    """
+    manifest = load_manifest(path)
+    # Named after the time of the restoration, as the same artifact can be restored again.
+    new_index = '%s_%s' % (index, datetime.now().strftime('%Y_%m_%d_%H%M%S_%f'))
+    logging.info("restoring artifact %s into index %s...", manifest['version'], new_index)
+
+    es = Elasticsearch(timeout=script.ES_TIMEOUT)
+    es.indices.create(index=new_index, body=manifest['mapping'])
+
+    for filename, description in sorted(manifest['files'].iteritems()):
+        logging.info("restoring %s...", filename)
+        stats = script.bulk_index(es, read_actions(os.path.join(path, filename), new_index), concurrency=concurrency)
+        if stats['indexed'] != description['count']:
+            raise ArtifactException("%s of %s documents of %s were restored" % (
+                stats['indexed'], description['count'], filename))
+
+    # Upon requests received from employers we can add, remove or update offices, see create_index.run.
+    script.add_offices(index=new_index)
+    script.remove_offices(index=new_index)
+    script.update_offices(index=new_index)
+    script.create_national_tops(index=new_index)
+
+    switch_alias(es, index, new_index)
+    return new_index
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Export or restore an offline artifact of the index")
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export', help="Build the documents of the index into a new artifact")
+    export_parser.add_argument('output_folder', help="Folder of the new artifact")
+    restore_parser = subparsers.add_parser('restore', help="Restore an artifact into the index")
+    restore_parser.add_argument('path', help="Path of the artifact")
+    restore_parser.add_argument('-i', '--index', dest='index', default=script.INDEX_NAME,
+        help="Alias switched to the restored index")
+    restore_parser.add_argument('-c', '--concurrency', dest='concurrency', type=int,
+        default=script.BULK_CONCURRENCY, help="Number of concurrent bulk requests")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_artifact(args.output_folder)
+        return
+
+    restore_artifact(args.path, index=args.index, concurrency=args.concurrency)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,213 @@
+# coding: utf8
+"""
+Warm up the caches of a newly built index by replaying popular searches against it,
+so that traffic can be switched over to it once its caches are hot.
+
+Popular searches are either the most frequent ones of an access log,
+or the searches of the sitemap (most populated cities x ROME codes).
+"""
+import argparse
+import collections
+import logging
+import math
+import re
+import sys
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from elasticsearch import Elasticsearch
+
+from labonneboite.common import geocoding
+from labonneboite.common import mapping as mapping_util
+from labonneboite.common import search
+from labonneboite.conf import settings
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+ES_TIMEOUT = 30
+
+# A search replayed to warm up the caches.
+Search = collections.namedtuple('Search', ['rome', 'zipcode', 'distance', 'sort'])
+
+# e.g. "GET /entreprises/metz-57000/boucherie?d=30&sort=distance HTTP/1.1"
+RESULTS_URL_REGEXP = re.compile(
+    r'GET /entreprises/(?P<city>[^/?\s]+)-(?P<zipcode>\d{5})/(?P<occupation>[^/?\s]+)(\?(?P<query>\S*))?\s'
+)
+
+
+class RateLimiter(object):
+    """
+    Lets at most `rate` calls per second go through `wait`, whatever the number of threads calling it.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            wait_until = max(now, self.next_time)
+            self.next_time = wait_until + self.interval
+        time.sleep(wait_until - now)
+
+
+def get_searches_from_sitemap(count):
+    """
+    Returns the first `count` searches of the sitemap, most populated cities first.
+    """
+    searches = []
+    rome_codes = sorted(settings.ROME_DESCRIPTIONS.keys())
+    for city in geocoding.load_top_cities(count):
+        zipcode = city[2]
+        for rome in rome_codes:
+            searches.append(Search(rome, zipcode, settings.DISTANCE_FILTER_DEFAULT, settings.SORT_FILTER_DEFAULT))
+            if len(searches) == count:
+                return searches
+    return searches
+
+
+def parse_access_log_line(line):
+    """
+    Returns the search of the results page requested by an access log line, None for any other line.
+    """
+    match = RESULTS_URL_REGEXP.search(line)
+    if not match:
+        return None
+    rome = mapping_util.SLUGIFIED_ROME_LABELS.get(match.group('occupation'))
+    if not rome:
+        return None
+    params = urlparse.parse_qs(match.group('query') or '')
+    try:
+        distance = int(params['d'][0])
+    except (KeyError, ValueError):
+        distance = settings.DISTANCE_FILTER_DEFAULT
+    sort = params.get('sort', [settings.SORT_FILTER_DEFAULT])[0]
+    if sort not in ['distance', 'score']:
+        sort = settings.SORT_FILTER_DEFAULT
+    return Search(rome, match.group('zipcode'), distance, sort)
+
+
+def get_searches_from_access_log(filename, count):
+    """
+    Returns the `count` most frequent searches of an access log, most frequent first.
+    """
+    counter = collections.Counter()
+    with open(filename) as f:
+        for line in f:
+            searched = parse_access_log_line(line)
+            if searched:
+                counter[searched] += 1
+    return [searched for searched, _ in counter.most_common(count)]
+
+
+def get_percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of already sorted values.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def replay_search(es, index, searched, coordinates):
+    """
+    Runs the Elasticsearch request of the first results page of a search.
+    Returns its duration in seconds, None if it could not be run.
+    """
+    try:
+        latitude, longitude = coordinates[searched.zipcode]
+    except KeyError:
+        logging.info("unknown zipcode %s", searched.zipcode)
+        return None
+    naf_codes = mapping_util.Rome2NafMapper().map([searched.rome])
+    # Same request as the results page, see search.Fetcher.
+    json_body = search.build_json_body_elastic_search(
+        naf_codes, latitude, longitude, searched.distance,
+        from_number=1, to_number=settings.PAGINATION_COMPANIES_PER_PAGE,
+        sort=searched.sort, rome_code=searched.rome, facets=True)
+    start = time.time()
+    try:
+        es.search(index=index, doc_type="office", body=json_body,
+            routing=search.get_routing(latitude, longitude, searched.distance))
+    except Exception as e:
+        logging.info("search %s failed: %s", searched, e)
+        return None
+    return time.time() - start
+
+
+def warm_up(searches, index, concurrency, rate):
+    """
+    Replays the searches with `concurrency` threads, at most `rate` searches per second.
+    Returns the sorted durations of the successful searches, and the count of failed ones.
+    """
+    es = Elasticsearch(timeout=ES_TIMEOUT)
+    coordinates = geocoding.load_coordinates()
+    rate_limiter = RateLimiter(rate)
+
+    def replay(searched):
+        rate_limiter.wait()
+        return replay_search(es, index, searched, coordinates)
+
+    pool = ThreadPool(concurrency)
+    try:
+        durations = pool.map(replay, searches)
+    finally:
+        pool.close()
+        pool.join()
+
+    error_count = len([duration for duration in durations if duration is None])
+    return sorted(duration for duration in durations if duration is not None), error_count
+
+
+def display_latency_stats(durations, error_count, elapsed):
+    logging.info("replayed %s searches in %.1fs (%s errors)", len(durations) + error_count, elapsed, error_count)
+    if durations:
+        logging.info("latency (ms): p50=%.0f p90=%.0f p99=%.0f max=%.0f",
+            get_percentile(durations, 50) * 1000,
+            get_percentile(durations, 90) * 1000,
+            get_percentile(durations, 99) * 1000,
+            durations[-1] * 1000,
+            )
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Warm up the caches of an index by replaying popular searches")
+    parser.add_argument('-i', '--index', dest='index', default=settings.ES_INDEX, help="Index to warm up")
+    parser.add_argument('-n', '--count', dest='count', type=int, default=1000, help="Number of searches to replay")
+    parser.add_argument('-l', '--access-log', dest='access_log',
+        help="Access log to read popular searches from, instead of the sitemap searches")
+    parser.add_argument('-c', '--concurrency', dest='concurrency', type=int, default=4,
+        help="Number of concurrent searches")
+    parser.add_argument('-r', '--rate', dest='rate', type=float, default=50, help="Maximum searches per second")
+    parser.add_argument('-p', '--passes', dest='passes', type=int, default=2, help="Number of times to replay searches")
+    parser.add_argument('--max-p90', dest='max_p90', type=float,
+        help="Exit with an error if the p90 latency (ms) of the last pass is higher")
+    args = parser.parse_args()
+
+    if args.access_log:
+        searches = get_searches_from_access_log(args.access_log, args.count)
+    else:
+        searches = get_searches_from_sitemap(args.count)
+    logging.info("warming up index %s with %s searches", args.index, len(searches))
+
+    durations = []
+    for current_pass in range(1, args.passes + 1):
+        logging.info("pass %s...", current_pass)
+        start = time.time()
+        durations, error_count = warm_up(searches, args.index, args.concurrency, args.rate)
+        display_latency_stats(durations, error_count, time.time() - start)
+
+    if args.max_p90 and durations and get_percentile(durations, 90) * 1000 > args.max_p90:
+        logging.info("caches are not hot yet: p90 latency is higher than %sms", args.max_p90)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
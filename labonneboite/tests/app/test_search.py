@@ -1,4 +1,5 @@
 # coding: utf8
+import threading
 import unittest
 
 from labonneboite.common import search
@@ -18,3 +19,139 @@ class ElasticTest(unittest.TestCase):
         lon = 6.327310
         siret_list = self.search_in_naf(naf, lat, lon)
         self.assertNotIn(siret, siret_list)
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_cursor_round_trip(self):
+        search_after = [72, 0, 12345, u'00000000000001']
+        cursor = search.encode_cursor('score', search_after, 11)
+        self.assertEqual(search.decode_cursor(cursor), ('score', search_after, 11))
+
+    def test_cursor_without_siret_is_invalid(self):
+        cursor = search.encode_cursor('score', [72, 3], 11)
+        with self.assertRaises(search.CursorException):
+            search.decode_cursor(cursor)
+
+    def test_keyset_filter_breaks_ties_by_siret(self):
+        keyset_filter = search.build_keyset_filter('distance', None, 49, 6, [1.5, 12345, u'00000000000001'])
+        after_filters = keyset_filter['bool']['should']
+        self.assertEqual(len(after_filters), 3)
+        # offices at the same distance, with the same shuffle key, and a greater siret
+        self.assertEqual(after_filters[-1]['bool']['must'][-1], {'range': {'siret': {'gt': u'00000000000001'}}})
+        self.assertEqual(after_filters[-1]['bool']['must'][1], {
+            'range': {search.get_shuffle_key_field(): {'gte': 12345, 'lte': 12345}},
+        })
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_concurrent_identical_calls_are_coalesced(self):
+        single_flight = search.SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow_search():
+            calls.append(1)
+            release.wait()
+            return [u'00000000000001']
+
+        def run():
+            results.append(single_flight.run('key', slow_search))
+
+        threads = [threading.Thread(target=run) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # wait for every thread to either run the call or wait for it
+        while 'key' not in single_flight.calls or len(calls) + single_flight.calls['key'].waiting_count < 5:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[u'00000000000001']] * 5)
+        self.assertEqual(single_flight.calls, {})
+
+    def test_exception_is_shared_and_not_cached(self):
+        single_flight = search.SingleFlight()
+
+        def failing_search():
+            raise ValueError("elasticsearch is down")
+
+        with self.assertRaises(ValueError):
+            single_flight.run('key', failing_search)
+        self.assertEqual(single_flight.run('key', lambda: 42), 42)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def failing_call(self):
+        raise IOError("elasticsearch is down")
+
+    def test_circuit_opens_after_failures_and_recovers(self):
+        circuit_breaker = search.CircuitBreaker(
+            window=4,
+            failure_ratio=0.5,
+            slow_call_duration=10,
+            open_duration=0,
+            failure_exceptions=(IOError,),
+        )
+        for call in [lambda: 1, lambda: 2, self.failing_call]:
+            try:
+                circuit_breaker.call(call)
+            except IOError:
+                pass
+        self.assertEqual(circuit_breaker.get_state(), search.CircuitBreaker.CLOSED)
+
+        with self.assertRaises(IOError):
+            circuit_breaker.call(self.failing_call)
+        # the open duration is over right away: the next call is a probe
+        self.assertEqual(circuit_breaker.get_state(), search.CircuitBreaker.HALF_OPEN)
+
+        with self.assertRaises(IOError):
+            circuit_breaker.call(self.failing_call)
+        self.assertEqual(circuit_breaker.get_state(), search.CircuitBreaker.HALF_OPEN)
+
+        self.assertEqual(circuit_breaker.call(lambda: 42), 42)
+        self.assertEqual(circuit_breaker.get_state(), search.CircuitBreaker.CLOSED)
+
+    def test_open_circuit_fails_fast(self):
+        circuit_breaker = search.CircuitBreaker(
+            window=1,
+            failure_ratio=1,
+            slow_call_duration=10,
+            open_duration=60,
+            failure_exceptions=(IOError,),
+        )
+        with self.assertRaises(IOError):
+            circuit_breaker.call(self.failing_call)
+        self.assertEqual(circuit_breaker.get_state(), search.CircuitBreaker.OPEN)
+        with self.assertRaises(search.CircuitOpenException):
+            circuit_breaker.call(lambda: 42)
+
+    def test_stale_result_cache_keeps_most_recently_used(self):
+        cache = search.StaleResultCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+
+class RoutingTest(unittest.TestCase):
+
+    def test_routing_covers_departements_around_location(self):
+        # Metz, 30km.
+        routing = search.get_routing(49.1196, 6.1764, 30).split(",")
+        self.assertIn("57", routing)
+        self.assertIn("54", routing)
+        self.assertNotIn("75", routing)
+        self.assertNotIn("13", routing)
+
+    def test_routing_queries_all_shards_for_large_distances(self):
+        self.assertIsNone(search.get_routing(49.1196, 6.1764, 200))
+        self.assertIsNone(search.get_routing(49.1196, 6.1764, search.NATIONAL_DISTANCE))
@@ -1,8 +1,11 @@
 # coding: utf8
 
 import time
+import unittest
 
+from labonneboite.common import search as search_util
 from labonneboite.common.models import Office, OfficeAdminAdd, OfficeAdminRemove, OfficeAdminUpdate
+from labonneboite.conf import settings
 from labonneboite.scripts import create_index as script
 from labonneboite.tests.test_base import DatabaseTest
 
@@ -51,7 +54,8 @@ class CreateIndexBaseTest(DatabaseTest):
         count = self.es.count(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body={'query': {'match_all': {}}})
         self.assertEquals(count['count'], 1)
         # Ensure that the office is the one that has been indexed in ES.
-        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=self.office.siret)
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=self.office.siret,
+            routing=search_util.get_office_routing(self.office))
         self.assertEquals(res['_source']['email'], self.office.email)
 
     def tearDown(self):
@@ -130,7 +134,8 @@ class AddOfficesTest(CreateIndexBaseTest):
         self.assertEquals(office.tel, u"")
         self.assertEquals(office.website, u"")
 
-        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=office_to_add.siret)
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=office_to_add.siret,
+            routing=search_util.get_office_routing(office_to_add))
         self.assertEquals(res['_source']['siret'], office.siret)
         self.assertEquals(res['_source']['score'], office.score)
 
@@ -162,6 +167,34 @@ class RemoveOfficesTest(CreateIndexBaseTest):
         count = self.es.count(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body={'query': {'match_all': {}}})
         self.assertEquals(count['count'], 0)
 
+    def test_remove_offices_including_unknown_office(self):
+        """
+        Test `remove_offices` to delete offices in bulk, one of them being unknown.
+        """
+        for siret in [self.office.siret, u"00000000000000"]:
+            OfficeAdminRemove(siret=siret, name=u"N/A", reason=u"N/A", initiative=False).save()
+
+        script.remove_offices(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        self.assertEquals(Office.query.count(), 0)
+        count = self.es.count(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body={'query': {'match_all': {}}})
+        self.assertEquals(count['count'], 0)
+
+    def test_remove_office_no_longer_in_db(self):
+        """
+        Test `remove_offices` to delete an office which is still indexed but no longer in the DB.
+        """
+        self.office.delete()
+        OfficeAdminRemove(siret=self.office.siret, name=u"N/A", reason=u"N/A", initiative=False).save()
+
+        script.remove_offices(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        # The office was deleted with the routing it was indexed with.
+        count = self.es.count(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body={'query': {'match_all': {}}})
+        self.assertEquals(count['count'], 0)
+
 
 class UpdateOfficesTest(CreateIndexBaseTest):
     """
@@ -194,7 +227,8 @@ class UpdateOfficesTest(CreateIndexBaseTest):
         self.assertEquals(office.tel, self.office.tel)  # This value should not be modified.
         self.assertEquals(office.website, office_to_update.new_website)
 
-        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=office.siret)
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=office.siret,
+            routing=search_util.get_office_routing(office))
         self.assertEquals(res['_source']['email'], office.email)
         self.assertEquals(res['_source']['phone'], office.tel)
         self.assertEquals(res['_source']['score'], office.score)
@@ -223,8 +257,236 @@ class UpdateOfficesTest(CreateIndexBaseTest):
         self.assertEquals(office.tel, u'')
         self.assertEquals(office.website, u'')
 
-        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=office.siret)
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=office.siret,
+            routing=search_util.get_office_routing(office))
         self.assertEquals(res['_source']['email'], u'')
         self.assertEquals(res['_source']['phone'], u'')
         self.assertEquals(res['_source']['website'], u'')
         self.assertEquals(res['_source']['score'], self.office.score)
+
+
+class BulkIndexTest(CreateIndexBaseTest):
+    """
+    Test bulk_index().
+    """
+
+    def test_bulk_index_reports_failed_documents(self):
+        actions = [{
+            '_op_type': 'index',
+            '_index': self.ES_TEST_INDEX,
+            '_type': 'ogr',
+            '_id': i,
+            '_source': {'ogr_code': str(i), 'ogr_description': u"Boucher", 'rome_code': u"D1101"},
+        } for i in range(1, 11)]
+        # The `score` of an office has to be an integer.
+        actions.append({
+            '_op_type': 'index',
+            '_index': self.ES_TEST_INDEX,
+            '_type': self.ES_OFFICE_TYPE,
+            '_id': u"00000000000000",
+            '_source': {'siret': u"00000000000000", 'score': u"not a number"},
+        })
+
+        stats = script.bulk_index(self.es, actions, chunk_size=3, concurrency=2)
+
+        self.assertEquals(stats, {'indexed': 10, 'failed': 1, 'rejected': 0, 'retried': 0})
+
+
+class SyncOfficesTest(CreateIndexBaseTest):
+    """
+    Test sync_offices().
+    """
+
+    def test_sync_unchanged_offices(self):
+        counts = script.sync_offices(index=self.ES_TEST_INDEX)
+        self.assertEquals(counts, {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 1})
+
+    def test_sync_does_not_build_unchanged_rows(self):
+        routing = search_util.get_office_routing(self.office)
+        self.es.update(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=self.office.siret,
+            routing=routing, body={'doc': {'content_hash': u"outdated"}})
+
+        counts = script.sync_offices(index=self.ES_TEST_INDEX)
+
+        # The row of the office did not change: its document is neither built nor sent again.
+        self.assertEquals(counts, {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 1})
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=self.office.siret,
+            routing=routing)
+        self.assertEquals(res['_source']['content_hash'], u"outdated")
+
+    def test_sync_changed_offices(self):
+        self.office.email = u"contact@match.com"
+        self.office.save()
+
+        counts = script.sync_offices(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        self.assertEquals(counts, {'added': 0, 'updated': 1, 'deleted': 0, 'unchanged': 0})
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=self.office.siret,
+            routing=search_util.get_office_routing(self.office))
+        self.assertEquals(res['_source']['email'], u"contact@match.com")
+
+    def test_sync_office_moved_to_another_departement(self):
+        old_routing = search_util.get_office_routing(self.office)
+        self.office.city_code = u"54395"
+        self.office.zipcode = u"54000"
+        self.office.departement = u"54"
+        self.office.x = 6.18496
+        self.office.y = 48.6921
+        self.office.save()
+        new_routing = search_util.get_office_routing(self.office)
+        self.assertNotEquals(old_routing, new_routing)
+
+        counts = script.sync_offices(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        self.assertEquals(counts, {'added': 0, 'updated': 1, 'deleted': 0, 'unchanged': 0})
+        # The document under the old routing was removed: the office is indexed once.
+        count = self.es.count(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body={'query': {'match_all': {}}})
+        self.assertEquals(count['count'], 1)
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=self.office.siret,
+            routing=new_routing)
+        self.assertEquals(res['_source']['location'], {'lat': 48.6921, 'lon': 6.18496})
+
+    def test_sync_deleted_offices(self):
+        self.office.delete()
+
+        counts = script.sync_offices(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        self.assertEquals(counts, {'added': 0, 'updated': 0, 'deleted': 1, 'unchanged': 0})
+        count = self.es.count(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body={'query': {'match_all': {}}})
+        self.assertEquals(count['count'], 0)
+
+
+class CreateNationalTopsTest(CreateIndexBaseTest):
+    """
+    Test create_national_tops().
+    """
+
+    def test_create_national_tops(self):
+        script.create_national_tops(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        doc = script.get_office_as_es_doc(self.office)
+        rome_code = [key for key in doc if key.startswith('score_for_rome_')][0][len('score_for_rome_'):]
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=search_util.NATIONAL_TOP_TYPE, id=rome_code)
+        self.assertEquals(res['_source']['office_count'], 1)
+        self.assertEquals([office['siret'] for office in res['_source']['offices']], [self.office.siret])
+        self.assertFalse(res['_source']['offices'][0]['boosted'])
+
+    def test_remove_offices_refreshes_national_tops(self):
+        script.create_national_tops(index=self.ES_TEST_INDEX)
+        doc = script.get_office_as_es_doc(self.office)
+        rome_code = [key for key in doc if key.startswith('score_for_rome_')][0][len('score_for_rome_'):]
+        OfficeAdminRemove(siret=self.office.siret, name=u"N/A", reason=u"N/A", initiative=False).save()
+
+        script.remove_offices(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=search_util.NATIONAL_TOP_TYPE, id=rome_code)
+        self.assertEquals(res['_source']['office_count'], 0)
+        self.assertEquals(res['_source']['offices'], [])
+
+    def test_sync_offices_refreshes_national_tops(self):
+        script.create_national_tops(index=self.ES_TEST_INDEX)
+        doc = script.get_office_as_es_doc(self.office)
+        rome_code = [key for key in doc if key.startswith('score_for_rome_')][0][len('score_for_rome_'):]
+        self.office.delete()
+
+        script.sync_offices(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=search_util.NATIONAL_TOP_TYPE, id=rome_code)
+        self.assertEquals(res['_source']['office_count'], 0)
+
+
+class CompactScoresForRomeTest(CreateIndexBaseTest):
+    """
+    Test the compact layout of the scores adjusted to ROME codes (settings.ES_COMPACT_SCORES_FOR_ROME).
+    """
+
+    def tearDown(self):
+        settings.ES_COMPACT_SCORES_FOR_ROME = False
+        script.add_scores_to_request_body()
+        return super(CompactScoresForRomeTest, self).tearDown()
+
+    def test_compact_scores_match_scores_for_rome(self):
+        doc = script.get_office_as_es_doc(self.office)
+        settings.ES_COMPACT_SCORES_FOR_ROME = True
+        compact_doc = script.get_office_as_es_doc(self.office)
+
+        scores_for_rome = {
+            key[len('score_for_rome_'):]: value for key, value in doc.items() if key.startswith('score_for_rome_')
+        }
+        compact_scores_for_rome = {
+            score['rome_code']: score['score'] for score in compact_doc[search_util.SCORES_FOR_ROME_PATH]
+        }
+        self.assertTrue(scores_for_rome)
+        self.assertEquals(compact_scores_for_rome, scores_for_rome)
+        self.assertFalse([key for key in compact_doc if key.startswith('score_for_rome_')])
+
+    def test_search_compact_scores(self):
+        settings.ES_COMPACT_SCORES_FOR_ROME = True
+        script.add_scores_to_request_body()
+        script.drop_and_create_index(index=self.ES_TEST_INDEX)
+        script.create_offices(index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        score_for_rome = script.get_office_as_es_doc(self.office)[search_util.SCORES_FOR_ROME_PATH][0]
+        json_body = search_util.build_json_body_elastic_search(
+            [self.office.naf], self.office.y, self.office.x, 10, sort='score', rome_code=score_for_rome['rome_code'])
+        res = self.es.search(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body=json_body)
+        self.assertEquals([hit['_source']['siret'] for hit in res['hits']['hits']], [self.office.siret])
+        # The first sort value is the score adjusted to the rome_code.
+        self.assertEquals(res['hits']['hits'][0]['sort'][0], score_for_rome['score'])
+
+
+class ProfilingTest(unittest.TestCase):
+    """
+    Test the profiling report of the index build.
+    """
+
+    def test_profiler_records_phases(self):
+        profiler = script.BuildProfiler('default')
+        for _ in range(2):
+            with profiler.phase('db_read') as counters:
+                counters['rows'] += 10
+        report = profiler.get_report()
+        self.assertEquals(report['mode'], 'default')
+        self.assertEquals(report['phases'].keys(), ['db_read'])
+        self.assertEquals(report['phases']['db_read']['rows'], 20)
+        self.assertIn('rows_per_second', report['phases']['db_read'])
+        self.assertIn('process_peak_rss_kb', report['phases']['db_read'])
+
+    def test_profiling_regressions(self):
+        previous_report = {'phases': {
+            'db_read': {'wall_seconds': 100},
+            'bulk_send': {'wall_seconds': 100},
+            'refresh': {'wall_seconds': 1},
+        }}
+        report = {'phases': {
+            'db_read': {'wall_seconds': 110},
+            'bulk_send': {'wall_seconds': 150},
+            'refresh': {'wall_seconds': 3},
+            'sync': {'wall_seconds': 60},
+        }}
+        self.assertEquals(script.get_profiling_regressions(previous_report, report), [('bulk_send', 100, 150)])
+
+    def test_profiler_records_sub_phases(self):
+        profiler = script.BuildProfiler('drop_indexes')
+        with profiler.phase('doc_build'):
+            profiler.record('score_injection', wall_seconds=2.0, docs=10)
+        with profiler.phase('admin_overrides'):
+            with profiler.phase('bulk_send') as counters:
+                counters['docs'] += 5
+        report = profiler.get_report()
+        self.assertEquals(report['phases'].keys(),
+            ['doc_build', 'doc_build/score_injection', 'admin_overrides', 'admin_overrides/bulk_send'])
+        self.assertEquals(report['phases']['doc_build/score_injection']['docs_per_second'], 5)
+        self.assertEquals(report['phases']['admin_overrides/bulk_send']['docs'], 5)
+
+    def test_no_profiling_regressions_between_modes(self):
+        previous_report = {'mode': 'default', 'phases': {'bulk_send': {'wall_seconds': 10}}}
+        report = {'mode': 'drop_indexes', 'phases': {'bulk_send': {'wall_seconds': 1000}}}
+        self.assertEquals(script.get_profiling_regressions(previous_report, report), [])
@@ -0,0 +1,65 @@
+# coding: utf8
+
+import os
+import shutil
+import tempfile
+import time
+
+from labonneboite.common import search as search_util
+from labonneboite.importer.jobs.populate_flags import ExportedOffice
+from labonneboite.scripts import index_artifact
+from labonneboite.tests.scripts.test_create_index import CreateIndexBaseTest
+
+
+class IndexArtifactTest(CreateIndexBaseTest):
+    """
+    Test the export and restoration of index artifacts.
+    """
+
+    def setUp(self, *args, **kwargs):
+        super(IndexArtifactTest, self).setUp(*args, **kwargs)
+        self.output_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_folder)
+        return super(IndexArtifactTest, self).tearDown()
+
+    def test_export_and_restore(self):
+        path = index_artifact.export_artifact(self.output_folder)
+        manifest = index_artifact.load_manifest(path)
+        self.assertEquals(manifest['files']['office.jsonl.gz']['count'], 1)
+
+        index_artifact.restore_artifact(path, index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        count = self.es.count(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body={'query': {'match_all': {}}})
+        self.assertEquals(count['count'], 1)
+        res = self.es.get(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=self.office.siret,
+            routing=search_util.get_office_routing(self.office))
+        self.assertEquals(res['_source']['email'], self.office.email)
+
+    def test_export_given_offices(self):
+        office = ExportedOffice(**{field: getattr(self.office, field) for field in ExportedOffice._fields})
+        path = index_artifact.export_artifact(self.output_folder, offices=[office])
+        manifest = index_artifact.load_manifest(path)
+        self.assertEquals(manifest['files']['office.jsonl.gz']['count'], 1)
+
+    def test_restore_switches_alias(self):
+        path = index_artifact.export_artifact(self.output_folder)
+        first_index = index_artifact.restore_artifact(path, index=self.ES_TEST_INDEX)
+        second_index = index_artifact.restore_artifact(path, index=self.ES_TEST_INDEX)
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        # The alias points to the last restored index only, the previous one was deleted.
+        self.assertEquals(self.es.indices.get_alias(name=self.ES_TEST_INDEX).keys(), [second_index])
+        self.assertFalse(self.es.indices.exists(index=first_index))
+        count = self.es.count(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, body={'query': {'match_all': {}}})
+        self.assertEquals(count['count'], 1)
+
+    def test_corrupted_artifact_is_not_restored(self):
+        path = index_artifact.export_artifact(self.output_folder)
+        with open(os.path.join(path, 'office.jsonl.gz'), 'ab') as f:
+            f.write('corrupted')
+
+        with self.assertRaises(index_artifact.ArtifactException):
+            index_artifact.restore_artifact(path, index=self.ES_TEST_INDEX)
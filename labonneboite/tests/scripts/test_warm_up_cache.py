@@ -0,0 +1,31 @@
+# coding: utf8
+import unittest
+
+from labonneboite.conf import settings
+from labonneboite.scripts import warm_up_cache as script
+
+
+class WarmUpCacheTest(unittest.TestCase):
+
+    def test_parse_access_log_line(self):
+        line = '127.0.0.1 - - [10/Oct/2017:13:55:36 +0200] "GET /entreprises/metz-57000/boucherie?d=30&sort=distance HTTP/1.1" 200 2326'
+        searched = script.parse_access_log_line(line)
+        self.assertEqual(searched, script.Search(u'D1101', '57000', 30, 'distance'))
+
+    def test_parse_access_log_line_defaults(self):
+        line = '127.0.0.1 - - [10/Oct/2017:13:55:36 +0200] "GET /entreprises/metz-57000/boucherie HTTP/1.1" 200 2326'
+        searched = script.parse_access_log_line(line)
+        self.assertEqual(searched.distance, settings.DISTANCE_FILTER_DEFAULT)
+        self.assertEqual(searched.sort, settings.SORT_FILTER_DEFAULT)
+
+    def test_parse_access_log_line_ignores_other_pages(self):
+        line = '127.0.0.1 - - [10/Oct/2017:13:55:36 +0200] "GET /health HTTP/1.1" 200 3'
+        self.assertIsNone(script.parse_access_log_line(line))
+
+    def test_get_percentile(self):
+        durations = range(1, 101)
+        self.assertEqual(script.get_percentile(durations, 50), 50)
+        self.assertEqual(script.get_percentile(durations, 99), 99)
+        self.assertEqual(script.get_percentile(durations, 100), 100)
+        self.assertEqual(script.get_percentile([3], 90), 3)
+        self.assertIsNone(script.get_percentile([], 90))
@@ -3,11 +3,13 @@
 from urllib import urlencode
 import datetime
 import json
+import time
 
 from labonneboite.common import scoring as scoring_util
 from labonneboite.common import mapping as mapping_util
+from labonneboite.common import search
 from labonneboite.common.models import Office
-from labonneboite.common.search import get_companies_for_naf_codes
+from labonneboite.common.search import get_clusters_for_naf_codes, get_companies_for_naf_codes
 from labonneboite.conf import settings
 from labonneboite.tests.web.api.test_api_base import ApiBaseTest
 
@@ -54,6 +56,56 @@ class ApiGenericTest(ApiBaseTest):
         self.assertNotIn(u'00000000000002', sirets)
         self.assertEqual(len(companies), 1)
 
+    def test_clusters(self):
+        rome_code = u'D1408'
+        naf_codes = [u'7320Z']
+        latitude = 49.305658  # 15 Avenue François Mitterrand, 57290 Fameck, France.
+        longitude = 6.116853
+        distance = 100
+        bounding_box = (5, 48, 7, 50)
+        clusters = get_clusters_for_naf_codes(
+            naf_codes,
+            latitude,
+            longitude,
+            distance,
+            bounding_box,
+            10,
+            index=self.ES_TEST_INDEX,
+            rome_code=rome_code,
+        )
+        # The 3 offices of Bayonville-sur-Mad share the same location.
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]['count'], 3)
+        self.assertAlmostEqual(clusters[0]['latitude'], self.positions['bayonville_sur_mad']['location']['lat'], 3)
+        self.assertAlmostEqual(clusters[0]['longitude'], self.positions['bayonville_sur_mad']['location']['lon'], 3)
+
+    def test_national_search_uses_national_top(self):
+        rome_code = u'D1405'
+        self.es.index(index=self.ES_TEST_INDEX, doc_type=search.NATIONAL_TOP_TYPE, id=rome_code, body={
+            'rome_code': rome_code,
+            'office_count': 42,
+            'offices': [
+                {'siret': u'00000000000002', 'score': 50, 'boosted': False, 'lat': 49, 'lon': 6},
+                {'siret': u'00000000000001', 'score': 60, 'boosted': False, 'lat': 49, 'lon': 6},
+            ],
+        })
+        time.sleep(1)  # Sleep required by ES to register new documents.
+
+        latitude = self.positions['caen']['location']['lat']
+        longitude = self.positions['caen']['location']['lon']
+        naf_codes = mapping_util.Rome2NafMapper().map([rome_code])
+        companies, companies_count = get_companies_for_naf_codes(
+            naf_codes, latitude, longitude, search.NATIONAL_DISTANCE, 1, 2,
+            sort='score', index=self.ES_TEST_INDEX, rome_code=rome_code)
+        self.assertEqual(companies_count, 42)
+        self.assertEqual([company.siret for company in companies], [u'00000000000001', u'00000000000002'])
+        self.assertEqual(companies[0].distance, 464)
+
+        # count lookups are answered from the national top too
+        count = search.count_companies_for_naf_codes(
+            naf_codes, latitude, longitude, search.NATIONAL_DISTANCE, index=self.ES_TEST_INDEX, rome_code=rome_code)
+        self.assertEqual(count, 42)
+
     def test_naf_and_rome(self):
         """
         Ensure that those ROME codes can be used accurately in other tests.
@@ -252,6 +304,128 @@ class ApiCompanyListTest(ApiBaseTest):
         self.assertEqual(data['companies_count'], 3)
         self.assertEqual(len(data['companies']), 2)
 
+    def test_cursor_pagination(self):
+        params = self.add_security_params({
+            'distance': 10,
+            'latitude': self.positions['bayonville_sur_mad']['location']['lat'],
+            'longitude': self.positions['bayonville_sur_mad']['location']['lon'],
+            'page': 1,
+            'page_size': 2,
+            'rome_codes': u'D1405',
+            'user': u'labonneboite',
+        })
+        rv = self.app.get('/api/v1/company/?%s' % urlencode(params))
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data)
+        self.assertEqual(len(data['companies']), 2)
+        self.assertIn('next_cursor', data)
+        first_page_sirets = [company['siret'] for company in data['companies']]
+
+        params = self.add_security_params({
+            'cursor': data['next_cursor'],
+            'distance': 10,
+            'latitude': self.positions['bayonville_sur_mad']['location']['lat'],
+            'longitude': self.positions['bayonville_sur_mad']['location']['lon'],
+            'page_size': 2,
+            'rome_codes': u'D1405',
+            'user': u'labonneboite',
+        })
+        rv = self.app.get('/api/v1/company/?%s' % urlencode(params))
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data)
+        self.assertEqual(data['companies_count'], 3)
+        self.assertEqual(len(data['companies']), 1)
+        self.assertNotIn(data['companies'][0]['siret'], first_page_sirets)
+        self.assertNotIn('next_cursor', data)
+
+    def test_cursor_pagination_follows_sort_order(self):
+        params = {
+            'distance': 10,
+            'latitude': self.positions['bayonville_sur_mad']['location']['lat'],
+            'longitude': self.positions['bayonville_sur_mad']['location']['lon'],
+            'page': 1,
+            'page_size': 10,
+            'rome_codes': u'D1405',
+            'user': u'labonneboite',
+        }
+        rv = self.app.get('/api/v1/company/?%s' % urlencode(self.add_security_params(dict(params))))
+        self.assertEqual(rv.status_code, 200)
+        expected_sirets = [company['siret'] for company in json.loads(rv.data)['companies']]
+        self.assertEqual(len(expected_sirets), 3)
+
+        # Pages of a single office, each one fetched with the cursor of the previous page.
+        sirets = []
+        params['page_size'] = 1
+        del params['page']
+        cursor = None
+        for _ in expected_sirets:
+            if cursor:
+                params['cursor'] = cursor
+            rv = self.app.get('/api/v1/company/?%s' % urlencode(self.add_security_params(dict(params))))
+            self.assertEqual(rv.status_code, 200)
+            data = json.loads(rv.data)
+            sirets.extend(company['siret'] for company in data['companies'])
+            cursor = data.get('next_cursor')
+        self.assertEqual(sirets, expected_sirets)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        params = self.add_security_params({
+            'commune_id': self.positions['caen']['commune_id'],
+            'cursor': u'invalid',
+            'rome_codes': u'D1405',
+            'user': u'labonneboite',
+        })
+        rv = self.app.get('/api/v1/company/?%s' % urlencode(params))
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(rv.data, u'invalid cursor')
+
+    def test_shuffle_is_stable(self):
+        params = self.add_security_params({
+            'distance': 10,
+            'latitude': self.positions['bayonville_sur_mad']['location']['lat'],
+            'longitude': self.positions['bayonville_sur_mad']['location']['lon'],
+            'page': 1,
+            'page_size': 10,
+            'rome_codes': u'D1405',
+            'user': u'labonneboite',
+        })
+        sirets = []
+        for _ in range(2):
+            rv = self.app.get('/api/v1/company/?%s' % urlencode(params))
+            self.assertEqual(rv.status_code, 200)
+            data = json.loads(rv.data)
+            sirets.append([company['siret'] for company in data['companies']])
+        self.assertEqual(len(sirets[0]), 3)
+        self.assertEqual(sirets[0], sirets[1])
+
+    def test_facets(self):
+        params = self.add_security_params({
+            'distance': 10,
+            'facets': 1,
+            'headcount': settings.HEADCOUNT_SMALL_ONLY,
+            'latitude': self.positions['bayonville_sur_mad']['location']['lat'],
+            'longitude': self.positions['bayonville_sur_mad']['location']['lon'],
+            'page': 1,
+            'page_size': 10,
+            'rome_codes': u'D1405',
+            'user': u'labonneboite',
+        })
+        rv = self.app.get('/api/v1/company/?%s' % urlencode(params))
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data)
+        self.assertEqual(data['companies_count'], 1)
+        self.assertEqual(len(data['companies']), 1)
+        # The headcount facet is not restricted by the headcount filter itself.
+        self.assertEqual(data['facets']['headcount'], [
+            {'value': settings.HEADCOUNT_WHATEVER, 'count': 3},
+            {'value': settings.HEADCOUNT_SMALL_ONLY, 'count': 1},
+            {'value': settings.HEADCOUNT_BIG_ONLY, 'count': 2},
+        ])
+        self.assertEqual(data['facets']['naf'], [{'value': u'7320Z', 'count': 1}])
+        # Empty facets are omitted.
+        self.assertEqual(data['facets']['flag_alternance'], [{'value': 0, 'count': 1}])
+
     def test_query_by_commune_id(self):
         params = self.add_security_params({
             'commune_id': self.positions['caen']['commune_id'],
@@ -8,6 +8,7 @@ from labonneboite.conf import settings
 from labonneboite.web.api import util
 from labonneboite.common import mapping as mapping_util
 from labonneboite.common import scoring as scoring_util
+from labonneboite.common import search as search_util
 
 
 class ApiBaseTest(DatabaseTest):
@@ -64,6 +65,7 @@ class ApiBaseTest(DatabaseTest):
                         },
                         "location": {
                             "type": "geo_point",
+                            "lat_lon": True,
                         }
                     }
                 }
@@ -134,7 +136,17 @@ class ApiBaseTest(DatabaseTest):
                 )
                 doc['score_for_rome_%s' % rome_code] = office_score_for_current_rome 
 
-            self.es.index(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=i, body=doc)
+            # Same fields as create_index.get_office_as_es_doc, used to sort offices.
+            doc['boosted'] = int(doc['score'] == 100)
+            doc.update(search_util.get_shuffle_keys(doc['siret']))
+
+            # Offices are routed by departement, see search.get_office_routing.
+            routing = None
+            for position in self.positions:
+                if doc['location'] == self.positions[position]['location']:
+                    routing = self.positions[position]['zip_code'][:2]
+
+            self.es.index(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=i, body=doc, routing=routing)
         
         # need for ES to register our new documents, flaky test here otherwise
         time.sleep(1)
@@ -2,6 +2,7 @@
 
 import time
 
+from labonneboite.common import search as search_util
 from labonneboite.common.models import User
 from labonneboite.common.models import Office
 from labonneboite.common.models import UserFavoriteOffice
@@ -111,7 +112,17 @@ class FavoriteBaseTest(DatabaseTest):
             },
         ]
         for i, doc in enumerate(docs, start=1):
-            self.es.index(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=i, body=doc)
+            # Same fields as create_index.get_office_as_es_doc, used to sort offices.
+            doc['boosted'] = int(doc['score'] == 100)
+            doc.update(search_util.get_shuffle_keys(doc['siret']))
+
+            # Offices are routed by departement, see search.get_office_routing.
+            routing = None
+            for position in self.positions:
+                if doc['location'] == self.positions[position]['location']:
+                    routing = self.positions[position]['zip_code'][:2]
+
+            self.es.index(index=self.ES_TEST_INDEX, doc_type=self.ES_OFFICE_TYPE, id=i, body=doc, routing=routing)
 
         # Sleep required by ES to register new documents, flaky test here otherwise.
         time.sleep(1)
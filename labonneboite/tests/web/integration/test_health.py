@@ -16,3 +16,7 @@ class HealthTest(AppTest):
         rv = self.app.get("/health/es")
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(rv.data, 'yes')
+
+        rv = self.app.get("/health/es/circuit")
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, 'closed')
@@ -17,3 +17,13 @@ class PaginationTest(unittest.TestCase):
         pm = PaginationManager(company_count, 1, 10, "")
         pm.get_pages()
         self.assertEquals(2, pm.get_page_count())
+
+    def test_pagination_cursor_only_on_next_page(self):
+        company_count = 40
+        pm = PaginationManager(company_count, 11, 20, "/entreprises?from=11&to=20&c=old", next_cursor="abc")
+        pages = pm.get_pages()
+        urls = dict((page.ranking, page.get_url()) for page in pages)
+        self.assertIn("c=abc", urls[2])
+        self.assertIn("from=21", urls[2])
+        for ranking in [0, 1, 3]:
+            self.assertNotIn("c=", urls[ranking])
@@ -68,6 +68,13 @@ def company_list():
     - `distance`: perimeter of the search radius (in Km) in which to search.
     - `page`: number of the requested page.
     - `page_size`: number of results per page.
+    - `cursor`: the `next_cursor` value of a previous response, to fetch the following page.
+      Much faster than `page` for deep pages. When given, `page` is ignored.
+    - `facets`: set to `1` to get the number of offices for each value of the `naf`, `headcount`,
+      `flag_alternance` and `public` filters. Values without any office are omitted.
+
+    When the search engine is unavailable, the last known result of the same search is returned
+    with `stale` set to true, if any. Otherwise a 503 error is returned.
     """
 
     current_app.logger.debug("API request received: %s", request.full_path)
@@ -126,6 +133,17 @@ def company_list():
         pass
     # -------
 
+    search_after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            sort, search_after, from_number = search.decode_cursor(cursor)
+        except search.CursorException:
+            return u'invalid cursor', 400
+        if sort != settings.SORT_FILTER_DEFAULT:
+            return u'invalid cursor', 400
+        to_number = from_number + page_size - 1
+
     try:
         distance = int(request.args.get('distance'))
     except (TypeError, ValueError):
@@ -139,24 +157,44 @@ def company_list():
     mapper = mapping_util.Rome2NafMapper()
     naf_code_list = mapper.map(rome_code_list)
 
-    companies, companies_count = search.get_companies_for_naf_codes(
-        naf_code_list,
-        latitude,
-        longitude,
-        distance,
-        headcount_filter=headcount_filter,
-        from_number=from_number,
-        to_number=to_number,
-        sort=settings.SORT_FILTER_DEFAULT,
-        index=settings.ES_INDEX,
-        rome_code=rome_code,
-    )
+    with_facets = request.args.get('facets') == '1'
+
+    try:
+        result = search.search_companies_for_naf_codes(
+            naf_code_list,
+            latitude,
+            longitude,
+            distance,
+            headcount_filter=headcount_filter,
+            from_number=from_number,
+            to_number=to_number,
+            sort=settings.SORT_FILTER_DEFAULT,
+            index=settings.ES_INDEX,
+            rome_code=rome_code,
+            search_after=search_after,
+            facets=with_facets,
+        )
+    except search.SearchUnavailableException:
+        return u'search is temporarily unavailable, please retry later', 503
 
     company_json = {
-        'companies': [company.as_json(rome_code=rome_code) for company in companies],
-        'companies_count': companies_count
+        'companies': [company.as_json(rome_code=rome_code) for company in result.companies],
+        'companies_count': result.companies_count
     }
 
+    if result.stale:
+        company_json['stale'] = True
+
+    if result.facets:
+        company_json['facets'] = {
+            name: [{'value': value, 'count': count} for value, count in sorted(counts.items()) if count]
+            for name, counts in result.facets.iteritems()
+        }
+
+    if result.next_search_after and to_number < result.companies_count:
+        company_json['next_cursor'] = search.encode_cursor(
+            settings.SORT_FILTER_DEFAULT, result.next_search_after, to_number + 1)
+
     return jsonify(company_json)
 
 
@@ -1,5 +1,6 @@
 from elasticsearch import Elasticsearch
 from labonneboite.common.database import db_session  # This is how we talk to the database.
+from labonneboite.common import search
 
 
 def is_db_alive():
@@ -17,3 +18,7 @@ def is_elasticsearch_alive():
         return True
     except:
         return False
+
+
+def get_elasticsearch_circuit_state():
+    return search.ELASTIC_SEARCH_CIRCUIT_BREAKER.get_state()
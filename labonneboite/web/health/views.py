@@ -43,3 +43,13 @@ def health_elasticsearch():
         return make_response("yes")
     else:
         return make_response("no")
+
+
+@healthBlueprint.route('/es/circuit')
+def health_elasticsearch_circuit():
+    """
+    Returns the state of the circuit breaker around elasticsearch searches in the current process:
+    'closed' (searches go through), 'open' (searches fail fast or serve stale results)
+    or 'half-open' (a search is probing whether elasticsearch has recovered)
+    """
+    return make_response(health_util.get_elasticsearch_circuit_state())
@@ -57,12 +57,13 @@ class PaginationManager(object):
     A pagination class which is specific for offices search results.
     """
     def __init__(self, company_count, current_from_number, current_to_number,
-                 full_path_url):
+                 full_path_url, next_cursor=None):
         self.pages = []
         self.company_count = company_count
         self.current_from_number = current_from_number
         self.current_to_number = current_to_number
         self.full_path_url = full_path_url
+        self.next_cursor = next_cursor
         self._current_page = None
 
     def _run(self):
@@ -70,9 +71,18 @@ class PaginationManager(object):
         for ranking in range(min_page, max_page):
             url_parts = list(urlparse.urlparse(self.full_path_url))
             page = Page(ranking, self.company_count, self.current_from_number,
-                        url_parts)
+                        url_parts, cursor=self.get_cursor_for_ranking(ranking))
             self.pages.append(page)
 
+    def get_cursor_for_ranking(self, ranking):
+        """
+        Only the page right after the current one can be fetched using the cursor
+        of the current page, other pages are fetched using their `from` offset.
+        """
+        if ranking == self.get_current_page():
+            return self.next_cursor
+        return None
+
     def should_show(self):
         pages = self.get_pages()
         return len(pages) > 1
@@ -131,19 +141,20 @@ class PaginationManager(object):
         ranking = self.get_page_count() - 1
         url_parts = list(urlparse.urlparse(self.full_path_url))
         page = Page(ranking, self.company_count, self.current_from_number,
-                    url_parts)
+                    url_parts, cursor=self.get_cursor_for_ranking(ranking))
         return page
 
 
 class Page(object):
 
-    def __init__(self, ranking, company_count, current_from_number, url_parts):
+    def __init__(self, ranking, company_count, current_from_number, url_parts, cursor=None):
         self.ranking = ranking
         self.company_count = company_count
         self._from_number = None
         self._to_number = None
         self.url_parts = url_parts
         self.current_from_number = current_from_number
+        self.cursor = cursor
 
     def get_from_number(self):
         if not self._from_number:
@@ -161,6 +172,9 @@ class Page(object):
     def get_url(self):
         params = {'from': self.get_from_number(), 'to': self.get_to_number()}
         url_query = dict(urlparse.parse_qsl(self.url_parts[4]))
+        url_query.pop('c', None)
+        if self.cursor:
+            params['c'] = self.cursor
         url_query.update(params)
         self.url_parts[4] = urlencode(url_query)
         page_url = urlparse.urlunparse(self.url_parts)
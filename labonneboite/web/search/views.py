@@ -60,6 +60,7 @@ PARAMETER_FIELD_MAPPING = {
     'sort': 'sort',
     'from': 'from',
     'to': 'to',
+    'c': 'cursor',
     'f_a': 'flag_alternance',
     'p': 'public',
 }
@@ -112,6 +113,24 @@ def get_parameters(args):
     return kwargs
 
 
+def add_facet_counts_to_choices(choices, counts, selected_value):
+    """
+    Adds the number of offices found for each choice (see search_util.get_facets_from_aggregations)
+    to its label, and hides the choices without any office unless they are selected.
+    Choices which were not counted are left untouched.
+    """
+    counts = {unicode(value): count for value, count in counts.iteritems()}
+    selected_value = unicode(selected_value)
+    result = []
+    for value, label in choices:
+        count = counts.get(unicode(value))
+        if count is None:
+            result.append((value, label))
+        elif count or unicode(value) == selected_value:
+            result.append((value, u'%s (%s)' % (label, count)))
+    return result
+
+
 @searchBlueprint.route('/entreprises/<city>-<zipcode>/<occupation>')
 def results(city, zipcode, occupation):
 
@@ -146,6 +165,8 @@ def results(city, zipcode, occupation):
     alternative_rome_descriptions = []
     alternative_distances = {}
     location_error = False
+    search_unavailable = False
+    next_cursor = None
     try:
         current_app.logger.debug("fetching companies and company_count")
         companies = fetcher.get_companies()
@@ -156,6 +177,7 @@ def results(city, zipcode, occupation):
                 alternative_rome_descriptions.append([alternative, desc, slug, count])
         company_count = fetcher.company_count
         alternative_distances = fetcher.alternative_distances
+        next_cursor = fetcher.next_cursor
     except search_util.JobException:
         companies = []
         company_count = 0
@@ -163,11 +185,16 @@ def results(city, zipcode, occupation):
         companies = []
         company_count = 0
         location_error = True
+    except search_util.SearchUnavailableException:
+        companies = []
+        company_count = 0
+        search_unavailable = True
 
     # Pagination.
     from_number_param = int(kwargs.get('from') or 1)
     to_number_param = int(kwargs.get('to') or 10)
-    pagination_manager = PaginationManager(company_count, from_number_param, to_number_param, request.full_path)
+    pagination_manager = PaginationManager(
+        company_count, from_number_param, to_number_param, request.full_path, next_cursor=next_cursor)
     current_page = pagination_manager.get_current_page()
 
     # Get contact mode.
@@ -198,6 +225,17 @@ def results(city, zipcode, occupation):
     form_kwargs['job'] = settings.ROME_DESCRIPTIONS[rome]
     form = CompanySearchForm(**form_kwargs)
     form.naf.choices = [('', u'Tous les secteurs')] + sorted(naf_codes_with_descriptions, key=lambda t: t[1])
+
+    # Show the number of offices for each filter value and hide empty ones.
+    if fetcher.facets:
+        form.naf.choices = add_facet_counts_to_choices(form.naf.choices, fetcher.facets['naf'], kwargs['naf'])
+        form.headcount.choices = add_facet_counts_to_choices(
+            form.headcount.choices, fetcher.facets['headcount'], kwargs['headcount'])
+        form.flag_alternance.choices = add_facet_counts_to_choices(
+            form.flag_alternance.choices, fetcher.facets['flag_alternance'], kwargs['flag_alternance'])
+        if 'public' in kwargs:
+            form.public.choices = add_facet_counts_to_choices(
+                form.public.choices, fetcher.facets['public'], kwargs['public'])
     form.validate()
 
     context = {
@@ -220,14 +258,52 @@ def results(city, zipcode, occupation):
         'pagination': pagination_manager,
         'rome_code': rome,
         'rome_description': settings.ROME_DESCRIPTIONS.get(fetcher.rome, ''),
+        'search_unavailable': search_unavailable,
         'show_favorites': True,
         'sort': kwargs['sort'],
+        'stale_results': fetcher.stale,
         'tile_server_url': settings.TILE_SERVER_URL,
         'user_favs_as_sirets': UserFavoriteOffice.user_favs_as_sirets(current_user),
     }
     return render_template('search/results.html', **context)
 
 
+@searchBlueprint.route('/entreprises/<city>-<zipcode>/<occupation>/clusters')
+def clusters(city, zipcode, occupation):
+    """
+    Returns the offices of a search as clusters to be displayed on the results map.
+
+    Accepts the same parameters as the results page, plus:
+    - `bbox`: the bounding box of the map, formatted as "west,south,east,north"
+    - `zoom`: the zoom level of the map
+    """
+    if occupation not in mapping_util.SLUGIFIED_ROME_LABELS:
+        abort(404)
+
+    try:
+        bounding_box = [float(coordinate) for coordinate in request.args.get('bbox', '').split(',')]
+        zoom = int(request.args.get('zoom'))
+    except (TypeError, ValueError):
+        abort(400)
+    if len(bounding_box) != 4:
+        abort(400)
+
+    kwargs = get_parameters(request.args)
+    kwargs['city'] = city
+    kwargs['zipcode'] = zipcode
+    kwargs['occupation'] = occupation
+
+    fetcher = search_util.Fetcher(**kwargs)
+    try:
+        clusters = fetcher.get_clusters(bounding_box, zoom)
+    except search_util.LocationError:
+        abort(404)
+    except search_util.SearchUnavailableException:
+        abort(503)
+
+    return make_response(json.dumps({'clusters': clusters}))
+
+
 @searchBlueprint.route('/entreprises/commune/<commune_id>/rome/<rome_id>', methods=['GET'])
 def results_by_commune_and_rome(commune_id, rome_id):
     """
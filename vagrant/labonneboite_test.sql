@@ -56,6 +56,7 @@ CREATE TABLE `etablissements_prod` (
   `score` int(11) DEFAULT NULL,
   `website1` varchar(191) DEFAULT NULL,
   `website2` varchar(191) DEFAULT NULL,
+  `content_hash` char(32) DEFAULT NULL,
   PRIMARY KEY (`siret`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 